@@ -1,8 +1,12 @@
 import edge_tts
-import speech_recognition as sr
-from pydub import AudioSegment
-import io
+import asyncio
+import hashlib
+import importlib
+import inspect
 import os
+import re
+import threading
+import time
 import uuid
 
 # Configuration
@@ -13,28 +17,359 @@ VOICE = "th-TH-PremwadeeNeural"
 RATE = "-5%"
 PITCH = "+60Hz"
 
-async def generate_audio(text: str, output_file: str):
+# Synthesis backend: edge (online, default), espeak (offline, espeak-ng), or "module:function"
+TTS_BACKEND = os.getenv("TTS_BACKEND", "edge")
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "4")) # syntheses in flight at once, across all replies
+ESPEAK_BINARY = os.getenv("TTS_ESPEAK_BINARY", "espeak-ng")
+ESPEAK_VOICE = os.getenv("TTS_ESPEAK_VOICE", "th")
+
+# Audio cache: one file per distinct (backend, voice, rate, pitch, text)
+AUDIO_DIR = os.getenv("TTS_AUDIO_DIR", "static_audio")
+CACHE_MAX_MB = float(os.getenv("TTS_CACHE_MAX_MB", "500"))
+CACHE_MIN_AGE = float(os.getenv("TTS_CACHE_MIN_AGE", "900")) # seconds; recently used files are never swept (clients may still fetch them)
+SWEEP_INTERVAL = float(os.getenv("TTS_SWEEP_INTERVAL", "300")) # seconds
+
+# Sentence pipelining (streamed replies)
+# Thai separates sentences/phrases with spaces, so whitespace is a boundary too.
+SEGMENT_BOUNDARY = re.compile(r'[.!?…]+\s*|\n+|\s+')
+MIN_SEGMENT_CHARS = int(os.getenv("TTS_MIN_SEGMENT_CHARS", "12"))
+MAX_SEGMENT_CHARS = int(os.getenv("TTS_MAX_SEGMENT_CHARS", "200"))
+SEGMENT_CONCURRENCY = int(os.getenv("TTS_SEGMENT_CONCURRENCY", "3"))
+
+# ==========================================
+# SYNTHESIS BACKENDS
+# ==========================================
+
+async def _synthesize_edge(text, output_file):
     # Direct Thai Text -> Thai Voice (No Transliteration needed for Premwadee)
     communicate = edge_tts.Communicate(text, VOICE, rate=RATE, pitch=PITCH)
     await communicate.save(output_file)
+
+async def _synthesize_espeak(text, output_file):
+    # Offline: espeak-ng writes WAV. RATE/PITCH are mapped onto its words-per-minute and 0-99 scales.
+    speed = round(175 * (1 + int(RATE.rstrip("%")) / 100))
+    pitch = min(99, max(0, 50 + int(PITCH.rstrip("Hz")) // 2))
+    process = await asyncio.create_subprocess_exec(
+        ESPEAK_BINARY, "-v", ESPEAK_VOICE, "-s", str(speed), "-p", str(pitch), "-w", output_file, "--stdin",
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await process.communicate(text.encode("utf-8"))
+    if process.returncode != 0:
+        raise RuntimeError(f"espeak-ng failed: {stderr.decode('utf-8', 'replace').strip()}")
+
+_synthesize_edge.extension = "mp3"
+_synthesize_espeak.extension = "wav"
+
+BACKENDS = {
+    "edge": _synthesize_edge,
+    "espeak": _synthesize_espeak,
+}
+
+def resolve_backend(name=TTS_BACKEND):
+    """
+    Built-in name, or "module:function" for a custom fn(text, output_file), sync or async.
+    Set fn.extension (default "mp3") if it writes another format.
+    """
+    if name in BACKENDS:
+        return BACKENDS[name]
+    if ":" in name:
+        module_name, attr = name.split(":", 1)
+        return getattr(importlib.import_module(module_name), attr)
+    raise ValueError(f"Unknown TTS backend '{name}'")
+
+async def _run_backend(fn, text, output_file):
+    if inspect.iscoroutinefunction(fn):
+        await fn(text, output_file)
+    else:
+        await asyncio.to_thread(fn, text, output_file)
+
+async def generate_audio(text: str, output_file: str):
+    # Uncached, straight to output_file (scripts); replies go through cache.synthesize
+    await _run_backend(resolve_backend(), text, output_file)
     return output_file
 
-def transcribe_audio(audio_file_path: str, language="th-TH") -> str:
-    recognizer = sr.Recognizer()
-    
-    # Convert audio to wav if needed (pydub)
-    # SpeechRecognition prefers WAV
-    sound = AudioSegment.from_file(audio_file_path)
-    wav_path = audio_file_path + ".wav"
-    sound.export(wav_path, format="wav")
-    
-    with sr.AudioFile(wav_path) as source:
-        audio_data = recognizer.record(source)
+# ==========================================
+# CONTENT-ADDRESSED AUDIO CACHE
+# ==========================================
+
+class AudioCache:
+    """
+    TTS output keyed by a hash of (backend, voice, rate, pitch, text): a text that was
+    spoken before is served from disk, and concurrent requests for it share one synthesis.
+    At most `workers` syntheses run at once. A background sweeper keeps the directory
+    under max_bytes, removing least recently used files first.
+    """
+
+    def __init__(self, directory=AUDIO_DIR, backend=TTS_BACKEND, workers=TTS_WORKERS,
+                 max_mb=CACHE_MAX_MB, min_age=CACHE_MIN_AGE, sweep_interval=SWEEP_INTERVAL):
+        self.directory = directory
+        self.backend = backend
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.min_age = min_age
+        self.sweep_interval = sweep_interval
+        self._fn = None
+        self._semaphore = asyncio.Semaphore(max(1, workers))
+        self._inflight = {} # filename -> task synthesizing it
+        self._stop = threading.Event()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0 # requests that joined an in-flight synthesis
+        self.swept_files = 0
+
+    def _backend_fn(self):
+        if self._fn is None:
+            self._fn = resolve_backend(self.backend)
+        return self._fn
+
+    def filename_for(self, text):
+        fn = self._backend_fn()
+        key = "\0".join((self.backend, VOICE, RATE, PITCH, text))
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+        return f"tts_{digest}.{getattr(fn, 'extension', 'mp3')}"
+
+    async def synthesize(self, text):
+        """
+        Filename (inside directory) of the audio for text, synthesizing it if needed.
+        """
+        filename = self.filename_for(text)
+        path = os.path.join(self.directory, filename)
         try:
-            text = recognizer.recognize_google(audio_data, language=language)
-            return text
-        except sr.UnknownValueError:
-            return ""
-        except sr.RequestError as e:
-            print(f"Could not request results; {e}")
-            return ""
+            os.utime(path) # LRU: mark as recently used
+            self.hits += 1
+            return filename
+        except FileNotFoundError:
+            pass
+
+        task = self._inflight.get(filename)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._render(text, path))
+            self._inflight[filename] = task
+            task.add_done_callback(lambda _: self._inflight.pop(filename, None))
+        else:
+            self.shared += 1
+        # Shielded: one caller disconnecting must not cancel the synthesis others wait on
+        await asyncio.shield(task)
+        return filename
+
+    async def _render(self, text, path):
+        part = f"{path}.{uuid.uuid4().hex}.part"
+        async with self._semaphore:
+            try:
+                await _run_backend(self._backend_fn(), text, part)
+                os.replace(part, path) # Never serve a half-written file
+            finally:
+                if os.path.exists(part):
+                    os.remove(part)
+
+    # --- Retention ---
+
+    def sweep(self):
+        """
+        Delete least recently used files until the directory fits in max_bytes.
+        Covers every file here (legacy reply_*.mp3 and playlists too).
+        """
+        files = []
+        total = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        if total <= self.max_bytes:
+            return 0
+
+        files.sort()
+        cutoff = time.time() - self.min_age
+        removed = 0
+        for mtime, size, path in files:
+            if total <= self.max_bytes or mtime > cutoff:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        self.swept_files += removed
+        if removed:
+            print(f"TTS Cache: swept {removed} file(s)")
+        return removed
+
+    def _sweep_loop(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"TTS Sweep Error: {e}")
+            if self._stop.wait(self.sweep_interval):
+                return
+
+    def start_sweeper(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sweep_loop, name="tts-sweeper", daemon=True)
+        self._thread.start()
+
+    def stop_sweeper(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def stats(self):
+        return {
+            "backend": self.backend,
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "in_flight": len(self._inflight),
+            "swept_files": self.swept_files,
+        }
+
+cache = AudioCache()
+
+class SentenceSegmenter:
+    """
+    Cuts a text stream into speakable segments at sentence/phrase boundaries.
+    """
+
+    def __init__(self, min_chars=MIN_SEGMENT_CHARS, max_chars=MAX_SEGMENT_CHARS):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self._buffer = ""
+
+    def feed(self, text):
+        self._buffer += text
+        segments = []
+        while True:
+            cut = None
+            for match in SEGMENT_BOUNDARY.finditer(self._buffer):
+                if match.end() == len(self._buffer):
+                    break # Boundary at the very end may still grow (e.g. "..." or more spaces)
+                if len(self._buffer[:match.start()].strip()) >= self.min_chars:
+                    cut = match.end()
+                    break
+            if cut is None and len(self._buffer) >= self.max_chars:
+                cut = self.max_chars
+            if cut is None:
+                break
+            segment = self._buffer[:cut].strip()
+            self._buffer = self._buffer[cut:]
+            if segment:
+                segments.append(segment)
+        return segments
+
+    def flush(self):
+        segment = self._buffer.strip()
+        self._buffer = ""
+        return [segment] if segment else []
+
+class SpeechPipeline:
+    """
+    Synthesizes reply segments concurrently while the LLM is still generating.
+    Segments are handed out in order as soon as each one (and all before it) is ready.
+    Segment audio comes from the shared AudioCache, so repeated sentences are not re-synthesized.
+    """
+
+    def __init__(self, output_dir: str, url_prefix: str, reply_id: str = None, concurrency: int = SEGMENT_CONCURRENCY, audio_cache: AudioCache = None):
+        self.output_dir = output_dir
+        self.url_prefix = url_prefix
+        self.reply_id = reply_id or str(uuid.uuid4())
+        self.audio_cache = audio_cache or cache
+        self.segmenter = SentenceSegmenter()
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        self._tasks = []
+        self._next_index = 0 # next segment to hand out
+        self.segment_urls = []
+
+    def feed(self, text: str):
+        for segment in self.segmenter.feed(text):
+            self._start(segment)
+
+    def finish(self):
+        for segment in self.segmenter.flush():
+            self._start(segment)
+
+    def _start(self, segment):
+        self._tasks.append(asyncio.create_task(self._synthesize(segment)))
+
+    async def _synthesize(self, segment):
+        async with self._semaphore:
+            try:
+                return await self.audio_cache.synthesize(segment)
+            except Exception as e:
+                print(f"TTS Segment Error: {e}")
+                return None
+
+    def _take(self, index):
+        filename = self._tasks[index].result()
+        if filename is None:
+            return None
+        url = f"{self.url_prefix}/{filename}"
+        self.segment_urls.append(url)
+        return {"index": len(self.segment_urls) - 1, "url": url}
+
+    def pop_ready(self):
+        """
+        Non-blocking: segments that finished, in order, not yet handed out.
+        """
+        ready = []
+        while self._next_index < len(self._tasks) and self._tasks[self._next_index].done():
+            item = self._take(self._next_index)
+            self._next_index += 1
+            if item:
+                ready.append(item)
+        return ready
+
+    async def drain(self):
+        """
+        Wait for the remaining segments, yielding each in order.
+        """
+        while self._next_index < len(self._tasks):
+            await asyncio.wait([self._tasks[self._next_index]])
+            item = self._take(self._next_index)
+            self._next_index += 1
+            if item:
+                yield item
+
+    def write_playlist(self):
+        # M3U playlist of the segments (for players that accept one)
+        if not self.segment_urls:
+            return None
+        filename = f"reply_{self.reply_id}.m3u"
+        with open(os.path.join(self.output_dir, filename), "w", encoding="utf-8") as f:
+            f.write("#EXTM3U\n")
+            for url in self.segment_urls:
+                f.write(url.rsplit("/", 1)[-1] + "\n")
+        return f"{self.url_prefix}/{filename}"
+
+def transcribe_audio(audio_file_path: str, language="th-TH") -> str:
+    # Blocking helper for scripts; the API uses transcription.transcribe (worker pool, no temp files)
+    import transcription
+    with open(audio_file_path, "rb") as f:
+        return transcription.transcribe_bytes(f.read(), language=language)
+
+if __name__ == "__main__":
+    # Local TTS benchmark: python audio_service.py [backend ...]  (cold synthesis, then cached)
+    import sys
+    import tempfile
+
+    async def _benchmark(names):
+        sample = "สวัสดีค่ะ หนูชื่อมะลิ วันนี้มีอะไรให้ช่วยไหมคะ"
+        for name in names:
+            with tempfile.TemporaryDirectory() as directory:
+                bench = AudioCache(directory, backend=name)
+                for label in ("cold", "cached"):
+                    start = time.perf_counter()
+                    try:
+                        filename = await bench.synthesize(sample)
+                    except Exception as e:
+                        print(f"{name}: failed ({e})")
+                        break
+                    size = os.path.getsize(os.path.join(directory, filename))
+                    print(f"{name} {label}: {(time.perf_counter() - start) * 1000:.0f} ms, {size} bytes")
+
+    asyncio.run(_benchmark(sys.argv[1:] or list(BACKENDS)))
@@ -1,12 +1,25 @@
 from datetime import datetime, timedelta
 from typing import Optional
+from collections import OrderedDict
+import asyncio
+import math
+import os
+import threading
+import time
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
 from pydantic import BaseModel
 import models, database
+import password_hashing
+import worker_pools
+# Re-exported: these used to live here
+pwd_context = password_hashing.pwd_context
+verify_password = password_hashing.verify_password
+get_password_hash = password_hashing.get_password_hash
 
 class TokenData(BaseModel):
     username: Optional[str] = None
@@ -16,14 +29,95 @@ SECRET_KEY = "MALI_CHAT_SUPER_SECRET_KEY_CHANGE_ME" # In production, use os.gete
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 # 24 Hours
 
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+# Auth caches: a hit skips both the JWT HMAC check and the user query
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "60")) # seconds
+AUTH_CACHE_MAX = int(os.getenv("AUTH_CACHE_MAX", "10000"))
+
+# Password hashing runs off the event loop, on a small worker pool
+HASH_WORKERS = int(os.getenv("AUTH_HASH_WORKERS", str(min(2, os.cpu_count() or 1))))
+HASH_CONCURRENCY = int(os.getenv("AUTH_HASH_CONCURRENCY", str(HASH_WORKERS * 2))) # hash jobs in flight
+# Login/register rate shaping (token bucket): bursts are smoothed out instead of queueing on the pool
+LOGIN_RATE = float(os.getenv("AUTH_LOGIN_RATE", "20")) # per second
+LOGIN_BURST = int(os.getenv("AUTH_LOGIN_BURST", "40"))
+LOGIN_MAX_WAIT = float(os.getenv("AUTH_LOGIN_MAX_WAIT", "5")) # seconds; longer waits get 429
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+# ==========================================
+# PASSWORD HASHING POOL
+# ==========================================
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+_hash_slots = asyncio.Semaphore(max(1, HASH_CONCURRENCY))
+
+def _get_hash_pool():
+    # Workers only import password_hashing (see worker_pools.make_cpu_pool)
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = worker_pools.make_cpu_pool(HASH_WORKERS, "auth-hash")
+        return _hash_pool
+
+async def _run_hash(fn, *args):
+    async with _hash_slots:
+        return await asyncio.get_running_loop().run_in_executor(_get_hash_pool(), fn, *args)
+
+async def verify_password_async(plain_password, hashed_password):
+    return await _run_hash(password_hashing.verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    return await _run_hash(password_hashing.get_password_hash, password)
+
+def shutdown_hash_pool():
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is not None:
+            _hash_pool.shutdown(wait=False, cancel_futures=True)
+            _hash_pool = None
+
+
+class TokenBucket:
+    """
+    Rate shaper: reserve() returns how long to wait for the next slot.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = max(rate, 0.001)
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def cancel(self):
+        with self._lock:
+            self.tokens += 1
+
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+_login_bucket = TokenBucket(LOGIN_RATE, LOGIN_BURST)
+
+async def throttle_login():
+    """
+    Smooth login/register storms. Raises 429 (with Retry-After) if the wait would be too long.
+    """
+    wait = _login_bucket.reserve()
+    if wait > LOGIN_MAX_WAIT:
+        _login_bucket.cancel()
+        raise HTTPException(
+            status_code=429,
+            detail="Too many login attempts right now, please retry shortly",
+            headers={"Retry-After": str(math.ceil(wait))}
+        )
+    if wait > 0:
+        await asyncio.sleep(wait)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -36,7 +130,82 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
+class TTLCache:
+    """
+    Bounded LRU with a per-entry expiry.
+    """
+
+    def __init__(self, ttl=AUTH_CACHE_TTL, max_entries=AUTH_CACHE_MAX):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return item[1]
+
+    def put(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_token_cache = TTLCache() # raw token -> email ('sub'), never past the token's own expiry
+_user_cache = TTLCache() # email -> User column values
+
+def invalidate_user(email: str):
+    """
+    Call after changing or deleting a user (role, active flag, nickname, ...).
+    """
+    _user_cache.pop(email)
+
+def _decode_token(token: str):
+    email = _token_cache.get(token)
+    if email is not None:
+        return email
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    email = payload.get("sub") # access_token 'sub' holding the email
+    exp = payload.get("exp")
+    if email is not None:
+        _token_cache.put(token, email, ttl=(exp - time.time()) if exp else None)
+    return email
+
+async def _load_user(db: AsyncSession, email: str):
+    cached = _user_cache.get(email)
+    if cached is not None:
+        # Attach a copy to this request's session without a query, so updates still commit normally
+        user = models.User(**cached)
+        make_transient_to_detached(user)
+        return await db.merge(user, load=False)
+
+    result = await db.execute(select(models.User).where(models.User.email == email)) # Query by EMAIL
+    user = result.scalars().first()
+    if user is not None:
+        _user_cache.put(email, {attr.key: getattr(user, attr.key) for attr in inspect(models.User).column_attrs})
+    return user
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(database.get_async_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -45,8 +214,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     try:
         # Debugging Token
         # print(f"DEBUG AUTH: Received Token: {token[:10]}...") 
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub") # access_token 'sub' holding the email
+        username: str = _decode_token(token)
         # print(f"DEBUG AUTH: Decoded sub: {username}")
 
         if username is None:
@@ -57,10 +225,12 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
         print(f"DEBUG AUTH: JWT Verification Failed: {e}")
         raise credentials_exception
         
-    user = db.query(models.User).filter(models.User.email == token_data.username).first() # Query by EMAIL
+    user = await _load_user(db, token_data.username)
     if user is None:
         print(f"DEBUG AUTH: User not found in DB for email: {token_data.username}")
         raise credentials_exception
+    if not user.is_active:
+        raise HTTPException(status_code=403, detail="User is banned")
     return user
 
 async def get_current_admin(current_user: models.User = Depends(get_current_user)):
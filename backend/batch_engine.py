@@ -0,0 +1,270 @@
+import os
+import queue
+import threading
+from concurrent.futures import Future
+
+import torch
+
+from prefix_cache import build_transformers_prefix, match_prefix, to_legacy_cache, to_model_cache
+
+# Configuration
+MAX_BATCH_SIZE = int(os.getenv("LLM_BATCH_SIZE", "8"))
+
+
+class _Sequence:
+    def __init__(self, prompt_ids, max_new_tokens, prefix_text=None):
+        self.prompt_ids = prompt_ids
+        self.prefix_text = prefix_text # static system-prompt start, prefilled once via the prefix cache
+        self.max_new_tokens = max_new_tokens
+        self.generated = []
+        self.text = ""
+        self.emitted = 0 # chars of self.text already streamed
+        self.finished = False
+        self.pieces = queue.Queue() # streamed text deltas, None = end
+        self.future = Future()
+
+
+def _left_pad(legacy, target_len):
+    # Pad every layer's (k, v) [B, heads, T, dim] with zeros on the left up to target_len
+    pad = target_len - legacy[0][0].shape[2]
+    if pad <= 0:
+        return legacy
+    padded = []
+    for k, v in legacy:
+        k_pad = k.new_zeros(k.shape[0], k.shape[1], pad, k.shape[3])
+        v_pad = v.new_zeros(v.shape[0], v.shape[1], pad, v.shape[3])
+        padded.append((torch.cat([k_pad, k], dim=2), torch.cat([v_pad, v], dim=2)))
+    return tuple(padded)
+
+
+class ContinuousBatcher:
+    """
+    Continuous-batching decode loop for a HuggingFace causal LM.
+    New requests are prefilled and join the running batch between decode steps;
+    finished ones retire immediately, so nobody waits for the longest reply in the batch.
+    The batch KV cache is left-padded and only re-shaped when membership changes.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size=MAX_BATCH_SIZE, max_new_tokens=80,
+                 temperature=0.3, top_p=0.9, repetition_penalty=1.3, stop_strings=(), prefix_cache=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.stop_strings = list(stop_strings)
+        self.prefix_cache = prefix_cache
+
+        self.eos_ids = {tokenizer.eos_token_id}
+        im_end = tokenizer.convert_tokens_to_ids("<|im_end|>")
+        if isinstance(im_end, int) and im_end != tokenizer.unk_token_id:
+            self.eos_ids.add(im_end)
+        self.eos_ids.discard(None)
+
+        self._pending = queue.Queue()
+        self._active = []
+        self._past = None # legacy cache tuple, batch dim follows self._active
+        self._mask = None # [B, T] attention mask (0 = left padding)
+        self._thread = threading.Thread(target=self._loop, name="llm-continuous-batcher", daemon=True)
+        self._thread.start()
+
+    # --- Public API ---
+
+    def submit(self, prompt: str, max_new_tokens: int = None, prefix: str = None) -> _Sequence:
+        prompt_ids = self.tokenizer(prompt, return_tensors="pt").input_ids[0].tolist()
+        seq = _Sequence(prompt_ids, max_new_tokens or self.max_new_tokens, prefix_text=prefix)
+        self._pending.put(seq)
+        return seq
+
+    def generate(self, prompt: str, max_new_tokens: int = None, prefix: str = None) -> str:
+        return self.submit(prompt, max_new_tokens, prefix=prefix).future.result()
+
+    def stream(self, prompt: str, max_new_tokens: int = None, prefix: str = None):
+        seq = self.submit(prompt, max_new_tokens, prefix=prefix)
+        while True:
+            piece = seq.pieces.get()
+            if piece is None:
+                break
+            yield piece
+        seq.future.result() # Re-raise batch errors
+
+    # --- Decode loop ---
+
+    def _loop(self):
+        while True:
+            if not self._active:
+                self._admit(self._pending.get()) # Idle: block for work
+            while len(self._active) < self.max_batch_size:
+                try:
+                    self._admit(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            if not self._active:
+                continue
+            try:
+                with torch.no_grad():
+                    self._decode_step()
+            except Exception as e:
+                print(f"Continuous Batch Error: {e}")
+                for seq in self._active:
+                    self._fail(seq, e)
+                self._active, self._past, self._mask = [], None, None
+                continue
+            self._retire_finished()
+
+    def _admit(self, seq):
+        try:
+            with torch.no_grad():
+                entry, cached = self._cached_prefix(seq)
+                input_ids = torch.tensor([seq.prompt_ids[cached:]], device=self.model.device)
+                if cached:
+                    # Only the per-request tail is prefilled on top of the shared prefix KV
+                    out = self.model(input_ids=input_ids, past_key_values=to_model_cache(entry[1]), use_cache=True)
+                else:
+                    out = self.model(input_ids=input_ids, use_cache=True)
+            past = to_legacy_cache(out.past_key_values)
+            self._append_token(seq, self._sample(out.logits[:, -1, :], [seq])[0])
+        except Exception as e:
+            print(f"Continuous Batch Prefill Error: {e}")
+            self._fail(seq, e)
+            return
+
+        mask = torch.ones(1, len(seq.prompt_ids), dtype=torch.long, device=self.model.device)
+        if seq.finished:
+            self._finish(seq)
+            return
+        if self._past is None:
+            self._active, self._past, self._mask = [seq], past, mask
+            return
+
+        # Left-pad whichever side is shorter, then stack along the batch dim
+        target = max(self._mask.shape[1], mask.shape[1])
+        self._past = _left_pad(self._past, target)
+        past = _left_pad(past, target)
+        self._mask = torch.cat([self._mask.new_zeros(self._mask.shape[0], target - self._mask.shape[1]), self._mask], dim=1)
+        mask = torch.cat([mask.new_zeros(1, target - mask.shape[1]), mask], dim=1)
+        self._past = tuple(
+            (torch.cat([k0, k1], dim=0), torch.cat([v0, v1], dim=0))
+            for (k0, v0), (k1, v1) in zip(self._past, past)
+        )
+        self._mask = torch.cat([self._mask, mask], dim=0)
+        self._active.append(seq)
+
+    def _cached_prefix(self, seq):
+        if self.prefix_cache is None or not seq.prefix_text:
+            return None, 0
+        try:
+            entry = self.prefix_cache.get_or_build(
+                seq.prefix_text,
+                lambda text: build_transformers_prefix(self.model, self.tokenizer, text)
+            )
+        except Exception as e:
+            print(f"Prefix Cache Error: {e}")
+            return None, 0
+        return entry, match_prefix(seq.prompt_ids, entry)
+
+    def _decode_step(self):
+        last_tokens = torch.tensor([[seq.generated[-1]] for seq in self._active], device=self.model.device)
+        position_ids = self._mask.sum(dim=1, keepdim=True) # next position = real tokens so far
+        self._mask = torch.cat([self._mask, self._mask.new_ones(self._mask.shape[0], 1)], dim=1)
+
+        out = self.model(
+            input_ids=last_tokens,
+            attention_mask=self._mask,
+            position_ids=position_ids,
+            past_key_values=to_model_cache(self._past),
+            use_cache=True
+        )
+        self._past = to_legacy_cache(out.past_key_values)
+        for seq, token in zip(self._active, self._sample(out.logits[:, -1, :], self._active)):
+            self._append_token(seq, token)
+
+    def _sample(self, logits, seqs):
+        logits = logits.float()
+        # Repetition penalty (same rule as transformers: shrink scores of tokens already seen)
+        if self.repetition_penalty and self.repetition_penalty != 1.0:
+            for row, seq in enumerate(seqs):
+                seen = torch.tensor(sorted(set(seq.prompt_ids + seq.generated)), device=logits.device)
+                scores = logits[row, seen]
+                logits[row, seen] = torch.where(scores > 0, scores / self.repetition_penalty, scores * self.repetition_penalty)
+
+        if not self.temperature or self.temperature <= 0:
+            return logits.argmax(dim=-1).tolist()
+
+        probs = torch.softmax(logits / self.temperature, dim=-1)
+        if self.top_p and self.top_p < 1.0:
+            sorted_probs, sorted_idx = torch.sort(probs, descending=True, dim=-1)
+            cumulative = torch.cumsum(sorted_probs, dim=-1)
+            sorted_probs[(cumulative - sorted_probs) > self.top_p] = 0.0
+            probs = torch.zeros_like(probs).scatter(-1, sorted_idx, sorted_probs)
+            probs = probs / probs.sum(dim=-1, keepdim=True)
+        return torch.multinomial(probs, num_samples=1).squeeze(-1).tolist()
+
+    def _append_token(self, seq, token):
+        if token in self.eos_ids:
+            seq.finished = True
+            self._emit(seq, final=True)
+            return
+        seq.generated.append(token)
+        seq.text = self.tokenizer.decode(seq.generated, skip_special_tokens=True)
+
+        for stop in self.stop_strings:
+            pos = seq.text.find(stop)
+            if pos != -1:
+                seq.text = seq.text[:pos]
+                seq.finished = True
+                break
+        if len(seq.generated) >= seq.max_new_tokens:
+            seq.finished = True
+        self._emit(seq, final=seq.finished)
+
+    def _emit(self, seq, final=False):
+        end = len(seq.text)
+        if not final:
+            # Hold back an incomplete multi-byte char or a possible partial stop string
+            if seq.text.endswith("\ufffd"):
+                end -= 1
+            for stop in self.stop_strings:
+                for n in range(min(len(stop) - 1, end), 0, -1):
+                    if seq.text[end - n:end] == stop[:n]:
+                        end = min(end, len(seq.text) - n)
+                        break
+        if end > seq.emitted:
+            seq.pieces.put(seq.text[seq.emitted:end])
+            seq.emitted = end
+
+    def _retire_finished(self):
+        keep = [i for i, seq in enumerate(self._active) if not seq.finished]
+        for seq in self._active:
+            if seq.finished:
+                self._finish(seq)
+        if len(keep) == len(self._active):
+            return
+        if not keep:
+            self._active, self._past, self._mask = [], None, None
+            return
+
+        index = torch.tensor(keep, device=self._mask.device)
+        self._active = [self._active[i] for i in keep]
+        self._mask = self._mask.index_select(0, index)
+        self._past = tuple((k.index_select(0, index), v.index_select(0, index)) for k, v in self._past)
+
+        # Drop leading columns that are padding for every remaining row
+        leading = int((self._mask.sum(dim=0) == 0).long().cumprod(dim=0).sum().item())
+        if leading:
+            self._mask = self._mask[:, leading:]
+            self._past = tuple((k[:, :, leading:, :], v[:, :, leading:, :]) for k, v in self._past)
+
+    def _finish(self, seq):
+        self._emit(seq, final=True)
+        seq.pieces.put(None)
+        if not seq.future.done():
+            seq.future.set_result(seq.text)
+
+    def _fail(self, seq, error):
+        seq.pieces.put(None)
+        if not seq.future.done():
+            seq.future.set_exception(error)
@@ -1,12 +1,68 @@
-from sqlalchemy import create_engine
+import os
+
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./ainote_users_v2.db"
+# Configuration
+# DATABASE_URL may point at Postgres (postgresql://...), which runs on asyncpg in the async path.
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./ainote_users_v2.db")
+if SQLALCHEMY_DATABASE_URL.startswith("postgres://"):
+    # Heroku-style scheme, which SQLAlchemy rejects; normalised once for both engines
+    SQLALCHEMY_DATABASE_URL = "postgresql://" + SQLALCHEMY_DATABASE_URL[len("postgres://"):]
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800")) # seconds
+
+IS_SQLITE = SQLALCHEMY_DATABASE_URL.startswith("sqlite")
+
+# WAL lets readers (chat history, auth) run while a chat turn is being written
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL", # durable with WAL, without an fsync per commit
+    "busy_timeout": "5000", # ms to wait on a locked database instead of failing
+    "cache_size": "-20000", # ~20 MB page cache per connection
+    "temp_store": "MEMORY",
+}
+
+
+def _async_url(url):
+    if url.startswith("sqlite:"):
+        return "sqlite+aiosqlite:" + url[len("sqlite:"):]
+    if url.startswith("postgresql:"):
+        return "postgresql+asyncpg:" + url[len("postgresql:"):]
+    return url
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+def _engine_kwargs():
+    kwargs = {"pool_size": POOL_SIZE, "max_overflow": MAX_OVERFLOW, "pool_recycle": POOL_RECYCLE}
+    if IS_SQLITE:
+        kwargs["connect_args"] = {"check_same_thread": False}
+    else:
+        kwargs["pool_pre_ping"] = True
+    return kwargs
+
+
+# Sync engine: startup migrations, scripts and background threads
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **_engine_kwargs())
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine: every request handler, so DB waits never block the event loop
+async_engine = create_async_engine(_async_url(SQLALCHEMY_DATABASE_URL), **_engine_kwargs())
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+if IS_SQLITE:
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragmas)
+
 Base = declarative_base()
 
 def get_db():
@@ -15,3 +71,24 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def ensure_column(table_name, column_name, column_ddl):
+    """
+    Add a column to an existing table (create_all only creates missing tables).
+    """
+    columns = {c["name"] for c in inspect(engine).get_columns(table_name)}
+    if column_name not in columns:
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_ddl}"))
+        print(f"DB Migration: added {table_name}.{column_name}")
+
+def ensure_indexes(model):
+    """
+    Create a model's indexes on an existing table (create_all skips tables that already exist).
+    """
+    for index in model.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
@@ -0,0 +1,176 @@
+import asyncio
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from langchain_core.embeddings import Embeddings
+
+# Configuration
+# Requests arriving within BATCH_WINDOW_MS of each other are coalesced into one encode() call,
+# up to MAX_BATCH_SIZE texts. A single large request (e.g. a training upload) is encoded on its own.
+MAX_BATCH_SIZE = int(os.getenv("EMBED_MAX_BATCH", "64"))
+BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))
+
+# Query embedding cache: in-memory LRU, optionally backed by SQLite so it survives restarts
+QUERY_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "4096"))
+QUERY_CACHE_PATH = os.getenv("EMBED_CACHE_PATH") # e.g. "embedding_cache.db" (unset = memory only)
+
+
+class EmbeddingCache:
+    """
+    Bounded, content-hashed cache of query vectors.
+    """
+
+    def __init__(self, namespace: str = "", max_entries: int = QUERY_CACHE_SIZE, db_path: str = QUERY_CACHE_PATH):
+        self.namespace = namespace # model name, so a model change never serves stale vectors
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute("CREATE TABLE IF NOT EXISTS query_embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+                self._db.commit()
+            except Exception as e:
+                print(f"Embedding Cache: disk store unavailable ({e}), using memory only")
+                self._db = None
+
+    def key_for(self, text: str) -> str:
+        normalized = " ".join(text.split())
+        return hashlib.sha256(f"{self.namespace}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, text: str):
+        key = self.key_for(text)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                return vector
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT vector FROM query_embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            vector = array("f", row[0]).tolist()
+            self._remember(key, vector)
+            return vector
+
+    def put(self, text: str, vector: list[float]):
+        key = self.key_for(text)
+        with self._lock:
+            self._remember(key, vector)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO query_embeddings (key, vector) VALUES (?, ?)",
+                        (key, array("f", vector).tobytes())
+                    )
+                    self._db.commit()
+                except Exception as e:
+                    print(f"Embedding Cache Write Error: {e}")
+
+    def _remember(self, key, vector):
+        # Caller holds _lock
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class BatchedEmbeddings(Embeddings):
+    """
+    Micro-batching front for a LangChain embedding model.
+    Sync callers block on a future; async callers get an awaitable.
+    """
+
+    def __init__(self, base: Embeddings, max_batch_size: int = MAX_BATCH_SIZE, window_ms: float = BATCH_WINDOW_MS,
+                 query_cache: EmbeddingCache = None):
+        self.base = base
+        self.query_cache = query_cache
+        self.max_batch_size = max(1, max_batch_size)
+        self.window = max(0.0, window_ms) / 1000.0
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    # --- Public API (LangChain Embeddings interface) ---
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        return self.submit(texts).result()
+
+    def embed_query(self, text: str) -> list[float]:
+        if self.query_cache is not None:
+            cached = self.query_cache.get(text)
+            if cached is not None:
+                return cached
+        vector = self.embed_documents([text])[0]
+        if self.query_cache is not None:
+            self.query_cache.put(text, vector)
+        return vector
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        return await asyncio.wrap_future(self.submit(texts))
+
+    async def aembed_query(self, text: str) -> list[float]:
+        if self.query_cache is not None:
+            cached = self.query_cache.get(text)
+            if cached is not None:
+                return cached
+        vectors = await self.aembed_documents([text])
+        if self.query_cache is not None:
+            self.query_cache.put(text, vectors[0])
+        return vectors[0]
+
+    def submit(self, texts: list[str]) -> Future:
+        future = Future()
+        self._queue.put((list(texts), future))
+        return future
+
+    # --- Worker ---
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            batch = [first]
+            count = len(first[0])
+            deadline = time.monotonic() + self.window
+
+            # Collect more requests until the window closes or the batch is full
+            while count < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                count += len(item[0])
+
+            self._encode(batch)
+
+    def _encode(self, batch):
+        flat_texts = [text for texts, _ in batch for text in texts]
+        try:
+            vectors = self.base.embed_documents(flat_texts)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        # Hand each caller back its own slice
+        offset = 0
+        for texts, future in batch:
+            future.set_result(vectors[offset:offset + len(texts)])
+            offset += len(texts)
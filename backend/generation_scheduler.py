@@ -0,0 +1,178 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+# Configuration
+MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "32")) # waiting requests before we answer 429
+METRICS_WINDOW = 500 # recent requests kept for wait/run-time stats
+
+
+class SchedulerSaturated(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Generation queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class _Job:
+    __slots__ = ("fn", "kwargs", "future", "enqueued_at")
+
+    def __init__(self, fn, kwargs):
+        self.fn = fn
+        self.kwargs = kwargs
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+class GenerationScheduler:
+    """
+    Bounded, per-user fair queue in front of the LLM.
+    One worker thread per engine replica; each job runs as fn(engine, **kwargs).
+    Users are served round-robin, so one user's burst cannot starve everyone else.
+    """
+
+    def __init__(self, engines, max_queue: int = MAX_QUEUE):
+        self.engines = list(engines)
+        self.max_queue = max(1, max_queue)
+        self._cond = threading.Condition()
+        self._queues = OrderedDict() # user_id -> deque[_Job], in round-robin order
+        self._depth = 0
+        self._active = 0
+        self._completed = 0
+        self._rejected = 0
+        self._wait_times = deque(maxlen=METRICS_WINDOW)
+        self._run_times = deque(maxlen=METRICS_WINDOW)
+
+        for index, engine in enumerate(self.engines):
+            worker = threading.Thread(target=self._worker, args=(engine,), name=f"llm-worker-{index}", daemon=True)
+            worker.start()
+
+    # --- Submission ---
+
+    def submit(self, user_id, fn, **kwargs) -> Future:
+        """
+        Queue fn(engine, **kwargs). Raises SchedulerSaturated when the queue is full.
+        """
+        with self._cond:
+            if self._depth >= self.max_queue:
+                self._rejected += 1
+                raise SchedulerSaturated(self._retry_after())
+            job = _Job(fn, kwargs)
+            self._queues.setdefault(user_id, deque()).append(job)
+            self._depth += 1
+            self._cond.notify()
+        return job.future
+
+    async def run(self, user_id, fn, **kwargs):
+        return await asyncio.wrap_future(self.submit(user_id, fn, **kwargs))
+
+    def stream(self, user_id, gen_fn, **kwargs):
+        """
+        Queue a generator gen_fn(engine, **kwargs) and return an async iterator over its items.
+        Raises SchedulerSaturated immediately (before anything is streamed) when full.
+        """
+        loop = asyncio.get_running_loop()
+        items = asyncio.Queue()
+        stopped = threading.Event() # set when the client goes away
+        done = object()
+
+        def run(engine, **job_kwargs):
+            generator = gen_fn(engine, **job_kwargs)
+            try:
+                for item in generator:
+                    if stopped.is_set():
+                        break
+                    loop.call_soon_threadsafe(items.put_nowait, item)
+            finally:
+                generator.close()
+                loop.call_soon_threadsafe(items.put_nowait, done)
+
+        future = self.submit(user_id, run, **kwargs)
+
+        async def iterate():
+            try:
+                while True:
+                    item = await items.get()
+                    if item is done:
+                        break
+                    yield item
+                await asyncio.wrap_future(future) # Re-raise worker errors
+            finally:
+                stopped.set()
+
+        return iterate()
+
+    # --- Workers ---
+
+    def _next_job(self):
+        # Caller holds _cond. Take the head of the first user's queue, then rotate that user to the back.
+        user_id, user_queue = next(iter(self._queues.items()))
+        job = user_queue.popleft()
+        del self._queues[user_id]
+        if user_queue:
+            self._queues[user_id] = user_queue
+        self._depth -= 1
+        return job
+
+    def _worker(self, engine):
+        while True:
+            with self._cond:
+                while self._depth == 0:
+                    self._cond.wait()
+                job = self._next_job()
+                self._active += 1
+
+            if not job.future.set_running_or_notify_cancel():
+                with self._cond:
+                    self._active -= 1
+                continue
+
+            started = time.monotonic()
+            try:
+                job.future.set_result(job.fn(engine, **job.kwargs))
+            except Exception as e:
+                job.future.set_exception(e)
+            finally:
+                finished = time.monotonic()
+                with self._cond:
+                    self._active -= 1
+                    self._completed += 1
+                    self._wait_times.append(started - job.enqueued_at)
+                    self._run_times.append(finished - started)
+
+    # --- Metrics ---
+
+    def _retry_after(self):
+        # Caller holds _cond. Time for the current backlog to drain, from recent run times.
+        avg_run = (sum(self._run_times) / len(self._run_times)) if self._run_times else 5.0
+        estimate = avg_run * (self._depth + 1) / max(1, len(self.engines))
+        return max(1, min(120, math.ceil(estimate)))
+
+    def metrics(self):
+        with self._cond:
+            waits = list(self._wait_times)
+            runs = list(self._run_times)
+            return {
+                "workers": len(self.engines),
+                "queue_depth": self._depth,
+                "queue_limit": self.max_queue,
+                "active": self._active,
+                "users_waiting": len(self._queues),
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "wait_avg_s": round(sum(waits) / len(waits), 3) if waits else 0.0,
+                "wait_p95_s": round(_percentile(waits, 0.95), 3),
+                "run_avg_s": round(sum(runs) / len(runs), 3) if runs else 0.0,
+                "run_p95_s": round(_percentile(runs, 0.95), 3),
+                "retry_after_s": self._retry_after(),
+            }
@@ -0,0 +1,146 @@
+import datetime
+import json
+import os
+
+from sqlalchemy import delete, or_, select
+
+import database
+import models
+
+# Configuration
+LEGACY_HISTORY_FILE = "training_history.json"
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+GLOBAL_SCOPE = "Global"
+PRIVATE_SCOPE = "Private"
+
+
+def normalize_scope(scope):
+    return GLOBAL_SCOPE if (scope or "").lower() == "global" else PRIVATE_SCOPE
+
+
+def to_dict(row):
+    # Same shape the JSON file used, plus the row id (the pagination cursor)
+    entry = {
+        "id": row.id,
+        "filename": row.filename,
+        "timestamp": row.timestamp.isoformat() if row.timestamp else None,
+        "status": row.status,
+        "user_id": row.user_id,
+        "scope": row.scope,
+    }
+    if row.original_title:
+        entry["original_title"] = row.original_title
+    return entry
+
+
+def _parse_timestamp(value):
+    if not value:
+        return datetime.datetime.now()
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return datetime.datetime.now()
+
+
+def _row(entry):
+    return models.TrainingHistory(
+        user_id=entry.get("user_id"),
+        scope=normalize_scope(entry.get("scope")),
+        filename=entry["filename"],
+        original_title=entry.get("original_title"),
+        status=entry.get("status"),
+        timestamp=_parse_timestamp(entry.get("timestamp")),
+    )
+
+
+async def add_entry(db, entry):
+    row = _row(entry)
+    db.add(row)
+    await db.commit()
+    return row
+
+
+async def list_visible(db, user, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Newest first. Returns (entries, next_cursor); next_cursor is None on the last page.
+    Admins see everything, users see their own entries plus Global ones.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    query = select(models.TrainingHistory)
+    if user.role != "admin":
+        query = query.where(or_(
+            models.TrainingHistory.user_id == user.id,
+            models.TrainingHistory.scope == GLOBAL_SCOPE
+        ))
+    if cursor is not None:
+        query = query.where(models.TrainingHistory.id < cursor)
+
+    result = await db.execute(query.order_by(models.TrainingHistory.id.desc()).limit(limit + 1))
+    rows = result.scalars().all()
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    return [to_dict(row) for row in rows[:limit]], next_cursor
+
+
+async def find_by_filename(db, filename):
+    result = await db.execute(select(models.TrainingHistory).where(models.TrainingHistory.filename == filename))
+    return result.scalars().all()
+
+
+async def delete_entries(db, filename, owner_id):
+    result = await db.execute(delete(models.TrainingHistory).where(
+        models.TrainingHistory.filename == filename,
+        models.TrainingHistory.user_id == owner_id if owner_id is not None else models.TrainingHistory.user_id.is_(None)
+    ))
+    await db.commit()
+    return result.rowcount
+
+
+def entries_for_files(filenames):
+    """
+    Sync (rebuild thread): history rows for these filenames, newest first.
+    """
+    filenames = list(filenames)
+    if not filenames:
+        return []
+    db = database.SessionLocal()
+    try:
+        return db.execute(
+            select(models.TrainingHistory).where(models.TrainingHistory.filename.in_(filenames))
+            .order_by(models.TrainingHistory.id.desc())
+        ).scalars().all()
+    finally:
+        db.close()
+
+
+# ==========================================
+# ONE-SHOT IMPORT (training_history.json -> table)
+# ==========================================
+
+def import_legacy_json(path=LEGACY_HISTORY_FILE):
+    """
+    Copy every entry of the old JSON history into the table, then rename the file
+    to <name>.imported so the import never runs twice. Returns the number imported.
+    """
+    if not os.path.exists(path):
+        return 0
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+
+    rows = [_row(entry) for entry in entries if entry.get("filename")]
+    db = database.SessionLocal()
+    try:
+        db.add_all(rows)
+        db.commit()
+    finally:
+        db.close()
+
+    os.replace(path, f"{path}.imported")
+    print(f"Training history: imported {len(rows)} entries from {path}")
+    return len(rows)
+
+
+if __name__ == "__main__":
+    models.Base.metadata.create_all(bind=database.engine)
+    import_legacy_json()
@@ -0,0 +1,301 @@
+from langchain_community.vectorstores import FAISS
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import datetime
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import history_store
+import index_store
+import rag_engine
+import text_chunker
+
+# Configuration
+# Files are read + chunked + embedded in batches on a worker pool; the main rebuild thread
+# appends finished batches to a staged index and checkpoints periodically.
+REBUILD_WORKERS = int(os.getenv("RAG_REBUILD_WORKERS", "4"))
+REBUILD_BATCH_FILES = int(os.getenv("RAG_REBUILD_BATCH", "64"))
+CHECKPOINT_INTERVAL = float(os.getenv("RAG_REBUILD_CHECKPOINT_SECS", "30"))
+
+STAGING_DIR = os.path.join(rag_engine.MEMORY_DIR, ".rebuild")
+CHECKPOINT_FILE = os.path.join(STAGING_DIR, "checkpoint.json")
+STAGED_FILES = "files_done.json" # inside each staged index: the files its vectors came from
+
+_status_lock = threading.Lock()
+_status = {
+    "job_id": None,
+    "state": "idle", # idle | running | completed | failed
+    "started_at": None,
+    "finished_at": None,
+    "scopes_total": 0,
+    "scopes_done": 0,
+    "files_total": 0,
+    "files_done": 0,
+    "current_scope": None,
+    "resumed": False,
+    "error": None,
+}
+_job_thread = None
+
+
+def get_status():
+    with _status_lock:
+        return dict(_status)
+
+
+def _update_status(**changes):
+    with _status_lock:
+        _status.update(changes)
+
+
+def _advance_files(count):
+    with _status_lock:
+        _status["files_done"] += count
+
+
+# ==========================================
+# DISCOVERY
+# ==========================================
+
+def _list_files(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if os.path.isfile(os.path.join(directory, name))
+    )
+
+
+def _root_file_owners(data_store_path, root_files):
+    """
+    Files at the data_store root come from the old /train, which wrote Global *and* private
+    uploads there and only logged the Global ones. Training history decides the owner:
+    {path: user_id, or None for Global}. Files nobody owns are left out.
+    """
+    by_name = {os.path.basename(path): path for path in root_files}
+    owners = {}
+    for row in history_store.entries_for_files(by_name):
+        path = by_name.get(row.filename)
+        if path is None or path in owners:
+            continue # Newest entry wins
+        is_global = row.user_id is None or history_store.normalize_scope(row.scope) == history_store.GLOBAL_SCOPE
+        # Entries written since uploads moved to scope folders describe those files, not this one
+        scope_dir = os.path.join(data_store_path, "global" if is_global else os.path.join("users", str(row.user_id)))
+        if os.path.exists(os.path.join(scope_dir, row.filename)):
+            continue
+        owners[path] = None if is_global else row.user_id
+
+    for path in root_files:
+        if path not in owners:
+            print(f"Rebuild: skipping {os.path.basename(path)} at the data_store root (no owner in training history)")
+    return owners
+
+
+def discover_scopes(data_store_path):
+    """
+    Returns [(user_id, [file paths])]. user_id None is the Global scope.
+    """
+    scope_files = {None: _list_files(os.path.join(data_store_path, "global"))}
+
+    users_dir = os.path.join(data_store_path, "users")
+    if os.path.isdir(users_dir):
+        for entry in sorted(os.listdir(users_dir)):
+            if entry.isdigit():
+                scope_files[int(entry)] = _list_files(os.path.join(users_dir, entry))
+
+    # Legacy uploads at the data_store root go to whoever trained them
+    for path, owner in _root_file_owners(data_store_path, _list_files(data_store_path)).items():
+        scope_files.setdefault(owner, []).append(path)
+
+    return [(None, scope_files.pop(None))] + sorted(scope_files.items())
+
+
+# ==========================================
+# CHECKPOINT
+# ==========================================
+
+def _new_checkpoint(job_id):
+    return {"job_id": job_id, "model": rag_engine.EMBEDDING_MODEL, "scopes_done": []}
+
+
+def _load_checkpoint():
+    if not os.path.exists(CHECKPOINT_FILE):
+        return None
+    try:
+        with open(CHECKPOINT_FILE, "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+    except Exception as e:
+        print(f"Rebuild: unreadable checkpoint ({e}), starting over")
+        return None
+    if checkpoint.get("model") != rag_engine.EMBEDDING_MODEL:
+        print("Rebuild: checkpoint was made with another embedding model, starting over")
+        return None
+    return checkpoint
+
+
+def _save_checkpoint(checkpoint):
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    tmp_file = CHECKPOINT_FILE + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, ensure_ascii=False)
+    os.replace(tmp_file, CHECKPOINT_FILE)
+
+
+# ==========================================
+# PIPELINE
+# ==========================================
+
+def _embed_batch(file_paths, embedder):
+    # Runs on the worker pool: read + chunk + embed one batch of files
+    texts, metadatas = [], []
+    for path in file_paths:
+        memory_date = datetime.datetime.fromtimestamp(os.path.getmtime(path)).strftime("%Y-%m-%d")
+        try:
+            with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                for index, (chunk, offset) in enumerate(text_chunker.iter_chunks(f)):
+                    texts.append(chunk)
+                    metadatas.append({
+                        "source": os.path.basename(path),
+                        "memory_date": memory_date,
+                        "offset": offset,
+                        "chunk": index
+                    })
+        except Exception as e:
+            print(f"Rebuild: skipping unreadable file {path}: {e}")
+
+    vectors = embedder.embed_documents(texts) if texts else []
+    return file_paths, texts, vectors, metadatas
+
+
+def _rebuild_scope(user_id, files, checkpoint, embedder):
+    scope = rag_engine.get_scope_key(user_id)
+    stage_path = os.path.join(STAGING_DIR, scope)
+    _update_status(current_scope=scope)
+
+    # Resume from the staged index if this scope was interrupted mid-way. The list of files
+    # it covers is saved inside it, so the two can never disagree after a crash.
+    done = set()
+    store = None
+    if os.path.exists(os.path.join(stage_path, STAGED_FILES)):
+        try:
+            store = index_store.read_store(stage_path, rag_engine.embeddings, writable=True)
+            with open(os.path.join(stage_path, STAGED_FILES), "r", encoding="utf-8") as f:
+                done = set(json.load(f))
+        except Exception as e:
+            print(f"Rebuild: staged index for {scope} unreadable ({e}), restarting scope")
+            store = None
+            done = set()
+
+    _advance_files(len([f for f in files if f in done]))
+    pending = [f for f in files if f not in done]
+    batches = [pending[i:i + REBUILD_BATCH_FILES] for i in range(0, len(pending), REBUILD_BATCH_FILES)]
+
+    def checkpoint_scope():
+        if store is not None:
+            files_done = json.dumps(sorted(done), ensure_ascii=False)
+            rag_engine.save_index_atomic(store, stage_path, extra_files={STAGED_FILES: files_done})
+
+    last_checkpoint = time.monotonic()
+    with ThreadPoolExecutor(max_workers=REBUILD_WORKERS) as pool:
+        futures = [pool.submit(_embed_batch, batch, embedder) for batch in batches]
+        for future in as_completed(futures):
+            batch_files, texts, vectors, metadatas = future.result()
+            if texts:
+                ids = [str(uuid.uuid4()) for _ in texts]
+                pairs = list(zip(texts, vectors))
+                if store is None:
+                    store = FAISS.from_embeddings(pairs, rag_engine.embeddings, metadatas=metadatas, ids=ids)
+                else:
+                    store.add_embeddings(pairs, metadatas=metadatas, ids=ids)
+            done.update(batch_files)
+            _advance_files(len(batch_files))
+
+            if time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                checkpoint_scope()
+                last_checkpoint = time.monotonic()
+
+    # Publish atomically (plus any writes that reached the live index meanwhile), then mark the scope finished
+    rag_engine.install_index(store, user_id, rebuilt_sources={os.path.basename(path) for path in files})
+    checkpoint["scopes_done"].append(scope)
+    _save_checkpoint(checkpoint)
+    shutil.rmtree(stage_path, ignore_errors=True)
+
+
+def run_rebuild(data_store_path, resume=True, job_id=None):
+    """
+    Re-embed every scope under data_store and swap each index in atomically.
+    """
+    if rag_engine.embeddings is None:
+        raise RuntimeError("Embedding model is not loaded")
+
+    checkpoint = _load_checkpoint() if resume else None
+    resumed = checkpoint is not None
+    if checkpoint is None:
+        shutil.rmtree(STAGING_DIR, ignore_errors=True)
+        checkpoint = _new_checkpoint(job_id or str(uuid.uuid4()))
+        _save_checkpoint(checkpoint)
+
+    # Record live writes from here on: files trained after discovery are not in the rebuild
+    rag_engine.start_capture()
+    try:
+        scopes = discover_scopes(data_store_path)
+    except Exception:
+        rag_engine.stop_capture()
+        raise
+    pending = [(uid, files) for uid, files in scopes if rag_engine.get_scope_key(uid) not in checkpoint["scopes_done"]]
+    _update_status(
+        job_id=checkpoint["job_id"],
+        state="running",
+        started_at=datetime.datetime.now().isoformat(),
+        finished_at=None,
+        scopes_total=len(scopes),
+        scopes_done=len(scopes) - len(pending),
+        files_total=sum(len(files) for _, files in pending),
+        files_done=0,
+        resumed=resumed,
+        error=None,
+    )
+    print(f"Rebuild {checkpoint['job_id']}: {len(pending)} scope(s) to index{' (resumed)' if resumed else ''}")
+
+    # Large batches bypass the request micro-batcher and go straight to the model
+    embedder = getattr(rag_engine.embeddings, "base", rag_engine.embeddings)
+    try:
+        for user_id, files in pending:
+            _rebuild_scope(user_id, files, checkpoint, embedder)
+            with _status_lock:
+                _status["scopes_done"] += 1
+    except Exception as e:
+        print(f"Rebuild Error: {e}")
+        _update_status(state="failed", error=str(e), finished_at=datetime.datetime.now().isoformat())
+        raise
+    finally:
+        rag_engine.stop_capture()
+
+    shutil.rmtree(STAGING_DIR, ignore_errors=True)
+    _update_status(state="completed", current_scope=None, finished_at=datetime.datetime.now().isoformat())
+    print(f"Rebuild {checkpoint['job_id']}: complete ✅")
+    return get_status()
+
+
+def start_rebuild(data_store_path, resume=True):
+    """
+    Run the rebuild on a background thread. Raises RuntimeError if one is already running.
+    """
+    global _job_thread
+    with _status_lock:
+        if _job_thread is not None and _job_thread.is_alive():
+            raise RuntimeError("A rebuild is already running")
+        _status["state"] = "running"
+
+        def job():
+            try:
+                run_rebuild(data_store_path, resume=resume)
+            except Exception as e:
+                _update_status(state="failed", error=str(e), finished_at=datetime.datetime.now().isoformat())
+
+        _job_thread = threading.Thread(target=job, name="rag-rebuild", daemon=True)
+        _job_thread.start()
+    return get_status()
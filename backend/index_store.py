@@ -0,0 +1,323 @@
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+import faiss
+import numpy as np
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+# Configuration
+# On-disk format of a memory index: index.faiss (faiss.write_index) + docstore.sqlite.
+# Scopes with at least RAG_INDEX_MIN_VECTORS vectors are converted from exact flat L2 to
+# RAG_INDEX_TYPE / RAG_INDEX_QUANTIZER when written to; smaller ones stay flat.
+INDEX_TYPE = os.getenv("RAG_INDEX_TYPE", "flat").lower() # flat | hnsw | ivf
+INDEX_QUANTIZER = os.getenv("RAG_INDEX_QUANTIZER", "none").lower() # none | sq8 | pq
+INDEX_FACTORY = os.getenv("RAG_INDEX_FACTORY", "") # raw faiss.index_factory string ("{nlist}" allowed); overrides the two above
+MIN_VECTORS = int(os.getenv("RAG_INDEX_MIN_VECTORS", "10000"))
+PQ_M = int(os.getenv("RAG_PQ_M", "48")) # sub-quantizers; must divide the embedding size (384 for MiniLM)
+HNSW_M = int(os.getenv("RAG_HNSW_M", "32"))
+HNSW_EF_SEARCH = int(os.getenv("RAG_HNSW_EF_SEARCH", "64"))
+IVF_NPROBE = int(os.getenv("RAG_IVF_NPROBE", "16"))
+MMAP = os.getenv("RAG_INDEX_MMAP", "1") == "1" # page cold indices in lazily instead of reading them whole
+
+INDEX_FILE = "index.faiss"
+DOCSTORE_FILE = "docstore.sqlite"
+
+CODECS = {"none": "Flat", "sq8": "SQ8", "pq": f"PQ{PQ_M}"}
+
+
+# ==========================================
+# INDEX TYPES
+# ==========================================
+
+def _nlist(count):
+    # IVF cells: ~4*sqrt(n), with at least ~39 training points per cell
+    return max(1, min(int(4 * np.sqrt(count)), count // 39))
+
+def factory_string(count):
+    if INDEX_FACTORY:
+        return INDEX_FACTORY.replace("{nlist}", str(_nlist(count)))
+    codec = CODECS.get(INDEX_QUANTIZER)
+    if codec is None:
+        raise ValueError(f"Unknown RAG_INDEX_QUANTIZER '{INDEX_QUANTIZER}'")
+    if INDEX_TYPE == "hnsw":
+        return f"HNSW{HNSW_M}" if codec == "Flat" else f"HNSW{HNSW_M}_{codec}"
+    if INDEX_TYPE == "ivf":
+        return f"IVF{_nlist(count)},{codec}"
+    if INDEX_TYPE == "flat":
+        return codec
+    raise ValueError(f"Unknown RAG_INDEX_TYPE '{INDEX_TYPE}'")
+
+def _is_exact_flat(index):
+    return type(faiss.downcast_index(index)) in (faiss.IndexFlat, faiss.IndexFlatL2)
+
+def configure(index):
+    # Search-time knobs are not stored in the index file
+    try:
+        faiss.extract_index_ivf(index).nprobe = IVF_NPROBE
+    except RuntimeError:
+        pass # Not an IVF index
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None:
+        hnsw.efSearch = HNSW_EF_SEARCH
+    return index
+
+def _build(dimension, vectors):
+    if len(vectors) < MIN_VECTORS:
+        index = faiss.IndexFlatL2(dimension)
+    else:
+        index = faiss.index_factory(dimension, factory_string(len(vectors)))
+        if not index.is_trained:
+            index.train(vectors)
+    if len(vectors):
+        index.add(vectors)
+    return configure(index)
+
+def compact(vector_store):
+    """
+    Convert a large exact flat index to the configured type, in place.
+    Call on a writer's private copy only. Positions (and so index_to_docstore_id) are unchanged.
+    """
+    index = vector_store.index
+    if factory_string(index.ntotal) == "Flat" or index.ntotal < MIN_VECTORS or not _is_exact_flat(index):
+        return vector_store
+    vectors = index.reconstruct_n(0, index.ntotal)
+    vector_store.index = _build(index.d, vectors)
+    print(f"RAG: converted {index.ntotal} vectors to {factory_string(index.ntotal)}")
+    return vector_store
+
+def delete_documents(vector_store, ids):
+    """
+    FAISS.delete, also for index types without remove_ids (HNSW): those are rebuilt from
+    the remaining vectors (lossy codes are re-encoded as they are).
+    """
+    try:
+        vector_store.delete(ids)
+        return
+    except RuntimeError:
+        pass # remove_ids not implemented for this index type; nothing was changed
+
+    doomed = set(ids)
+    mapping = vector_store.index_to_docstore_id
+    keep = [position for position in sorted(mapping) if mapping[position] not in doomed]
+    index = vector_store.index
+    vectors = np.vstack([index.reconstruct(position) for position in keep]) if keep else np.empty((0, index.d), dtype=np.float32)
+    vector_store.index = _build(index.d, vectors)
+    vector_store.docstore.delete(ids)
+    vector_store.index_to_docstore_id = {new: mapping[old] for new, old in enumerate(keep)}
+
+
+# ==========================================
+# DOCSTORE
+# ==========================================
+
+_open_readers = set() # every _Reader not closed yet
+_readers_lock = threading.Lock()
+
+class _Reader:
+    """
+    Read-only connection to one docstore.sqlite, shared by a SqliteDocstore and its copies.
+    Closed when the last of them is closed.
+    """
+
+    def __init__(self, path):
+        self.path = str(Path(path).resolve())
+        self.conn = sqlite3.connect(Path(self.path).as_uri() + "?mode=ro&immutable=1", uri=True, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.users = 1
+        with _readers_lock:
+            _open_readers.add(self)
+
+    def acquire(self):
+        with self.lock:
+            if self.conn is None:
+                raise RuntimeError(f"Docstore {self.path} is closed")
+            self.users += 1
+        return self
+
+    def release(self):
+        with self.lock:
+            self.users -= 1
+            if self.users > 0 or self.conn is None:
+                return
+            self.conn.close()
+            self.conn = None
+        with _readers_lock:
+            _open_readers.discard(self)
+
+def in_use(path):
+    # True while a docstore under this directory is still open
+    prefix = os.path.join(str(Path(path).resolve()), "")
+    with _readers_lock:
+        return any(reader.path.startswith(prefix) for reader in _open_readers)
+
+class SqliteDocstore(Docstore, AddableMixin):
+    """
+    Documents of a saved index, read on demand from its docstore.sqlite (immutable: every
+    generation writes a new file), plus whatever was added or deleted in memory since.
+    """
+
+    def __init__(self, path=None, reader=None, added=None, deleted=None):
+        self._reader = reader if reader is not None else _Reader(path)
+        self._added = added if added is not None else {}
+        self._deleted = deleted if deleted is not None else set()
+        self._closed = False
+
+    def _query(self, sql, params=()):
+        reader = self._reader
+        with reader.lock:
+            if self._closed or reader.conn is None:
+                raise RuntimeError(f"Docstore {reader.path} is closed")
+            return reader.conn.execute(sql, params).fetchall()
+
+    def search(self, search):
+        if search in self._added:
+            return self._added[search]
+        if search not in self._deleted:
+            rows = self._query("SELECT content, metadata FROM docs WHERE doc_id = ?", (search,))
+            if rows:
+                return Document(page_content=rows[0][0], metadata=json.loads(rows[0][1]))
+        return f"ID {search} not found."
+
+    def add(self, texts):
+        self._added.update(texts)
+        self._deleted.difference_update(texts)
+
+    def delete(self, ids):
+        for doc_id in ids:
+            if self._added.pop(doc_id, None) is None:
+                self._deleted.add(doc_id)
+
+    def copy(self):
+        # Shares the read-only file (close each copy); changes to the copy stay in the copy
+        return SqliteDocstore(reader=self._reader.acquire(), added=dict(self._added), deleted=set(self._deleted))
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._reader.release()
+
+    def positions(self):
+        return {position: doc_id for position, doc_id in self._query("SELECT position, doc_id FROM docs")}
+
+    def sources(self):
+        found = {doc_id: source for doc_id, source in self._query("SELECT doc_id, source FROM docs")
+                 if doc_id not in self._deleted}
+        found.update((doc_id, doc.metadata.get("source")) for doc_id, doc in self._added.items())
+        return found
+
+    def resident_bytes(self):
+        return sum(len(doc.page_content) for doc in self._added.values())
+
+def copy_docstore(docstore):
+    if isinstance(docstore, SqliteDocstore):
+        return docstore.copy()
+    return InMemoryDocstore(dict(docstore._dict))
+
+def document_sources(vector_store):
+    # doc_id -> metadata 'source', without loading every document's text
+    docstore = vector_store.docstore
+    if isinstance(docstore, SqliteDocstore):
+        return docstore.sources()
+    return {doc_id: doc.metadata.get("source") for doc_id, doc in docstore._dict.items()}
+
+def release(vector_store):
+    """
+    Close the files a loaded store holds: its docstore connection and its (possibly
+    memory-mapped) index. The store must not be used afterwards.
+    """
+    docstore = vector_store.docstore
+    if isinstance(docstore, SqliteDocstore):
+        docstore.close()
+    vector_store.index = None # Frees the faiss index, unmapping index.faiss
+
+def resident_bytes(vector_store):
+    # Rough RAM held by a loaded store: vector codes + in-memory text
+    index = vector_store.index
+    try:
+        code_size = index.sa_code_size()
+    except RuntimeError:
+        code_size = index.d * 4
+    docstore = vector_store.docstore
+    if isinstance(docstore, SqliteDocstore):
+        text_bytes = docstore.resident_bytes()
+    else:
+        text_bytes = sum(len(doc.page_content) for doc in docstore._dict.values())
+    return index.ntotal * code_size + text_bytes
+
+
+# ==========================================
+# READ / WRITE
+# ==========================================
+
+def is_legacy(path):
+    # FAISS.save_local layout (pickled docstore)
+    return not os.path.exists(os.path.join(path, DOCSTORE_FILE))
+
+def write_store(vector_store, path):
+    """
+    Save into a new directory (callers write to a temp dir and rename it in).
+    """
+    os.makedirs(path, exist_ok=True)
+    faiss.write_index(vector_store.index, os.path.join(path, INDEX_FILE))
+
+    def rows():
+        mapping = vector_store.index_to_docstore_id
+        for position in sorted(mapping):
+            doc_id = mapping[position]
+            doc = vector_store.docstore.search(doc_id)
+            if not isinstance(doc, Document):
+                raise RuntimeError(f"Docstore is missing {doc_id}")
+            metadata = json.dumps(doc.metadata, ensure_ascii=False, default=str)
+            yield position, doc_id, doc.metadata.get("source"), doc.page_content, metadata
+
+    conn = sqlite3.connect(os.path.join(path, DOCSTORE_FILE))
+    try:
+        conn.execute("""
+            CREATE TABLE docs (
+                position INTEGER PRIMARY KEY,
+                doc_id TEXT NOT NULL UNIQUE,
+                source TEXT,
+                content TEXT NOT NULL,
+                metadata TEXT NOT NULL
+            )
+        """)
+        conn.executemany("INSERT INTO docs VALUES (?, ?, ?, ?, ?)", rows())
+        conn.commit()
+    finally:
+        conn.close()
+
+def _read_index(path, mmap):
+    if mmap:
+        try:
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_READ_ONLY", 0))
+        except RuntimeError:
+            pass # This index type (or faiss build) cannot be mapped
+    return faiss.read_index(path)
+
+def read_store(path, embeddings, writable=False):
+    """
+    Load a saved index. Default: memory-mapped vectors and documents read on demand, for
+    published snapshots (writers work on a copy). writable=True loads everything into RAM.
+    """
+    if is_legacy(path):
+        # Trusted files written by this app before the SQLite format; re-saved in it on the next write
+        return FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)
+
+    index = configure(_read_index(os.path.join(path, INDEX_FILE), MMAP and not writable))
+    docstore = SqliteDocstore(os.path.join(path, DOCSTORE_FILE))
+    try:
+        index_to_docstore_id = docstore.positions()
+        if writable:
+            loaded = InMemoryDocstore({doc_id: docstore.search(doc_id) for doc_id in index_to_docstore_id.values()})
+            docstore.close()
+            docstore = loaded
+    except Exception:
+        docstore.close()
+        raise
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
@@ -1,13 +1,36 @@
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer
 import torch
 import os
+import threading
 import google.generativeai as genai
 import re # Added for cleaning <think> tags
 from dotenv import load_dotenv
+from reply_filters import StreamCleaner
+from prefix_cache import PrefixCache, build_transformers_prefix, match_prefix, to_model_cache
 
 # Load env immediately
 load_dotenv()
 
+# Stop sequences per backend (shared by blocking + streaming generation)
+OPENAI_STOP = ["<|im_end|>", "User:", "Mali:", "System:", "\nUser:", "\nMali:", "- ตอบ:", "Answer:", "<|endoftext|>"]
+LLAMA_STOP = ["<|im_end|>", "User:", "Mali:", "System:"]
+TRANSFORMERS_STOP = ["<|im_end|>", "\n\n", "User:", "Question:", "Mali:", "System:"]
+# Opt-in: hold remote streams back this long waiting for a bare </think> (reasoning models whose
+# template opens the block in the prompt). Untagged replies are delayed by up to this many characters.
+THINK_HOLD_CHARS = int(os.getenv("LLM_THINK_HOLD_CHARS", "0"))
+
+# Everything in the system prompt before this marker is static per persona (see PrefixCache)
+CONTEXT_MARKER = "ข้อมูลความจำ (Context):\n"
+
+_live_engines = [] # every LLMEngine created, so a persona change can drop all their prefix caches
+
+
+class ReplyError(str):
+    """
+    Backend failure message returned (or streamed) in place of a reply.
+    It is still shown to the user, but callers must not cache it.
+    """
+
 class LLMEngine:
     _instance = None
     
@@ -23,6 +46,9 @@ class LLMEngine:
         self.tokenizer = None
         self.model = None
         self.genai_model = None
+        self.batcher = None # Continuous batching for the transformers path
+        self.prefix_cache = PrefixCache() # Persona KV state for the local backends
+        _live_engines.append(self)
         
         print(f"LLM Engine Strategy: {self.provider.upper()}")
         self._initialize()
@@ -99,6 +125,19 @@ class LLMEngine:
                 trust_remote_code=True
             ).to("cpu") 
             print("Local LLM Loaded Successfully!")
+            if os.getenv("LLM_CONTINUOUS_BATCHING", "1") == "1":
+                from batch_engine import ContinuousBatcher
+                self.batcher = ContinuousBatcher(
+                    self.model,
+                    self.tokenizer,
+                    max_new_tokens=80,
+                    temperature=0.3,
+                    top_p=0.9,
+                    repetition_penalty=1.3,
+                    stop_strings=TRANSFORMERS_STOP,
+                    prefix_cache=self.prefix_cache
+                )
+                print(f"Continuous batching enabled (max batch {self.batcher.max_batch_size})")
         except Exception as e:
             print(f"Error loading Local LLM: {e}")
             with open("llm_debug.log", "a") as f:
@@ -114,57 +153,46 @@ class LLMEngine:
 
     def _generate_gemini(self, user_message, context_text, persona_text):
         if not self.genai_model:
-            return "ระบบ Google Gemini ยังไม่พร้อมใช้งานค่ะ (API Key Error?)"
+            return ReplyError("ระบบ Google Gemini ยังไม่พร้อมใช้งานค่ะ (API Key Error?)")
 
-        system_msg = self._build_system_prompt(context_text, persona_text)
-        full_prompt = f"{system_msg}\n\nUser: {user_message}\nModel:"
+        full_prompt = self._gemini_prompt(user_message, context_text, persona_text)
         
         try:
             response = self.genai_model.generate_content(
                 full_prompt,
-                generation_config=genai.types.GenerationConfig(
-                    temperature=0.7,
-                    max_output_tokens=150,
-                    stop_sequences=[
-                        "User:", "Model:", "Mali:", "System:",
-                        "\nUser:", "\nModel:", "\nMali:", "\nSystem:",
-                        "\nQ:", "\nA:"
-                    ]
-                )
+                generation_config=self._gemini_config()
             )
             return response.text.strip()
         except Exception as e:
             print(f"Gemini Generation Error: {e}")
-            return f"ขอโทษค่ะ ระบบ Cloud มีปัญหา ({e})"
-
-    def _generate_openai_compatible(self, user_message, context_text, persona_text):
-        if not self.lm_client:
-            return "Remote AI Connection Failed. (Check Ngrok URL or LM Studio)"
+            return ReplyError(f"ขอโทษค่ะ ระบบ Cloud มีปัญหา ({e})")
 
+    def _gemini_prompt(self, user_message, context_text, persona_text):
         system_msg = self._build_system_prompt(context_text, persona_text)
-        
-        try:
-            # Create messages for Chat Completion
-            # Create messages for Chat Completion
-            # STRATEGY: Merge System Prompt into User Message (Universal Compatibility for GGUF)
-            # Some GGUF chat templates ignore 'system' role or hallucinate it.
-            
-            final_user_content = f"{system_msg}\n\n"
-            if context_text:
-                final_user_content += f"[Context/Memory]: {context_text}\n\n"
-            
-            final_user_content += f"[User Question]: {user_message}"
+        return f"{system_msg}\n\nUser: {user_message}\nModel:"
 
-            messages = [
-                {"role": "user", "content": final_user_content}
+    def _gemini_config(self):
+        return genai.types.GenerationConfig(
+            temperature=0.7,
+            max_output_tokens=150,
+            stop_sequences=[
+                "User:", "Model:", "Mali:", "System:",
+                "\nUser:", "\nModel:", "\nMali:", "\nSystem:",
+                "\nQ:", "\nA:"
             ]
+        )
 
+    def _generate_openai_compatible(self, user_message, context_text, persona_text):
+        if not self.lm_client:
+            return ReplyError("Remote AI Connection Failed. (Check Ngrok URL or LM Studio)")
+
+        try:
             completion = self.lm_client.chat.completions.create(
                 model="tgi", # Llama-cpp-server usually ignores this, or use "model"
-                messages=messages,
+                messages=self._openai_messages(user_message, context_text, persona_text),
                 temperature=0.7,
                 max_tokens=600,
-                stop=["<|im_end|>", "User:", "Mali:", "System:", "\nUser:", "\nMali:", "- ตอบ:", "Answer:", "<|endoftext|>"]
+                stop=OPENAI_STOP
             )
             
             raw_reply = completion.choices[0].message.content.strip()
@@ -191,32 +219,21 @@ class LLMEngine:
             
         except Exception as e:
             print(f"Remote AI Error: {e}")
-            return f"เกิดข้อผิดพลาดกับ Remote Server: {e}"
+            return ReplyError(f"เกิดข้อผิดพลาดกับ Remote Server: {e}")
 
     def _generate_local(self, user_message, context_text, persona_text):
         if not self.model:
-            return "ขอโทษค่ะ หนูยังโหลดสมองไม่เสร็จเลย (Model loading failed or pending)."
-        
-        system_msg = self._build_system_prompt(context_text, persona_text)
+            return ReplyError("ขอโทษค่ะ หนูยังโหลดสมองไม่เสร็จเลย (Model loading failed or pending).")
         
         # --- PATH 1: LlamaCPP (Native GGUF) ---
         if hasattr(self.model, "create_chat_completion"): # Check if it's Llama object
             try:
-                # ChatML Format is handled automatically by create_chat_completion usually, 
-                # but explicit messages structure is safer.
-                messages = [
-                    {"role": "system", "content": system_msg},
-                ]
-                if context_text:
-                     messages.append({"role": "user", "content": f"จากข้อมูลบริบท: {context_text}\n\nคำถาม: {user_message}"})
-                else:
-                     messages.append({"role": "user", "content": user_message})
-
+                self._restore_llama_prefix(persona_text)
                 resp = self.model.create_chat_completion(
-                    messages=messages,
+                    messages=self._llama_messages(user_message, context_text, persona_text),
                     max_tokens=600, # Increased from 150 to prevent cutting off
                     temperature=0.7,
-                    stop=["<|im_end|>", "User:", "Mali:", "System:"] 
+                    stop=LLAMA_STOP
                 )
                 raw_reply = resp['choices'][0]['message']['content']
                 
@@ -225,9 +242,191 @@ class LLMEngine:
                 return clean_reply.strip()
             except Exception as e:
                 print(f"GGUF Generation Error: {e}")
-                return f"สมองรวน (GGUF Error): {e}"
+                return ReplyError(f"สมองรวน (GGUF Error): {e}")
 
         # --- PATH 2: Transformers (Standard) ---
+        prompt = self._transformers_prompt(user_message, context_text, persona_text)
+
+        if self.batcher is not None:
+            # Shares decode steps with every other in-flight request
+            response = self.batcher.generate(prompt, prefix=self._transformers_prefix_text(persona_text))
+        else:
+            model_inputs = self.tokenizer([prompt], return_tensors="pt").to(self.model.device)
+            prefix_kwargs = self._transformers_prefix_kwargs(model_inputs, persona_text)
+
+            with torch.no_grad(): 
+                generated_ids = self.model.generate(**self._transformers_generate_kwargs(model_inputs, **prefix_kwargs))
+
+            generated_ids = [
+                output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
+            ]
+            
+            response = self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
+        
+        if "\n" in response:
+            response = response.split("\n")[0]
+            
+        return response.strip()
+
+    # ==========================================
+    # STREAMING
+    # ==========================================
+
+    def stream_reply(self, user_message, context_text="", persona_text=""):
+        """
+        Same as generate_reply, but yields the reply in pieces as the backend produces them.
+        <think> blocks and leaked labels are removed on the fly.
+        A backend failure arrives as a ReplyError piece, passed through uncleaned.
+        """
+        think_hold = 0
+        if self.provider == "gemini":
+            raw_stream, cut_markers = self._stream_gemini(user_message, context_text, persona_text), []
+        elif self.provider in ["lmstudio", "colab"]:
+            raw_stream, cut_markers = self._stream_openai_compatible(user_message, context_text, persona_text), ["Okay, the user"]
+            # _generate_openai_compatible keeps only what follows a </think>, opened or not
+            think_hold = THINK_HOLD_CHARS
+        elif self.model is not None and not hasattr(self.model, "create_chat_completion"):
+            # Transformers path keeps only the first line (same as _generate_local)
+            raw_stream, cut_markers = self._stream_local(user_message, context_text, persona_text), ["\n"]
+        else:
+            raw_stream, cut_markers = self._stream_local(user_message, context_text, persona_text), []
+
+        cleaner = StreamCleaner(cut_markers=cut_markers, think_hold_chars=think_hold)
+        for piece in raw_stream:
+            if isinstance(piece, ReplyError):
+                tail = cleaner.flush()
+                if tail:
+                    yield tail
+                yield piece
+                return
+            out = cleaner.feed(piece)
+            if out:
+                yield out
+        tail = cleaner.flush()
+        if tail:
+            yield tail
+
+    def _stream_gemini(self, user_message, context_text, persona_text):
+        if not self.genai_model:
+            yield ReplyError("ระบบ Google Gemini ยังไม่พร้อมใช้งานค่ะ (API Key Error?)")
+            return
+        try:
+            response = self.genai_model.generate_content(
+                self._gemini_prompt(user_message, context_text, persona_text),
+                generation_config=self._gemini_config(),
+                stream=True
+            )
+            for chunk in response:
+                if chunk.text:
+                    yield chunk.text
+        except Exception as e:
+            print(f"Gemini Stream Error: {e}")
+            yield ReplyError(f"ขอโทษค่ะ ระบบ Cloud มีปัญหา ({e})")
+
+    def _stream_openai_compatible(self, user_message, context_text, persona_text):
+        if not self.lm_client:
+            yield ReplyError("Remote AI Connection Failed. (Check Ngrok URL or LM Studio)")
+            return
+        try:
+            stream = self.lm_client.chat.completions.create(
+                model="tgi",
+                messages=self._openai_messages(user_message, context_text, persona_text),
+                temperature=0.7,
+                max_tokens=600,
+                stop=OPENAI_STOP,
+                stream=True
+            )
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except Exception as e:
+            print(f"Remote AI Stream Error: {e}")
+            yield ReplyError(f"เกิดข้อผิดพลาดกับ Remote Server: {e}")
+
+    def _stream_local(self, user_message, context_text, persona_text):
+        if not self.model:
+            yield ReplyError("ขอโทษค่ะ หนูยังโหลดสมองไม่เสร็จเลย (Model loading failed or pending).")
+            return
+
+        # --- PATH 1: LlamaCPP (Native GGUF) ---
+        if hasattr(self.model, "create_chat_completion"):
+            try:
+                self._restore_llama_prefix(persona_text)
+                stream = self.model.create_chat_completion(
+                    messages=self._llama_messages(user_message, context_text, persona_text),
+                    max_tokens=600,
+                    temperature=0.7,
+                    stop=LLAMA_STOP,
+                    stream=True
+                )
+                for chunk in stream:
+                    content = chunk["choices"][0].get("delta", {}).get("content")
+                    if content:
+                        yield content
+            except Exception as e:
+                print(f"GGUF Stream Error: {e}")
+                yield ReplyError(f"สมองรวน (GGUF Error): {e}")
+            return
+
+        # --- PATH 2: Transformers (Standard) ---
+        prompt = self._transformers_prompt(user_message, context_text, persona_text)
+        if self.batcher is not None:
+            yield from self.batcher.stream(prompt, prefix=self._transformers_prefix_text(persona_text))
+            return
+
+        model_inputs = self.tokenizer([prompt], return_tensors="pt").to(self.model.device)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        prefix_kwargs = self._transformers_prefix_kwargs(model_inputs, persona_text)
+        gen_kwargs = self._transformers_generate_kwargs(model_inputs, streamer=streamer, **prefix_kwargs)
+
+        def run_generate():
+            try:
+                with torch.no_grad():
+                    self.model.generate(**gen_kwargs)
+            except Exception as e:
+                print(f"Transformers Stream Error: {e}")
+                streamer.end()
+
+        thread = threading.Thread(target=run_generate, daemon=True)
+        thread.start()
+        for text in streamer:
+            if text:
+                yield text
+        thread.join()
+
+    # ==========================================
+    # PROMPT BUILDERS (shared by generate + stream)
+    # ==========================================
+
+    def _openai_messages(self, user_message, context_text, persona_text):
+        system_msg = self._build_system_prompt(context_text, persona_text)
+
+        # STRATEGY: Merge System Prompt into User Message (Universal Compatibility for GGUF)
+        # Some GGUF chat templates ignore 'system' role or hallucinate it.
+        final_user_content = f"{system_msg}\n\n"
+        if context_text:
+            final_user_content += f"[Context/Memory]: {context_text}\n\n"
+        
+        final_user_content += f"[User Question]: {user_message}"
+
+        return [
+            {"role": "user", "content": final_user_content}
+        ]
+
+    def _llama_messages(self, user_message, context_text, persona_text):
+        # ChatML Format is handled automatically by create_chat_completion usually, 
+        # but explicit messages structure is safer.
+        messages = [
+            {"role": "system", "content": self._build_system_prompt(context_text, persona_text)},
+        ]
+        if context_text:
+             messages.append({"role": "user", "content": f"จากข้อมูลบริบท: {context_text}\n\nคำถาม: {user_message}"})
+        else:
+             messages.append({"role": "user", "content": user_message})
+        return messages
+
+    def _transformers_prompt(self, user_message, context_text, persona_text):
+        system_msg = self._build_system_prompt(context_text, persona_text)
         prompt = f"<|im_start|>system\n{system_msg}<|im_end|>\n"
         if context_text:
              prompt += f"<|im_start|>user\nจากข้อมูลบริบท: {context_text}\n\nคำถาม: {user_message}<|im_end|>\n"
@@ -235,38 +434,72 @@ class LLMEngine:
              prompt += f"<|im_start|>user\n{user_message}<|im_end|>\n"
              
         prompt += "<|im_start|>assistant\n"
-        
-        device = self.model.device
-        model_inputs = self.tokenizer([prompt], return_tensors="pt").to(device)
+        return prompt
 
+    def _transformers_generate_kwargs(self, model_inputs, **extra):
         if torch.cuda.is_available() == False:
             torch.set_num_threads(4) 
 
-        with torch.no_grad(): 
-            generated_ids = self.model.generate( 
-                model_inputs.input_ids,
-                attention_mask=model_inputs.attention_mask,
-                max_new_tokens=80, 
-                temperature=0.3,
-                top_p=0.9, 
-                repetition_penalty=1.3,
-                pad_token_id=self.tokenizer.eos_token_id,
-                stop_strings=["<|im_end|>", "\n\n", "User:", "Question:", "Mali:", "System:"],
-                tokenizer=self.tokenizer
+        kwargs = dict(
+            input_ids=model_inputs.input_ids,
+            attention_mask=model_inputs.attention_mask,
+            max_new_tokens=80, 
+            temperature=0.3,
+            top_p=0.9, 
+            repetition_penalty=1.3,
+            pad_token_id=self.tokenizer.eos_token_id,
+            stop_strings=TRANSFORMERS_STOP,
+            tokenizer=self.tokenizer
+        )
+        kwargs.update(extra)
+        return kwargs
+
+    # ==========================================
+    # PREFIX CACHE (persona KV reuse for local models)
+    # ==========================================
+
+    def _transformers_prefix_text(self, persona_text):
+        # Must match the start of _transformers_prompt exactly
+        return f"<|im_start|>system\n{self._build_system_prefix(persona_text)}"
+
+    def _transformers_prefix_kwargs(self, model_inputs, persona_text):
+        # Hand generate() the prefilled persona KV when the prompt starts with it
+        try:
+            entry = self.prefix_cache.get_or_build(
+                self._transformers_prefix_text(persona_text),
+                lambda text: build_transformers_prefix(self.model, self.tokenizer, text)
             )
+        except Exception as e:
+            print(f"Prefix Cache Error: {e}")
+            return {}
+        if not match_prefix(model_inputs.input_ids[0].tolist(), entry):
+            return {}
+        return {"past_key_values": to_model_cache(entry[1])}
 
-        generated_ids = [
-            output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-        ]
-        
-        response = self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-        
-        if "\n" in response:
-            response = response.split("\n")[0]
-            
-        return response.strip()
+    def _restore_llama_prefix(self, persona_text):
+        """
+        llama.cpp already skips the longest token prefix shared with the previous prompt.
+        Keep a saved state per persona so that prefix survives another persona's
+        request in between (or a fresh model), and only the tail gets evaluated.
+        """
+        def build(text):
+            tokens = self.model.tokenize(text.encode("utf-8"), special=True)[:-1]
+            self.model.reset()
+            self.model.eval(tokens)
+            return tokens, self.model.save_state()
+
+        try:
+            # Same ChatML start as the chat template renders for the system message
+            tokens, state = self.prefix_cache.get_or_build(self._transformers_prefix_text(persona_text), build)
+            if self.model._input_ids[:len(tokens)].tolist() != tokens:
+                self.model.load_state(state)
+        except Exception as e:
+            print(f"Prefix Cache Error: {e}")
 
     def _build_system_prompt(self, context_text, persona_text):
+        return f"{self._build_system_prefix(persona_text)}{context_text}\n"
+
+    def _build_system_prefix(self, persona_text):
         # Use provided persona, or fallback to default if empty
         if not persona_text or len(persona_text.strip()) < 10:
              # Default Fallback
@@ -287,9 +520,7 @@ A: สวัสดีค่าพี่นนท์! วันนี้มีอ
 Q: พรุ่งนี้มีอะไรไหม
 A: จากที่จดไว้... พรุ่งนี้ว่างค่ะพี่นนท์!
 
-ข้อมูลความจำ (Context):
-{context_text}
-"""
+{CONTEXT_MARKER}"""
 
 llm_engine_instance = None
 
@@ -298,3 +529,26 @@ def get_engine():
     if llm_engine_instance is None:
         llm_engine_instance = LLMEngine()
     return llm_engine_instance
+
+def invalidate_prefix_cache():
+    """
+    Drop the cached persona KV of every engine (called when the persona changes).
+    """
+    for engine in _live_engines:
+        engine.prefix_cache.clear()
+
+def get_replicas():
+    """
+    Engine instances for the generation scheduler (one worker thread each).
+    Remote providers are I/O-bound and share one client across LLM_WORKERS workers,
+    and the continuous batcher takes one worker per batch slot.
+    Other local models are not thread-safe, so each extra worker needs its own replica (LLM_REPLICAS).
+    """
+    engine = get_engine()
+    if engine.provider in ["gemini", "lmstudio", "colab"]:
+        return [engine] * max(1, int(os.getenv("LLM_WORKERS", "4")))
+    if engine.batcher is not None:
+        # The batcher is thread-safe: enough workers to keep the batch full
+        return [engine] * engine.batcher.max_batch_size
+    replicas = max(1, int(os.getenv("LLM_REPLICAS", "1")))
+    return [engine] + [LLMEngine() for _ in range(replicas - 1)]
@@ -8,12 +8,15 @@ except:
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional
 import uvicorn
 import os
-import uuid
+import io
+import hashlib
+import threading
 import json
 import datetime
 import requests
@@ -21,51 +24,59 @@ import traceback
 
 # Internal modules
 import rag_engine
+import index_rebuilder
+import text_chunker
+import reply_filters
 import audio_service
+import transcription
 import llm_engine
+import generation_scheduler
+import persona_registry
+import history_store
+import recent_turns
+import transcript_writer
+import response_cache
+import rag_workers
 import models, database, auth
-from sqlalchemy.orm import Session
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import Depends, status
 from fastapi.security import OAuth2PasswordRequestForm
 
 # Initialize Database Models
 models.Base.metadata.create_all(bind=database.engine)
+database.ensure_column("users", "persona_name", "VARCHAR")
+database.ensure_column("chat_messages", "uid", "VARCHAR")
+database.ensure_indexes(models.ChatMessage)
+transcript_writer.writer.start() # Replays any journal left by a crash, then starts the flusher
+history_store.import_legacy_json() # One-shot: training_history.json -> training_history table
+# One-shot, in the background: pickled RAG indices -> index.faiss + docstore.sqlite
+threading.Thread(target=rag_engine.migrate_legacy_indices, name="rag-migrate", daemon=True).start()
 
 # ==========================================
 # 1. CONSTANTS & HELPER FUNCTIONS
 # ==========================================
 
-PERSONA_FILE = "persona.txt"
-HISTORY_FILE = "training_history.json"
 DATA_STORE_DIR = "data_store"
-STATIC_AUDIO_DIR = "static_audio"
+STATIC_AUDIO_DIR = audio_service.AUDIO_DIR
 
 os.makedirs(DATA_STORE_DIR, exist_ok=True)
 os.makedirs(STATIC_AUDIO_DIR, exist_ok=True)
+audio_service.cache.start_sweeper() # Keeps static_audio under TTS_CACHE_MAX_MB
 
-def load_persona():
-    if os.path.exists(PERSONA_FILE):
-        with open(PERSONA_FILE, "r", encoding="utf-8") as f:
-            return f.read().strip()
-    return ""
+def load_persona(name=None):
+    # Served from memory; the file is only re-read after it changes
+    return persona_registry.get_persona(name).text
 
-def save_persona(text):
-    with open(PERSONA_FILE, "w", encoding="utf-8") as f:
-        f.write(text)
-
-def load_history():
-    if os.path.exists(HISTORY_FILE):
-        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return []
+def save_persona(text, name=None):
+    return persona_registry.save_persona(text, name)
 
-def save_history(entry):
-    history = load_history()
-    history.append(entry)
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(history, f, ensure_ascii=False, indent=2)
+async def save_history(entry):
+    # Training history is a table now (one INSERT instead of rewriting the whole JSON file)
+    async with database.AsyncSessionLocal() as db:
+        await history_store.add_entry(db, entry)
 
-def train_text_internal(title: str, text: str, user_id: int = None):
+async def train_text_internal(title: str, text: str, user_id: int = None):
     # Determine Scope
     scope_dir = "global" if user_id is None else f"users/{user_id}"
     full_store_dir = os.path.join(DATA_STORE_DIR, scope_dir)
@@ -80,8 +91,14 @@ def train_text_internal(title: str, text: str, user_id: int = None):
         f.write(text)
 
     # Add to RAG (Shared or Private) - with TIMESTAMP for context awareness
+    # Chunked so long texts are not truncated by the embedding model; runs on the ingest executor
     current_date = datetime.datetime.now().strftime("%Y-%m-%d")
-    rag_engine.add_documents([text], metadatas=[{"source": safe_filename, "memory_date": current_date}], user_id=user_id)
+    await rag_workers.add_chunks(
+        text_chunker.iter_text_chunks(text),
+        base_metadata={"source": safe_filename, "memory_date": current_date},
+        user_id=user_id
+    )
+    response_cache.cache.invalidate(user_id)
     
     # Log to history
     entry = {
@@ -92,7 +109,7 @@ def train_text_internal(title: str, text: str, user_id: int = None):
         "user_id": user_id,
         "scope": "Global" if user_id is None else "Private"
     }
-    save_history(entry)
+    await save_history(entry)
     
     return {"filename": safe_filename, "status": "Training completed", "scope": entry["scope"]}
 
@@ -105,13 +122,33 @@ app = FastAPI(title="AI Personal Assistant API")
 # Initialize LLM on startup
 print("Initializing LLM Engine...")
 llm = None
+scheduler = None
 try:
     llm = llm_engine.get_engine()
-    print("LLM Engine Initialized.")
+    # All generation goes through the scheduler (bounded queue, per-user fairness, one worker per replica)
+    scheduler = generation_scheduler.GenerationScheduler(llm_engine.get_replicas())
+    print(f"LLM Engine Initialized. ({len(scheduler.engines)} generation worker(s))")
 except Exception as e:
     print(f"CRITICAL WARNING: LLM Engine failed to initialize: {e}")
     llm = None
 
+@app.on_event("shutdown")
+def flush_memory_indices():
+    # Batched RAG persistence: write any dirty in-memory indices before exit
+    rag_engine.flush_indices()
+
+@app.on_event("shutdown")
+def flush_transcripts():
+    # Write-behind chat messages still waiting for their batch
+    transcript_writer.writer.close()
+
+@app.on_event("shutdown")
+def stop_worker_pools():
+    auth.shutdown_hash_pool()
+    transcription.shutdown()
+    audio_service.cache.stop_sweeper()
+    rag_workers.shutdown()
+
 # CORS setup
 app.add_middleware(
     CORSMiddleware,
@@ -132,6 +169,10 @@ class ChatRequest(BaseModel):
 
 class PersonaRequest(BaseModel):
     persona_text: str
+    name: Optional[str] = None # None = default persona
+
+class PersonaSelectRequest(BaseModel):
+    name: Optional[str] = None # None = default persona
 
 class ForgetRequest(BaseModel):
     filename: str
@@ -156,18 +197,19 @@ class UserRegister(BaseModel):
 from fastapi.responses import JSONResponse
 
 @app.post("/auth/register")
-async def register(user: UserRegister, db: Session = Depends(database.get_db)):
+async def register(user: UserRegister, db: AsyncSession = Depends(database.get_async_db)):
+    await auth.throttle_login() # Registration hashes a password too
     try:
         # Check if email exists
-        db_user = db.query(models.User).filter(models.User.email == user.email).first()
+        db_user = (await db.execute(select(models.User).where(models.User.email == user.email))).scalars().first()
         if db_user:
             raise HTTPException(status_code=400, detail="Email already registered")
         
         # First user is admin
-        is_first_user = db.query(models.User).count() == 0
+        is_first_user = (await db.scalar(select(func.count()).select_from(models.User))) == 0
         role = "admin" if is_first_user else "user"
         
-        hashed_password = auth.get_password_hash(user.password)
+        hashed_password = await auth.get_password_hash_async(user.password)
         new_user = models.User(
             email=user.email,
             nickname=user.nickname,
@@ -176,7 +218,7 @@ async def register(user: UserRegister, db: Session = Depends(database.get_db)):
             is_active=True
         )
         db.add(new_user)
-        db.commit()
+        await db.commit()
         return {"msg": "User created", "role": role}
     except Exception as e:
         print(f"REGISTER ERROR: {e}")
@@ -185,12 +227,13 @@ async def register(user: UserRegister, db: Session = Depends(database.get_db)):
         return JSONResponse(status_code=500, content={"detail": f"Internal Error: {str(e)}"})
 
 @app.post("/auth/login")
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(database.get_db)):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(database.get_async_db)):
+    await auth.throttle_login()
     try:
         # NOTE: OAuth2PasswordRequestForm always has a 'username' field. We use it for 'email'.
         print(f"LOGIN ATTEMPT: {form_data.username}")
-        user = db.query(models.User).filter(models.User.email == form_data.username).first()
-        if not user or not auth.verify_password(form_data.password, user.hashed_password):
+        user = (await db.execute(select(models.User).where(models.User.email == form_data.username))).scalars().first()
+        if not user or not await auth.verify_password_async(form_data.password, user.hashed_password):
             print("Login failed: Invalid credentials")
             raise HTTPException(status_code=400, detail="Incorrect email or password")
         
@@ -209,12 +252,17 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session =
 
 @app.get("/auth/me")
 async def read_users_me(current_user: models.User = Depends(auth.get_current_user)):
-    return {"email": current_user.email, "nickname": current_user.nickname, "role": current_user.role}
+    return {
+        "email": current_user.email,
+        "nickname": current_user.nickname,
+        "role": current_user.role,
+        "persona": current_user.persona_name or persona_registry.DEFAULT_NAME
+    }
 
 # --- ADMIN ENDPOINTS ---
 @app.get("/admin/users")
-async def get_all_users(db: Session = Depends(database.get_db), admin: models.User = Depends(auth.get_current_admin)):
-    users = db.query(models.User).all()
+async def get_all_users(db: AsyncSession = Depends(database.get_async_db), admin: models.User = Depends(auth.get_current_admin)):
+    users = (await db.execute(select(models.User))).scalars().all()
     return [{"id": u.id, "email": u.email, "nickname": u.nickname, "role": u.role, "is_active": u.is_active} for u in users]
 
 
@@ -223,8 +271,8 @@ class UserUpdateRequest(BaseModel):
     role: Optional[str] = None
 
 @app.put("/admin/users/{user_id}")
-async def update_user_status(user_id: int, request: UserUpdateRequest, db: Session = Depends(database.get_db), admin: models.User = Depends(auth.get_current_admin)):
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+async def update_user_status(user_id: int, request: UserUpdateRequest, db: AsyncSession = Depends(database.get_async_db), admin: models.User = Depends(auth.get_current_admin)):
+    user = await db.get(models.User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -242,26 +290,51 @@ async def update_user_status(user_id: int, request: UserUpdateRequest, db: Sessi
     if request.role is not None:
         user.role = request.role
 
-    db.commit()
+    await db.commit()
+    auth.invalidate_user(user.email) # Role/ban takes effect on the user's next request
     return {"status": "User updated", "role": user.role, "is_active": user.is_active}
 
 @app.delete("/admin/users/{user_id}")
-async def delete_user(user_id: int, db: Session = Depends(database.get_db), admin: models.User = Depends(auth.get_current_admin)):
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+async def delete_user(user_id: int, db: AsyncSession = Depends(database.get_async_db), admin: models.User = Depends(auth.get_current_admin)):
+    user = await db.get(models.User, user_id)
     if not user:
          raise HTTPException(status_code=404, detail="User not found")
     if user.id == admin.id:
          raise HTTPException(status_code=400, detail="Cannot delete yourself")
          
-    db.delete(user)
-    db.commit()
+    await db.delete(user)
+    await db.commit()
+    auth.invalidate_user(user.email)
+    recent_turns.turns.forget(user_id)
     return {"status": "User deleted"}
 
 
-@app.post("/chat")
-async def chat_endpoint(request: ChatRequest, current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
-    print(f"[{datetime.datetime.now()}] Incoming Chat Request from {current_user.email}: {request.message[:20]}...")
-    
+# --- ADMIN: RAG RE-INDEX ---
+@app.post("/admin/rebuild")
+async def start_rebuild(resume: bool = True, admin: models.User = Depends(auth.get_current_admin)):
+    try:
+        rebuild_status = index_rebuilder.start_rebuild(DATA_STORE_DIR, resume=resume)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    response_cache.cache.invalidate()
+    return rebuild_status
+
+@app.get("/admin/rebuild")
+async def get_rebuild_status(admin: models.User = Depends(auth.get_current_admin)):
+    return index_rebuilder.get_status()
+
+
+# ==========================================
+# CHAT PIPELINE (shared by /chat and /chat/stream)
+# ==========================================
+
+FALLBACK_REPLY = "หนูมะลิ (System): ขอโทษค่ะ สมองหนูเบลอนิดหน่อย (Remote AI Error) ลองเช็ค Colab ดูหน่อยนะค้า"
+
+async def handle_chat_commands(request: ChatRequest, current_user: models.User, db: AsyncSession):
+    """
+    Nickname changes and "remember that..." requests are answered without the LLM.
+    Returns the response dict, or None for a normal chat turn.
+    """
     # 0. Check for Training Keywords (Robust Detection)
     msg = request.message.strip()
     clean_msg = msg.lstrip("-•*> ").lower()
@@ -292,7 +365,8 @@ async def chat_endpoint(request: ChatRequest, current_user: models.User = Depend
                      if len(new_name) > 1:
                          print(f"Detected Name Change Intent: '{new_name}'")
                          current_user.nickname = new_name
-                         db.commit() # Save to DB PERMANENTLY
+                         await db.commit() # Save to DB PERMANENTLY
+                         auth.invalidate_user(current_user.email)
                          
                          return {
                              "reply": f"รับทราบค่ะ! (* >ω<) ต่อไปนี้หนูจะเรียกว่า \"{new_name}\" นะคะ! (บันทึกข้อมูลถาวรแล้ว)", 
@@ -321,20 +395,32 @@ async def chat_endpoint(request: ChatRequest, current_user: models.User = Depend
                 if content:
                     title = "Chat: " + content[:30] + "..."
                     # Default "Remember this" via chat to PRIVATE memory
-                    train_text_internal(title, content, user_id=current_user.id)
+                    try:
+                        await train_text_internal(title, content, user_id=current_user.id)
+                    except Exception as e:
+                        print(f"Chat Memory Error: {e}")
+                        return {"reply": "ขอโทษค่ะ มะลิจดไม่สำเร็จ ลองบอกใหม่อีกทีนะคะ", "audio_url": None, "animation_state": "idle", "model_source": "System (Memory)"}
                     
                     # Save interaction
-                    db.add(models.ChatMessage(user_id=current_user.id, role="user", content=request.message))
-                    db.add(models.ChatMessage(user_id=current_user.id, role="system", content=f"[Memory Recorded (Private): {content}]"))
                     reply_text = f"รับทราบค่ะ! (* >ω<) มะลิจำได้แล้วว่า \"{content}\" (เฉพาะคุณเท่านั้น)"
-                    db.add(models.ChatMessage(user_id=current_user.id, role="ai", content=reply_text))
-                    db.commit()
+                    save_messages(current_user.id, [
+                        ("user", request.message),
+                        ("system", f"[Memory Recorded (Private): {content}]"),
+                        ("ai", reply_text),
+                    ])
                     
                     return {"reply": reply_text, "audio_url": None, "animation_state": "idle", "model_source": "System (Memory)"}
-    
+
+    return None
+
+async def build_chat_context(request: ChatRequest, current_user: models.User, db: AsyncSession):
+    """
+    RAG memories + recent history + persona for one chat turn.
+    Returns (full_context, persona_text, reply_key); reply_key addresses the response cache.
+    """
     # 1. Retrieve RAG Context (Global + Private)
-    # Increase k to 10 to catch more relevant memories
-    rag_docs = rag_engine.query_memory(request.message, n_results=10, user_id=current_user.id)
+    # Top 10 from each index, merged by distance, deduped, trimmed to RAG_CONTEXT_TOKENS
+    rag_docs = await rag_workers.retrieve_context(request.message, k=10, user_id=current_user.id)
     # Label RAG content clearly so the model knows it overrides defaults
     rag_context_list = []
     for doc in rag_docs:
@@ -344,23 +430,34 @@ async def chat_endpoint(request: ChatRequest, current_user: models.User = Depend
     
     rag_text = "\n".join(rag_context_list) if rag_context_list else ""
     
-    # 2. Retrieve Conversation History from DB (Per User)
-    # Get last 6 messages
-    history_records = db.query(models.ChatMessage).filter(
-        models.ChatMessage.user_id == current_user.id
-    ).order_by(models.ChatMessage.timestamp.desc()).limit(6).all()
-    
-    # Reverse to chronological order
-    history_records.reverse()
+    # 2. Retrieve Conversation History (Per User)
+    # Last 6 messages: from the in-memory ring buffer, or the DB on the user's first turn
+    history_records = recent_turns.turns.get(current_user.id)
+    if history_records is None:
+        token = recent_turns.turns.read_token(current_user.id)
+        # Messages still in the write-behind queue (snapshot before the query; deduped by uid)
+        pending = transcript_writer.writer.pending_for(current_user.id)
+        result = await db.execute(
+            select(models.ChatMessage.uid, models.ChatMessage.role, models.ChatMessage.content).where(
+                models.ChatMessage.user_id == current_user.id
+            ).order_by(models.ChatMessage.timestamp.desc(), models.ChatMessage.id.desc()).limit(recent_turns.HISTORY_WINDOW)
+        )
+        # Reverse to chronological order
+        rows = list(reversed(result.all()))
+        stored = {row.uid for row in rows if row.uid}
+        history_records = [(row.role, row.content) for row in rows]
+        history_records += [(m.role, m.content) for m in pending if m.uid not in stored]
+        history_records = history_records[-recent_turns.HISTORY_WINDOW:]
+        recent_turns.turns.load(current_user.id, history_records, token)
     
     formatted_history = []
-    for record in history_records:
-        if record.role == "system":
-            formatted_history.append(f"(Context: {record.content})")
-        elif record.role == "user":
-            formatted_history.append(f"User: {record.content}")
+    for role, content in history_records:
+        if role == "system":
+            formatted_history.append(f"(Context: {content})")
+        elif role == "user":
+            formatted_history.append(f"User: {content}")
         else: # ai
-            formatted_history.append(f"Mali: {record.content}")
+            formatted_history.append(f"Mali: {content}")
             
     history_text = "\nประวัติการคุยล่าสุด:\n" + "\n".join(formatted_history) if formatted_history else ""
     
@@ -369,76 +466,134 @@ async def chat_endpoint(request: ChatRequest, current_user: models.User = Depend
     full_context = f"[Current Time: {current_time_str}]\n[ข้อมูลผู้ใช้งาน]: ชื่อเล่นในระบบคือ \"{current_user.nickname}\" (ใช้เป็นค่าเริ่มต้น แต่หากมีคำสั่งเปลี่ยนชื่อ ให้ยึดตามคำสั่งล่าสุด)\n{rag_text}\n{history_text}"
     
     # 3. Determine Reply
-    # FIX: Prioritize file-based persona for Hot-Reload capability
-    file_persona = load_persona()
-    current_persona = file_persona if file_persona else request.persona
+    # FIX: Prioritize file-based persona for Hot-Reload capability (the user's selected one, if any)
+    persona = persona_registry.get_persona(current_user.persona_name)
+    current_persona = persona.text if persona.text else request.persona
     if not current_persona: current_persona = "Mali-chan"
-
-    # 4. Generate Reply
-    ai_text_reply = ""
+    if persona.text:
+        persona_key = f"{persona.name}:{persona.version}"
+    else:
+        persona_key = hashlib.sha1(current_persona.encode("utf-8")).hexdigest()
+
+    reply_key = (
+        request.message,
+        response_cache.scope_key(persona_key, rag_docs, current_user.nickname),
+        response_cache.owner_of(rag_docs, current_user.id)
+    )
+    return full_context, current_persona, reply_key
+
+def require_scheduler():
+    if scheduler is None:
+        raise HTTPException(status_code=503, detail="LLM Engine is not available")
+    return scheduler
+
+def saturated_error(e: generation_scheduler.SchedulerSaturated):
+    return HTTPException(
+        status_code=429,
+        detail="มะลิกำลังคุยกับหลายคนอยู่ค่ะ รอแป๊บนึงนะคะ (Server busy)",
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+def get_model_source():
     current_provider = getattr(llm, 'provider', 'local')
     if current_provider == 'gemini':
-        model_source = "Cloud Brain (Gemini)"
+        return "Cloud Brain (Gemini)"
     elif current_provider == 'colab':
-        model_source = "Cloud Brain (Colab GPU)"
+        return "Cloud Brain (Colab GPU)"
     elif current_provider == 'lmstudio':
-        model_source = "Local Brain (LM Studio)"
+        return "Local Brain (LM Studio)"
+    return "Local Brain (Qwen/CPU)"
+
+async def synthesize_reply_audio(text: str):
+    # Content-addressed: a reply spoken before is served from disk without synthesis
+    try:
+         audio_filename = await audio_service.cache.synthesize(text)
+         return f"/static/audio/{audio_filename}"
+    except Exception as e:
+         print(f"TTS Error: {e}")
+         return None
+
+def save_messages(user_id: int, messages):
+    # Journaled write-behind (batched INSERTs on a background thread), then mirrored
+    # into the recent-turns buffer so the next turn needs no query
+    transcript_writer.writer.submit(user_id, messages)
+    for role, content in messages:
+        recent_turns.turns.append(user_id, role, content)
+
+def save_chat_turn(user_id: int, user_message: str, reply: str):
+    save_messages(user_id, [("user", user_message), ("ai", reply)])
+
+async def cached_reply(reply_key):
+    if not response_cache.cache.enabled:
+        return None
+    message, scope, _ = reply_key
+    # Near-duplicate matching embeds the message; keep it off the event loop
+    return await run_in_threadpool(response_cache.cache.lookup, message, scope)
+
+async def cache_reply(reply_key, reply: str, failed: bool = False):
+    # Never cache the fallback or a backend error (llm_engine.ReplyError): the next attempt may well succeed
+    if response_cache.cache.enabled and reply and reply != FALLBACK_REPLY and not failed:
+        message, scope, owner = reply_key
+        await run_in_threadpool(response_cache.cache.store, message, scope, reply, owner)
+
+@app.get("/admin/metrics/generation")
+async def get_generation_metrics(admin: models.User = Depends(auth.get_current_admin)):
+    metrics = require_scheduler().metrics()
+    if llm is not None:
+        metrics["prefix_cache"] = llm.prefix_cache.stats()
+    metrics["transcript_writer"] = transcript_writer.writer.stats()
+    metrics["response_cache"] = response_cache.cache.stats()
+    metrics["tts_cache"] = audio_service.cache.stats()
+    metrics["ingest_jobs"] = rag_workers.jobs.stats()
+    return metrics
+
+
+@app.post("/chat")
+async def chat_endpoint(request: ChatRequest, current_user: models.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_async_db)):
+    print(f"[{datetime.datetime.now()}] Incoming Chat Request from {current_user.email}: {request.message[:20]}...")
+
+    command_reply = await handle_chat_commands(request, current_user, db)
+    if command_reply is not None:
+        return command_reply
+
+    full_context, current_persona, reply_key = await build_chat_context(request, current_user, db)
+    model_source = get_model_source()
+
+    # 4. Generate Reply (unless the same question was just answered in the same context)
+    ai_text_reply = await cached_reply(reply_key)
+    if ai_text_reply is not None:
+        model_source += " (Cached)"
     else:
-        model_source = "Local Brain (Qwen/CPU)"
-    
-    # REMOVED LEGACY PROXY BLOCK causing 404
-    # All remote logic is now handled by llm_engine via .env configuration
-    pass
-    
-    if not ai_text_reply:
-         local_reply = await run_in_threadpool(
-            llm.generate_reply,
-            user_message=request.message,
-            context_text=full_context,
-            persona_text=current_persona
-        )
-         ai_text_reply = local_reply
-    
-    if not ai_text_reply:
-         # Fix: Don't print current_persona (it's the whole file!)
-         ai_text_reply = "หนูมะลิ (System): ขอโทษค่ะ สมองหนูเบลอนิดหน่อย (Remote AI Error) ลองเช็ค Colab ดูหน่อยนะค้า"
-    
-    # --- POST-PROCESSING FORCE REPLACEMENT ---
-    # Safe Replacement Strategy:
-    # 1. Replace "ฉัน" at the start of the message
-    # 2. Replace " ฉัน " (surrounded by spaces)
-    # 3. Replace "ดิฉัน" (always safe to replace for this character)
-    # This avoids breaking words inside sentences like "อ่านว่าฉัน" (Read as Chan)
-    
-    if ai_text_reply:
-        # Clear "Chan" at start
-        if ai_text_reply.startswith("ฉัน"):
-            ai_text_reply = "หนู" + ai_text_reply[3:]
-        
-        # Clear "Chan" with spaces
-        ai_text_reply = ai_text_reply.replace(" ฉัน ", " หนู ")
-        
-        # Always kill "Di-Chan" (formal I)
-        ai_text_reply = ai_text_reply.replace("ดิฉัน", "หนู")
-        
-        # Common particles
-        ai_text_reply = ai_text_reply.replace("คะ", "ค่า").replace("ค่ะ", "ค่า") # Make it cuter
+        # All remote logic is handled by llm_engine via .env configuration
+        try:
+            ai_text_reply = await require_scheduler().run(
+                current_user.id,
+                llm_engine.LLMEngine.generate_reply,
+                user_message=request.message,
+                context_text=full_context,
+                persona_text=current_persona
+            )
+        except generation_scheduler.SchedulerSaturated as e:
+            raise saturated_error(e)
+
+        if not ai_text_reply:
+             # Fix: Don't print current_persona (it's the whole file!)
+             ai_text_reply = FALLBACK_REPLY
+        failed = isinstance(ai_text_reply, llm_engine.ReplyError)
+
+        # --- POST-PROCESSING FORCE REPLACEMENT ---
+        # "ฉัน"/"ดิฉัน" -> "หนู" and cuter particles (see reply_filters.PRONOUN_REPLACEMENTS).
+        # The same filter runs incrementally on /chat/stream.
+        ai_text_reply = reply_filters.fix_pronouns(ai_text_reply)
+        await cache_reply(reply_key, ai_text_reply, failed=failed)
 
     # 5. Generate Audio
     audio_url = None
     if not request.mute_audio: 
-        try:
-             audio_filename = f"reply_{uuid.uuid4()}.mp3"
-             audio_path = os.path.join(STATIC_AUDIO_DIR, audio_filename)
-             await audio_service.generate_audio(ai_text_reply, audio_path)
-             audio_url = f"/static/audio/{audio_filename}"
-        except Exception as e:
-             print(f"TTS Error: {e}")
+        audio_url = await synthesize_reply_audio(ai_text_reply)
     
     # Save Transaction to DB
-    db.add(models.ChatMessage(user_id=current_user.id, role="user", content=request.message))
-    db.add(models.ChatMessage(user_id=current_user.id, role="ai", content=ai_text_reply))
-    db.commit()
+    save_chat_turn(current_user.id, request.message, ai_text_reply)
 
     return {
         "reply": ai_text_reply,
@@ -447,48 +602,189 @@ async def chat_endpoint(request: ChatRequest, current_user: models.User = Depend
         "model_source": model_source
     }
 
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest, current_user: models.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_async_db)):
+    """
+    Server-Sent Events version of /chat:
+    'meta' -> many 'token' {"text"} -> 'done' (same payload as /chat).
+    Unless muted, 'audio' {"index", "url"} events arrive as each sentence is synthesized,
+    so playback can start after the first sentence.
+    """
+    print(f"[{datetime.datetime.now()}] Incoming Stream Request from {current_user.email}: {request.message[:20]}...")
+    sse_headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+    command_reply = await handle_chat_commands(request, current_user, db)
+    if command_reply is not None:
+        async def command_stream():
+            yield _sse("done", command_reply)
+        return StreamingResponse(command_stream(), media_type="text/event-stream", headers=sse_headers)
+
+    full_context, current_persona, reply_key = await build_chat_context(request, current_user, db)
+    model_source = get_model_source()
+    user_id = current_user.id
+
+    reply = await cached_reply(reply_key)
+    if reply is not None:
+        # Cache hit: the whole reply in one token event, no generation
+        async def cached_stream():
+            source = model_source + " (Cached)"
+            yield _sse("meta", {"model_source": source})
+            yield _sse("token", {"text": reply})
+            audio_url = None if request.mute_audio else await synthesize_reply_audio(reply)
+            save_chat_turn(user_id, request.message, reply)
+            yield _sse("done", {
+                "reply": reply,
+                "audio_url": audio_url,
+                "audio_segments": [audio_url] if audio_url else [],
+                "animation_state": "talking" if audio_url else "idle",
+                "model_source": source
+            })
+        return StreamingResponse(cached_stream(), media_type="text/event-stream", headers=sse_headers)
+
+    # Queue now so a saturated server answers 429 instead of an empty stream
+    try:
+        tokens = require_scheduler().stream(
+            user_id,
+            llm_engine.LLMEngine.stream_reply,
+            user_message=request.message,
+            context_text=full_context,
+            persona_text=current_persona
+        )
+    except generation_scheduler.SchedulerSaturated as e:
+        raise saturated_error(e)
+
+    async def event_stream():
+        yield _sse("meta", {"model_source": model_source})
+
+        pronouns = reply_filters.PronounFilter()
+        # Sentence-pipelined TTS: each finished sentence is synthesized while the LLM keeps going
+        speech = None if request.mute_audio else audio_service.SpeechPipeline(STATIC_AUDIO_DIR, "/static/audio")
+        parts = []
+        failed = False
+
+        def emit_text(text):
+            parts.append(text)
+            if speech:
+                speech.feed(text)
+            return _sse("token", {"text": text})
+
+        # Tokens are produced on a scheduler worker and handed over as they arrive
+        async for piece in tokens:
+            if isinstance(piece, llm_engine.ReplyError):
+                failed = True
+            out = pronouns.feed(piece)
+            if out:
+                yield emit_text(out)
+            if speech:
+                for segment in speech.pop_ready():
+                    yield _sse("audio", segment)
+        tail = pronouns.flush()
+        if tail:
+            yield emit_text(tail)
+
+        reply = "".join(parts).strip()
+        if not reply:
+            reply = FALLBACK_REPLY
+            yield emit_text(reply)
+
+        audio_url = None
+        audio_segments = []
+        if speech:
+            speech.finish()
+            async for segment in speech.drain():
+                yield _sse("audio", segment)
+            audio_segments = speech.segment_urls
+            audio_url = speech.write_playlist()
+
+        save_chat_turn(user_id, request.message, reply)
+        await cache_reply(reply_key, reply, failed=failed)
+
+        yield _sse("done", {
+            "reply": reply,
+            "audio_url": audio_url, # M3U playlist of the segments below
+            "audio_segments": audio_segments,
+            "animation_state": "talking" if audio_url else "idle",
+            "model_source": model_source
+        })
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=sse_headers)
+
 @app.get("/persona")
-async def get_persona_endpoint(admin: models.User = Depends(auth.get_current_admin)):
-    return {"persona": load_persona()}
+async def get_persona_endpoint(name: Optional[str] = None, admin: models.User = Depends(auth.get_current_admin)):
+    if not persona_registry.registry.exists(name):
+        raise HTTPException(status_code=404, detail="Persona not found")
+    persona = persona_registry.get_persona(name)
+    return {"persona": persona.text, "name": persona.name, "version": persona.version}
 
 @app.post("/persona")
 async def save_persona_endpoint(request: PersonaRequest, admin: models.User = Depends(auth.get_current_admin)):
-    save_persona(request.persona_text)
-    return {"status": "Persona updated", "persona": request.persona_text}
+    try:
+        persona = save_persona(request.persona_text, request.name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    llm_engine.invalidate_prefix_cache() # Old persona KV is never matched again; free it now
+    response_cache.cache.invalidate() # Same for replies keyed on the old persona version
+    return {"status": "Persona updated", "persona": request.persona_text, "name": persona.name, "version": persona.version}
+
+@app.get("/personas")
+async def list_personas(current_user: models.User = Depends(auth.get_current_user)):
+    return {
+        "personas": persona_registry.registry.names(),
+        "selected": current_user.persona_name or persona_registry.DEFAULT_NAME
+    }
 
-@app.get("/history")
-async def get_history(current_user: models.User = Depends(auth.get_current_user)):
-    all_history = load_history()
-    
-    # helper for safety (handle missing user_id in old legacy records)
-    def is_visible(entry):
-        # Admin sees everything
-        if current_user.role == 'admin':
-            return True
-        
-        # User sees: Their own files OR Global files
-        owner_id = entry.get('user_id')
-        scope = entry.get('scope', 'private').lower()
-        
-        if owner_id == current_user.id:
-            return True
-        if scope == 'global':
-            return True
-        return False
+@app.delete("/personas/{name}")
+async def delete_persona(name: str, admin: models.User = Depends(auth.get_current_admin)):
+    try:
+        deleted = persona_registry.registry.delete(name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Persona not found")
+    # Users who picked it fall back to the default persona on their next chat
+    llm_engine.invalidate_prefix_cache()
+    response_cache.cache.invalidate()
+    return {"status": "Persona deleted", "name": name}
+
+@app.put("/auth/me/persona")
+async def select_persona(request: PersonaSelectRequest, current_user: models.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_async_db)):
+    name = request.name
+    if name == persona_registry.DEFAULT_NAME:
+        name = None
+    if not persona_registry.registry.exists(name):
+        raise HTTPException(status_code=404, detail="Persona not found")
+    current_user.persona_name = name
+    await db.commit()
+    auth.invalidate_user(current_user.email)
+    return {"status": "Persona selected", "persona": name or persona_registry.DEFAULT_NAME}
 
-    return [h for h in all_history if is_visible(h)]
+@app.get("/history")
+async def get_history(
+    cursor: Optional[int] = None,
+    limit: int = history_store.DEFAULT_PAGE_SIZE,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: AsyncSession = Depends(database.get_async_db)
+):
+    # Newest first. Pass next_cursor back as ?cursor= to get the following page.
+    # Admin sees everything; users see their own files + Global files
+    items, next_cursor = await history_store.list_visible(db, current_user, cursor=cursor, limit=limit)
+    return {"items": items, "next_cursor": next_cursor}
 
 @app.post("/forget")
-async def forget_endpoint(request: ForgetRequest, current_user: models.User = Depends(auth.get_current_user)):
+async def forget_endpoint(request: ForgetRequest, current_user: models.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_async_db)):
     # 1. Verify Ownership / Permission
-    history = load_history()
-    target_entry = next((h for h in history if h['filename'] == request.filename), None)
+    matches = await history_store.find_by_filename(db, request.filename)
+    # Prefer the caller's own entry when several users trained the same filename
+    target_entry = next((h for h in matches if h.user_id == current_user.id), matches[0] if matches else None)
     
     if not target_entry:
          raise HTTPException(status_code=404, detail="Memory not found")
     
-    owner_id = target_entry.get('user_id')
-    scope = target_entry.get('scope', 'private').lower()
+    owner_id = target_entry.user_id
+    scope = (target_entry.scope or 'private').lower()
     
     # Rules:
     # 1. Admin can delete anything.
@@ -506,62 +802,104 @@ async def forget_endpoint(request: ForgetRequest, current_user: models.User = De
     if not is_admin and not is_owner:
          raise HTTPException(status_code=403, detail="You do not own this memory")
 
+    # Legacy /train entries carry no owner: they were only logged for Global uploads
+    target_user_id = None if (is_global or owner_id is None) else owner_id
+
     # 2. Proceed with Delete
-    file_path = os.path.join(DATA_STORE_DIR, request.filename)
-    if os.path.exists(file_path):
-        os.remove(file_path)
+    scope_dir = "global" if target_user_id is None else f"users/{target_user_id}"
+    for file_path in (os.path.join(DATA_STORE_DIR, scope_dir, request.filename), os.path.join(DATA_STORE_DIR, request.filename)):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            break
 
-    history = load_history()
-    new_history = [entry for entry in history if entry['filename'] != request.filename]
-    
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(new_history, f, ensure_ascii=False, indent=2)
+    await history_store.delete_entries(db, request.filename, owner_id)
 
-    rag_engine.rebuild_index(DATA_STORE_DIR)
+    # Remove only this document's vectors (global or private index)
+    removed = await rag_workers.delete_documents(request.filename, user_id=target_user_id)
+    response_cache.cache.invalidate(target_user_id)
     
-    return {"status": "Forgotten", "filename": request.filename}
+    return {"status": "Forgotten", "filename": request.filename, "vectors_removed": removed}
 
 @app.get("/download/{filename}")
 async def download_file(filename: str):
     from fastapi.responses import FileResponse # Import locally or top level
-    file_path = os.path.join(DATA_STORE_DIR, filename)
-    if os.path.exists(file_path):
-        return FileResponse(file_path, filename=filename)
+    # Legacy uploads live at the data_store root, Global training under global/
+    for file_path in (os.path.join(DATA_STORE_DIR, filename), os.path.join(DATA_STORE_DIR, "global", filename)):
+        if os.path.exists(file_path):
+            return FileResponse(file_path, filename=filename)
     raise HTTPException(status_code=404, detail="File not found")
 
+def submit_training_job(ingest, current_user: models.User, filename: str, scope: str):
+    try:
+        job = rag_workers.jobs.submit(ingest, user_id=current_user.id, filename=filename, scope=scope)
+    except rag_workers.QueueFull:
+        raise HTTPException(status_code=429, detail="Too many trainings in progress, try again shortly", headers={"Retry-After": "5"})
+    return JSONResponse(status_code=202, content=job)
+
+def save_upload(source, file_path):
+    # Stream upload -> disk without holding the whole file in memory
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    try:
+        with open(file_path, "w", encoding="utf-8") as f:
+            reader = io.TextIOWrapper(source, encoding="utf-8")
+            while True:
+                block = reader.read(text_chunker.READ_BLOCK_CHARS)
+                if not block:
+                    break
+                f.write(block)
+            reader.detach()
+    except UnicodeDecodeError:
+        os.remove(file_path)
+        raise
+
 @app.post("/train")
 async def train_endpoint(
     file: UploadFile = File(...), 
     scope: str = Form("private"),
     current_user: models.User = Depends(auth.get_current_user)
 ):
-    content = await file.read()
-    text = content.decode("utf-8")
-    
     if scope == "global":
         if current_user.role != "admin":
             raise HTTPException(status_code=403, detail="Only Admins can train Global memory")
         target_user_id = None
     else:
         target_user_id = current_user.id
-    
-    file_path = os.path.join(DATA_STORE_DIR, file.filename)
-    with open(file_path, "w", encoding="utf-8") as f:
-        f.write(text)
 
-    rag_engine.add_documents([text], metadatas=[{"source": file.filename}], user_id=target_user_id)
-    
-    # Only Admin updates global history
-    if target_user_id is None:
+    # Store under the scope folder (same layout as train_text_internal / rebuild)
+    scope_dir = "global" if target_user_id is None else f"users/{target_user_id}"
+    full_store_dir = os.path.join(DATA_STORE_DIR, scope_dir)
+    filename = os.path.basename(file.filename)
+    file_path = os.path.join(full_store_dir, filename)
+
+    await file.seek(0)
+    try:
+        # Disk I/O (and the spooled upload's reads) off the event loop
+        await run_in_threadpool(save_upload, file.file, file_path)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="File must be UTF-8 text")
+
+    # Stream file -> chunks -> batched embeddings, in the background (poll /train/jobs/{job_id})
+    async def ingest():
+        current_date = datetime.datetime.now().strftime("%Y-%m-%d")
+        with open(file_path, "r", encoding="utf-8") as f:
+            chunk_count = await rag_workers.add_chunks(
+                text_chunker.iter_chunks(f),
+                base_metadata={"source": filename, "memory_date": current_date},
+                user_id=target_user_id
+            )
+        response_cache.cache.invalidate(target_user_id)
+
         entry = {
-            "filename": file.filename,
+            "filename": filename,
             "timestamp": datetime.datetime.now().isoformat(),
-            "status": "Success (File)"
+            "status": "Success (File)",
+            "user_id": target_user_id,
+            "scope": "Global" if target_user_id is None else "Private"
         }
-        save_history(entry)
-    
-    status_msg = f"Training completed ({scope})"
-    return {"filename": file.filename, "status": status_msg}
+        await save_history(entry)
+        return {"chunks": chunk_count, "status": f"Training completed ({scope})"}
+
+    return submit_training_job(ingest, current_user, filename, scope)
 
 @app.post("/train-text")
 async def train_text_endpoint(request: TrainTextRequest, current_user: models.User = Depends(auth.get_current_user)):
@@ -572,24 +910,46 @@ async def train_text_endpoint(request: TrainTextRequest, current_user: models.Us
     else:
         target_user_id = current_user.id
         
-    return train_text_internal(request.title, request.text, user_id=target_user_id)
+    async def ingest():
+        return await train_text_internal(request.title, request.text, user_id=target_user_id)
+
+    return submit_training_job(ingest, current_user, request.title, request.scope)
+
+@app.get("/train/jobs")
+async def list_training_jobs(current_user: models.User = Depends(auth.get_current_user)):
+    # Admin sees every job in this process; users see their own
+    return rag_workers.jobs.list(None if current_user.role == "admin" else current_user.id)
+
+@app.get("/train/jobs/{job_id}")
+async def get_training_job(job_id: str, current_user: models.User = Depends(auth.get_current_user)):
+    job = rag_workers.jobs.get(job_id)
+    if job is None or (job["user_id"] != current_user.id and current_user.role != "admin"):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 @app.post("/voice-chat")
-async def voice_chat_endpoint(file: UploadFile = File(...)):
-    temp_filename = f"temp_{uuid.uuid4()}.wav"
-    with open(temp_filename, "wb") as buffer:
-        buffer.write(await file.read())
-        
-    text = audio_service.transcribe_audio(temp_filename)
-    
-    if os.path.exists(temp_filename):
-        os.remove(temp_filename)
+async def voice_chat_endpoint(
+    file: UploadFile = File(...),
+    current_user: models.User = Depends(auth.get_current_user),
+    db: AsyncSession = Depends(database.get_async_db)
+):
+    # Decoded in memory and recognized on the STT worker pool (no temp files, loop stays free)
+    max_bytes = int(transcription.STT_MAX_UPLOAD_MB * 1024 * 1024)
+    audio_bytes = await file.read(max_bytes + 1)
+    if len(audio_bytes) > max_bytes:
+        raise HTTPException(status_code=413, detail="Audio file is too large")
+
+    try:
+        text = await transcription.transcribe(audio_bytes)
+    except Exception as e:
+        print(f"Transcription Error: {e}")
+        text = ""
     
     if not text:
         return {"reply": "Sorry, I could not hear you.", "audio_url": None, "animation_state": "idle"}
     
     chat_req = ChatRequest(message=text)
-    response = await chat_endpoint(chat_req)
+    response = await chat_endpoint(chat_req, current_user=current_user, db=db)
     
     return {
         "transcription": text,
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Index
 from sqlalchemy.orm import relationship
 from database import Base
 import datetime
@@ -13,17 +13,34 @@ class User(Base):
     hashed_password = Column(String) # Renamed password_hash to hashed_password
     is_active = Column(Boolean, default=True)
     role = Column(String, default="user") # 'admin' or 'user'
+    persona_name = Column(String, nullable=True) # selected persona (None = default)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
     messages = relationship("ChatMessage", back_populates="owner")
 
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
+    __table_args__ = (
+        # "Last N messages of this user" walks the index instead of sorting the user's whole history
+        Index("ix_chat_messages_user_timestamp", "user_id", "timestamp"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
+    uid = Column(String, unique=True, index=True, nullable=True) # write-behind journal key (idempotent replay)
     user_id = Column(Integer, ForeignKey("users.id"))
     role = Column(String) # 'user', 'ai', 'system'
     content = Column(Text)
     timestamp = Column(DateTime, default=datetime.datetime.utcnow)
 
     owner = relationship("User", back_populates="messages")
+
+class TrainingHistory(Base):
+    __tablename__ = "training_history"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=True, index=True) # None = Global / legacy upload
+    scope = Column(String, default="Private", index=True) # 'Global' or 'Private'
+    filename = Column(String, index=True)
+    original_title = Column(String, nullable=True)
+    status = Column(String)
+    timestamp = Column(DateTime, default=datetime.datetime.now)
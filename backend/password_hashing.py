@@ -0,0 +1,10 @@
+from passlib.context import CryptContext
+
+# Kept free of app imports: this module is what the hashing worker processes load.
+pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+
+def verify_password(plain_password, hashed_password):
+    return pwd_context.verify(plain_password, hashed_password)
+
+def get_password_hash(password):
+    return pwd_context.hash(password)
@@ -0,0 +1,166 @@
+import os
+import re
+import threading
+import time
+
+# Configuration
+DEFAULT_PERSONA_FILE = "persona.txt" # the "default" persona (hand-edited file, kept where it always was)
+PERSONA_DIR = "personas" # named personas live in personas/<name>.txt
+DEFAULT_NAME = "default"
+STAT_INTERVAL = float(os.getenv("PERSONA_STAT_INTERVAL", "2")) # seconds between mtime checks per persona
+
+NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class Persona:
+    __slots__ = ("name", "text", "version")
+
+    def __init__(self, name, text, version):
+        self.name = name
+        self.text = text
+        self.version = version # changes whenever the text does; stable key for prompt/response caches
+
+
+class _Entry:
+    __slots__ = ("persona", "stamp", "checked_at")
+
+    def __init__(self, persona, stamp, checked_at):
+        self.persona = persona
+        self.stamp = stamp # (mtime_ns, size) of the file we loaded, None if missing
+        self.checked_at = checked_at
+
+
+def is_valid_name(name):
+    return bool(name) and NAME_PATTERN.match(name) is not None
+
+
+class PersonaRegistry:
+    """
+    In-memory persona store. Files are re-read only when their mtime/size changes,
+    and stat() itself runs at most once per STAT_INTERVAL per persona,
+    so the chat hot path normally touches no files at all.
+    """
+
+    def __init__(self, default_file=DEFAULT_PERSONA_FILE, persona_dir=PERSONA_DIR, stat_interval=STAT_INTERVAL):
+        self.default_file = default_file
+        self.persona_dir = persona_dir
+        self.stat_interval = stat_interval
+        self._entries = {}
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def path_for(self, name):
+        if name in (None, "", DEFAULT_NAME):
+            return self.default_file
+        if not is_valid_name(name):
+            raise ValueError(f"Invalid persona name: {name!r}")
+        return os.path.join(self.persona_dir, f"{name}.txt")
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _read(self, path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read().strip()
+        except OSError:
+            return ""
+
+    def get(self, name=None):
+        """
+        Persona by name. Unknown or missing named personas fall back to the default one.
+        """
+        name = name or DEFAULT_NAME
+        if not is_valid_name(name):
+            name = DEFAULT_NAME
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and now - entry.checked_at < self.stat_interval:
+                persona = entry.persona
+            else:
+                persona = self._refresh(name, entry, now)
+        if persona is None:
+            return self.get(DEFAULT_NAME)
+        return persona
+
+    def _refresh(self, name, entry, now):
+        # Caller holds _lock. Returns None for a named persona whose file is gone.
+        path = self.path_for(name)
+        stamp = self._stat(path)
+        if stamp is None and name != DEFAULT_NAME:
+            self._entries.pop(name, None)
+            return None
+        if entry is not None and entry.stamp == stamp:
+            entry.checked_at = now
+            return entry.persona
+
+        # First load, or the file was edited by hand
+        self._version += 1
+        persona = Persona(name, self._read(path) if stamp else "", self._version)
+        self._entries[name] = _Entry(persona, stamp, now)
+        return persona
+
+    def save(self, text, name=None):
+        """
+        Atomically replace a persona's file (write to a temp file, then rename).
+        """
+        name = name or DEFAULT_NAME
+        path = self.path_for(name)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._version += 1
+            persona = Persona(name, text.strip(), self._version)
+            self._entries[name] = _Entry(persona, self._stat(path), time.monotonic())
+        return persona
+
+    def delete(self, name):
+        if name in (None, "", DEFAULT_NAME):
+            raise ValueError("The default persona cannot be deleted")
+        path = self.path_for(name)
+        if not os.path.exists(path):
+            return False
+        os.remove(path)
+        with self._lock:
+            self._entries.pop(name, None)
+        return True
+
+    def names(self):
+        names = [DEFAULT_NAME]
+        if os.path.isdir(self.persona_dir):
+            names += sorted(
+                entry[:-4] for entry in os.listdir(self.persona_dir)
+                if entry.endswith(".txt") and is_valid_name(entry[:-4])
+            )
+        return names
+
+    def exists(self, name):
+        if name in (None, "", DEFAULT_NAME):
+            return True
+        return is_valid_name(name) and os.path.exists(self.path_for(name))
+
+
+registry = PersonaRegistry()
+
+
+def get_persona(name=None):
+    return registry.get(name)
+
+
+def save_persona(text, name=None):
+    return registry.save(text, name)
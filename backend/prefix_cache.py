@@ -0,0 +1,109 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+try:
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None
+
+# Configuration
+# One entry per persona version. A llama.cpp state snapshot holds the whole KV buffer,
+# so keep this small on low-RAM machines.
+PREFIX_CACHE_ENTRIES = int(os.getenv("LLM_PREFIX_CACHE_ENTRIES", "4"))
+
+
+def to_legacy_cache(past):
+    if hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache()
+    return past
+
+
+def to_model_cache(legacy):
+    if DynamicCache is not None and hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(legacy)
+    return legacy
+
+
+class PrefixCache:
+    """
+    KV state for the static start of the system prompt (persona + rules + examples).
+    Entries are keyed by a hash of the prefix text, so a persona edit never reuses a stale
+    state; clear() just frees the old ones early.
+    """
+
+    def __init__(self, max_entries=PREFIX_CACHE_ENTRIES):
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock() # one prefill at a time, never the same prefix twice
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(self, prefix_text, build):
+        """
+        Cached build(prefix_text) for this prefix.
+        """
+        key = hashlib.sha256(prefix_text.encode("utf-8")).hexdigest()
+        entry = self._lookup(key)
+        if entry is not None:
+            return entry
+
+        with self._build_lock:
+            entry = self._lookup(key) # Built by another thread while we waited
+            if entry is not None:
+                return entry
+            entry = build(prefix_text)
+            with self._lock:
+                self.misses += 1
+                self._entries[key] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return entry
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+# ==========================================
+# TRANSFORMERS
+# ==========================================
+
+def build_transformers_prefix(model, tokenizer, prefix_text):
+    """
+    Prefill the prefix once. Returns (token ids, legacy past_key_values).
+    """
+    ids = tokenizer(prefix_text, return_tensors="pt").input_ids[0].tolist()
+    # The last token may merge with whatever text follows, so leave it to the request
+    ids = ids[:-1]
+    with torch.no_grad():
+        out = model(input_ids=torch.tensor([ids], device=model.device), use_cache=True)
+    return ids, to_legacy_cache(out.past_key_values)
+
+
+def match_prefix(prompt_ids, entry):
+    """
+    Number of leading prompt tokens covered by a cached prefix entry (0 = unusable).
+    """
+    if entry is None:
+        return 0
+    ids = entry[0]
+    if len(prompt_ids) > len(ids) and prompt_ids[:len(ids)] == ids:
+        return len(ids)
+    return 0
@@ -1,13 +1,35 @@
 from langchain_community.vectorstores import FAISS
 from langchain_community.embeddings import SentenceTransformerEmbeddings
+from langchain_core.documents import Document
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import copy
+import faiss
+import glob
+import index_store
+import hashlib
 import os
 import shutil
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from embedding_service import BatchedEmbeddings, EmbeddingCache
 
 # Initialize Embeddings
+# Changing the model requires a full re-index (see index_rebuilder.py)
+EMBEDDING_MODEL = os.getenv("RAG_EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+
 print("Initializing Embedding Model (RAG Memory)...")
 embeddings = None
 try:
-    embeddings = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
+    # Concurrent queries/ingests are coalesced into a single encode() call
+    # Repeated queries hit the content-hashed query cache instead of the model
+    embeddings = BatchedEmbeddings(
+        SentenceTransformerEmbeddings(model_name=EMBEDDING_MODEL),
+        query_cache=EmbeddingCache(namespace=EMBEDDING_MODEL)
+    )
     print("Alignment Chip Online: RAG Memory Active ✅")
 except Exception as e:
     print(f"CRITICAL: Memory System Failed to Load: {e}")
@@ -17,91 +39,725 @@ except Exception as e:
 MEMORY_DIR = "memory_indices"
 GLOBAL_INDEX = "global"
 
-def get_index_path(user_id=None):
+# Resident Index Cache
+# Indices stay in RAM between requests (keyed by scope: "global" / "user_{id}").
+# Cold user indices are evicted LRU-first once the budget is exceeded; global is pinned.
+INDEX_CACHE_MAX_MB = float(os.getenv("RAG_INDEX_CACHE_MB", "512"))
+# "write-through": save on every add. "batched": mark dirty and flush every RAG_FLUSH_INTERVAL seconds.
+PERSIST_MODE = os.getenv("RAG_PERSIST_MODE", "write-through").lower()
+FLUSH_INTERVAL = float(os.getenv("RAG_FLUSH_INTERVAL", "5"))
+INGEST_BATCH_SIZE = int(os.getenv("RAG_INGEST_BATCH", "64")) # chunks per embedding call
+CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKENS", "600")) # max memory tokens put in the prompt
+
+# Concurrency
+# Writers to a scope are serialized and work on a private copy of its index, which is then
+# published as a new generation; searches keep using the snapshot they started with.
+# RAG_MULTIPROCESS=1 (several uvicorn workers): writers also take a file lock and start from
+# the newest index on disk, and readers notice other workers' writes within RAG_STAT_INTERVAL.
+MULTIPROCESS = os.getenv("RAG_MULTIPROCESS", "0") == "1"
+STAT_INTERVAL = float(os.getenv("RAG_STAT_INTERVAL", "1")) # seconds
+KEEP_GENERATIONS = 2 # on disk; a worker may still be loading the previous one
+
+if MULTIPROCESS and PERSIST_MODE == "batched":
+    # Unsaved in-memory writes would be invisible to (and overwritten by) other workers
+    print("RAG: RAG_PERSIST_MODE=batched is single-process only; using write-through")
+    PERSIST_MODE = "write-through"
+
+_index_cache = OrderedDict() # scope -> published vector store (most recently used last)
+_index_sizes = {} # scope -> estimated bytes
+_generations = {} # scope -> generation of the published store
+_checked_at = {} # scope -> when the on-disk generation was last compared (multiprocess)
+_dirty_scopes = set()
+_source_ids = {} # scope -> {source filename: [docstore ids]} (for in-place deletion)
+_cache_lock = threading.RLock()
+_write_locks = {} # scope -> threading.Lock
+# A snapshot that leaves the cache (replaced, evicted, cleared) is retired: its files are
+# closed (index_store.release) as soon as no search or writer is still using it
+_users = {} # id(store) -> searches/writers using it
+_retired = {} # id(store) -> retired store still in use
+_released = weakref.WeakSet()
+_search_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rag-search")
+_flush_timer = None
+# While a rebuild runs, writes to the live indices are also recorded per scope, so
+# install_index can replay them onto the rebuilt index (None = no rebuild running)
+_captures = None # scope -> [("add", texts, vectors, metadatas) | ("delete", source)], or None once installed
+
+def get_scope_key(user_id=None):
     if user_id is None:
-        return os.path.join(MEMORY_DIR, GLOBAL_INDEX)
-    return os.path.join(MEMORY_DIR, f"user_{user_id}")
+        return GLOBAL_INDEX
+    return f"user_{user_id}"
 
-def get_vector_store(user_id=None):
-    path = get_index_path(user_id)
+def get_index_path(user_id=None):
+    # Directory of the scope's published index (None if it has none yet)
+    return _read_pointer(get_scope_key(user_id))[1]
+
+def _path_for_scope(scope):
+    # Pre-generation layout (memory_indices/<scope>); still loaded until the next save
+    return os.path.join(MEMORY_DIR, scope)
+
+def _estimate_size(vector_store):
+    # Vector codes + text held in RAM (memory-mapped pages and SQLite-resident text are not counted)
+    try:
+        return index_store.resident_bytes(vector_store)
+    except Exception:
+        return 0
+
+def save_index_atomic(vector_store, path, extra_files=None):
+    # Write to a sibling temp dir, then swap it in so readers never see a half-written index.
+    # extra_files {name: text} are saved inside it, so they change together with the index.
+    tmp_path = f"{path}.tmp-{uuid.uuid4().hex[:8]}"
+    old_path = f"{path}.old-{uuid.uuid4().hex[:8]}"
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    index_store.write_store(vector_store, tmp_path)
+    for name, text in (extra_files or {}).items():
+        with open(os.path.join(tmp_path, name), "w", encoding="utf-8") as f:
+            f.write(text)
     if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+# ==========================================
+# ON-DISK GENERATIONS
+# ==========================================
+# memory_indices/<scope>.g000042/  one complete saved index per generation (never modified),
+#                                  in index_store's format (index.faiss + docstore.sqlite)
+# memory_indices/<scope>.current   name of the published generation, replaced atomically
+
+def _pointer_path(scope):
+    return os.path.join(MEMORY_DIR, f"{scope}.current")
+
+def _read_pointer(scope):
+    """
+    (generation, directory) of the index published on disk; (0, None) if there is none.
+    """
+    try:
+        with open(_pointer_path(scope), "r", encoding="utf-8") as f:
+            name = f.read().strip()
+        return int(name.rsplit(".g", 1)[1]), os.path.join(MEMORY_DIR, name)
+    except FileNotFoundError:
+        legacy = _path_for_scope(scope)
+        return 0, (legacy if os.path.isdir(legacy) else None)
+    except (ValueError, IndexError) as e:
+        raise RuntimeError(f"Corrupt index pointer for {scope}: {e}")
+
+def _fsync_tree(path):
+    for name in os.listdir(path):
+        with open(os.path.join(path, name), "rb") as f:
+            os.fsync(f.fileno())
+
+def _save_scope(scope, vector_store, generation):
+    """
+    Save as a new generation directory, then flip the pointer file (os.replace is atomic on
+    every platform). Published directories are never written to, so a reader in any process
+    always loads a complete index.
+    """
+    os.makedirs(MEMORY_DIR, exist_ok=True)
+    name = f"{scope}.g{generation:06d}"
+    target = os.path.join(MEMORY_DIR, name)
+    tmp_path = f"{target}.tmp-{uuid.uuid4().hex[:8]}"
+    index_store.write_store(vector_store, tmp_path)
+    _fsync_tree(tmp_path)
+    shutil.rmtree(target, ignore_errors=True) # Left by a crash between these two steps
+    os.replace(tmp_path, target)
+
+    pointer = _pointer_path(scope)
+    pointer_tmp = f"{pointer}.tmp-{uuid.uuid4().hex[:8]}"
+    with open(pointer_tmp, "w", encoding="utf-8") as f:
+        f.write(name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(pointer_tmp, pointer)
+    _prune_generations(scope, generation)
+
+def _prune_generations(scope, generation):
+    # Caller holds the scope's write lock (or _cache_lock in batched mode).
+    # Whatever cannot be removed yet is retried by the next prune.
+    for path in glob.glob(os.path.join(MEMORY_DIR, f"{scope}.g*")):
+        name = os.path.basename(path)
+        try:
+            old = int(name[len(scope) + 2:].split(".", 1)[0])
+        except ValueError:
+            continue
+        if ".tmp-" in name or old <= generation - KEEP_GENERATIONS:
+            _remove_tree(path)
+    legacy = _path_for_scope(scope)
+    if os.path.isdir(legacy):
+        _remove_tree(legacy) # Migrated to the generation layout
+
+def _remove_tree(path):
+    if index_store.in_use(path):
+        return # A resident snapshot (or a copy of one) still reads it; closed once retired
+    try:
+        shutil.rmtree(path)
+    except OSError as e:
+        # e.g. Windows, while another process still has a file open
+        print(f"RAG: could not remove {path} ({e}); retrying on the next prune")
+
+def _load(path):
+    # Memory-mapped, documents on demand (see index_store); pickled legacy indices still load
+    return index_store.read_store(path, embeddings)
+
+class _FileLock:
+    """
+    Exclusive lock on a file, shared by every process on this machine (flock / msvcrt).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._file = open(self.path, "a+b")
+        if os.name == "nt":
+            import msvcrt
+            self._file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue # LK_LOCK gives up after ~10 s; keep waiting
+        else:
+            import fcntl
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
         try:
-            return FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)
+            if os.name == "nt":
+                import msvcrt
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._file.close()
+            self._file = None
+
+@contextmanager
+def _write_lock(scope):
+    """
+    Exclusive write access to a scope: per-process lock, plus a file lock in multiprocess mode.
+    Readers never take it.
+    """
+    with _cache_lock:
+        lock = _write_locks.setdefault(scope, threading.Lock())
+    with lock:
+        if MULTIPROCESS:
+            with _FileLock(os.path.join(MEMORY_DIR, f"{scope}.lock")):
+                yield
+        else:
+            yield
+
+# ==========================================
+# RESIDENT SNAPSHOTS
+# ==========================================
+
+def start_capture():
+    global _captures
+    with _cache_lock:
+        _captures = {}
+
+def stop_capture():
+    global _captures
+    with _cache_lock:
+        _captures = None
+
+def _record(scope, operation):
+    # Caller holds the scope's write lock
+    with _cache_lock:
+        if _captures is not None and _captures.get(scope, []) is not None:
+            _captures.setdefault(scope, []).append(operation)
+
+def _replay(vector_store, operations, rebuilt_sources):
+    # Writes that reached the live index while the rebuild ran. Adds of files the rebuild
+    # read itself are skipped (their vectors are in the rebuilt index already).
+    for operation in operations:
+        if operation[0] == "delete":
+            ids = _build_source_ids(vector_store).get(operation[1]) if vector_store is not None else None
+            if ids:
+                index_store.delete_documents(vector_store, ids)
+            continue
+        _, texts, vectors, metadatas = operation
+        metadatas = metadatas or [{}] * len(texts)
+        keep = [i for i, meta in enumerate(metadatas) if (meta or {}).get("source") not in rebuilt_sources]
+        if not keep:
+            continue
+        pairs = [(texts[i], vectors[i]) for i in keep]
+        kept_metadatas = [metadatas[i] for i in keep]
+        ids = [str(uuid.uuid4()) for _ in keep]
+        if vector_store is None:
+            vector_store = FAISS.from_embeddings(pairs, embeddings, metadatas=kept_metadatas, ids=ids)
+        else:
+            vector_store.add_embeddings(pairs, metadatas=kept_metadatas, ids=ids)
+    return vector_store
+
+def install_index(vector_store, user_id=None, rebuilt_sources=()):
+    """
+    Replace a scope's index wholesale (used by the rebuild pipeline). vector_store None
+    empties the scope. Writes recorded since start_capture() are replayed on top first;
+    rebuilt_sources names the files the rebuild embedded.
+    """
+    scope = get_scope_key(user_id)
+    with _write_lock(scope):
+        with _cache_lock:
+            operations = _captures.get(scope) if _captures is not None else None
+            if _captures is not None:
+                _captures[scope] = None # Installed: later writes go to the live index only
+        vector_store = _replay(vector_store, operations or [], set(rebuilt_sources))
+        if vector_store is None:
+            _clear(scope)
+            return
+        index_store.compact(vector_store)
+        with _cache_lock:
+            generation = max(_generations.get(scope, 0), _read_pointer(scope)[0]) + 1
+            _save_scope(scope, vector_store, generation)
+            _dirty_scopes.discard(scope)
+            _source_ids.pop(scope, None)
+            _install(scope, vector_store, generation)
+
+def _evict_if_needed():
+    # Caller holds _cache_lock
+    budget = INDEX_CACHE_MAX_MB * 1024 * 1024
+    total = sum(_index_sizes.values())
+    # Never evict the most recently used entry (it was just touched by the caller)
+    for scope in list(_index_cache.keys())[:-1]:
+        if total <= budget:
+            break
+        if scope == GLOBAL_INDEX:
+            continue
+        store = _index_cache.pop(scope)
+        if scope in _dirty_scopes:
+            _save_scope(scope, store, _generations[scope])
+            _dirty_scopes.discard(scope)
+        total -= _index_sizes.pop(scope, 0)
+        _source_ids.pop(scope, None)
+        _retire(store)
+        print(f"RAG Cache: evicted cold index '{scope}'")
+
+def _build_source_ids(vector_store):
+    lookup = index_store.document_sources(vector_store)
+    sources = {}
+    for position in sorted(vector_store.index_to_docstore_id):
+        doc_id = vector_store.index_to_docstore_id[position]
+        sources.setdefault(lookup.get(doc_id), []).append(doc_id)
+    return sources
+
+def _sources_for(scope, vector_store):
+    # A private {source: ids} map for a writer's copy of vector_store
+    with _cache_lock:
+        if vector_store is not None and _index_cache.get(scope) is vector_store and scope in _source_ids:
+            return {source: list(ids) for source, ids in _source_ids[scope].items()}
+    return _build_source_ids(vector_store) if vector_store is not None else {}
+
+def _track_sources(sources, ids, metadatas):
+    for doc_id, meta in zip(ids, metadatas or [{}] * len(ids)):
+        sources.setdefault((meta or {}).get("source"), []).append(doc_id)
+
+def _cache_put(scope, vector_store):
+    # Caller holds _cache_lock
+    if scope not in _source_ids:
+        _source_ids[scope] = _build_source_ids(vector_store)
+    previous = _index_cache.get(scope)
+    if previous is not None and previous is not vector_store:
+        _retire(previous)
+    _index_cache[scope] = vector_store
+    _index_cache.move_to_end(scope)
+    _index_sizes[scope] = _estimate_size(vector_store)
+    _evict_if_needed()
+
+def _install(scope, vector_store, generation):
+    # Caller holds _cache_lock
+    _generations[scope] = generation
+    _checked_at[scope] = time.monotonic()
+    _cache_put(scope, vector_store)
+
+def _lease(vector_store):
+    # Caller holds _cache_lock. Keeps vector_store open until _unlease, even if it is retired meanwhile.
+    if vector_store is not None:
+        _users[id(vector_store)] = _users.get(id(vector_store), 0) + 1
+    return vector_store
+
+def _unlease(vector_store):
+    if vector_store is None:
+        return
+    with _cache_lock:
+        users = _users.pop(id(vector_store)) - 1
+        if users:
+            _users[id(vector_store)] = users
+        elif _retired.pop(id(vector_store), None) is not None:
+            _release(vector_store)
+
+def _retire(vector_store):
+    # Caller holds _cache_lock. vector_store has left the cache.
+    if _users.get(id(vector_store)):
+        _retired[id(vector_store)] = vector_store # Released by its last user
+    else:
+        _release(vector_store)
+
+def _release(vector_store):
+    # Caller holds _cache_lock
+    _released.add(vector_store)
+    try:
+        index_store.release(vector_store)
+    except Exception as e:
+        print(f"RAG: failed to close a retired index: {e}")
+
+def _stale(scope):
+    # Caller holds _cache_lock. Another worker may have published a newer generation.
+    return MULTIPROCESS and time.monotonic() - _checked_at.get(scope, 0) >= STAT_INTERVAL
+
+def get_vector_store(user_id=None):
+    """
+    The scope's published snapshot, loaded on first use. A snapshot is never modified once
+    published (writers publish a new generation instead), so it can be searched without locks.
+    """
+    scope = get_scope_key(user_id)
+    with _cache_lock:
+        store = _index_cache.get(scope)
+        if store is not None:
+            _index_cache.move_to_end(scope)
+            if not _stale(scope):
+                return store
+
+    # Load (or reload) outside the locks: an ingestion in progress never delays a search
+    try:
+        generation, path = _read_pointer(scope)
+    except RuntimeError as e:
+        print(f"Failed to load index for {user_id}: {e}")
+        return store
+    if path is None:
+        return store
+    with _cache_lock:
+        if store is not None and generation <= _generations.get(scope, 0):
+            _checked_at[scope] = time.monotonic()
+            return store
+    try:
+        loaded = _load(path)
+    except Exception as e:
+        print(f"Failed to load index for {user_id}: {e}")
+        return store
+    with _cache_lock:
+        # A writer may have published something newer while we were loading
+        if scope not in _index_cache or generation > _generations.get(scope, 0):
+            _source_ids.pop(scope, None)
+            _install(scope, loaded, generation)
+        store = _index_cache.get(scope, loaded)
+        if store is not loaded:
+            _release(loaded)
+        return store
+
+@contextmanager
+def _reading(user_id=None):
+    """
+    get_vector_store(), kept open for the block even if it is replaced or evicted meanwhile.
+    """
+    while True:
+        store = get_vector_store(user_id)
+        with _cache_lock:
+            # Retired and closed between the two steps: take the newer snapshot instead
+            if store is None or store not in _released:
+                _lease(store)
+                break
+    try:
+        yield store
+    finally:
+        _unlease(store)
+
+@contextmanager
+def _latest(scope):
+    """
+    Caller holds the scope's write lock. The newest index (re-read from disk if another
+    process wrote it, or if it was evicted) and its generation, kept open for the block.
+    """
+    with _cache_lock:
+        store = _lease(_index_cache.get(scope))
+        generation = _generations.get(scope, 0)
+    try:
+        if store is None or MULTIPROCESS:
+            disk_generation, path = _read_pointer(scope)
+            if path is not None and (store is None or disk_generation > generation):
+                # Raise on a failed load: writing a fresh index over it would lose every stored memory
+                loaded = _load(path)
+                with _cache_lock:
+                    _source_ids.pop(scope, None)
+                    _install(scope, loaded, disk_generation)
+                    _unlease(store)
+                    store = _lease(loaded)
+            generation = max(generation, disk_generation)
+        yield store, generation
+    finally:
+        _unlease(store)
+
+def _clone_store(vector_store):
+    # Private copy for a writer; the published snapshot stays untouched for readers
+    clone = copy.copy(vector_store)
+    clone.index = index_store.configure(faiss.clone_index(vector_store.index)) # Also un-maps a mapped index
+    clone.docstore = index_store.copy_docstore(vector_store.docstore)
+    clone.index_to_docstore_id = dict(vector_store.index_to_docstore_id)
+    return clone
+
+def _commit(scope, vector_store, generation, sources):
+    # Caller holds the scope's write lock. Publish, then persist.
+    with _cache_lock:
+        _source_ids[scope] = sources
+        _install(scope, vector_store, generation)
+    _persist(scope, vector_store, generation)
+
+def flush_indices():
+    """
+    Persist every dirty index (batched mode). Safe to call at shutdown.
+    """
+    global _flush_timer
+    with _cache_lock:
+        _flush_timer = None
+        for scope in list(_dirty_scopes):
+            store = _index_cache.get(scope)
+            if store is not None:
+                try:
+                    _save_scope(scope, store, _generations[scope])
+                except Exception as e:
+                    print(f"RAG Flush Error ({scope}): {e}")
+                    continue
+            _dirty_scopes.discard(scope)
+
+def _schedule_flush():
+    # Caller holds _cache_lock
+    global _flush_timer
+    if _flush_timer is None:
+        _flush_timer = threading.Timer(FLUSH_INTERVAL, flush_indices)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+def _persist(scope, vector_store, generation):
+    if PERSIST_MODE == "batched":
+        with _cache_lock:
+            _dirty_scopes.add(scope)
+            _schedule_flush()
+    else:
+        # Under the scope's write lock only: searches and other scopes carry on meanwhile
+        _save_scope(scope, vector_store, generation)
+
+# ==========================================
+# WRITES
+# ==========================================
+
+def _ingest(user_id, batches):
+    """
+    Embed and append (texts, metadatas) batches to one scope as a single write: a private copy
+    grows batch by batch and is published as the next generation at the end.
+    Returns the number of texts added. If any batch fails, nothing is published and the error is raised.
+    """
+    scope = get_scope_key(user_id)
+    added = 0
+    recorded = []
+    with _write_lock(scope), _latest(scope) as (base, generation):
+        sources = _sources_for(scope, base)
+        vector_store = _clone_store(base) if base is not None else None
+        try:
+            for texts, metadatas in batches:
+                vectors = embeddings.embed_documents(texts)
+                ids = [str(uuid.uuid4()) for _ in texts]
+                pairs = list(zip(texts, vectors))
+                if vector_store is None:
+                    vector_store = FAISS.from_embeddings(pairs, embeddings, metadatas=metadatas, ids=ids)
+                else:
+                    vector_store.add_embeddings(pairs, metadatas=metadatas, ids=ids)
+                _track_sources(sources, ids, metadatas)
+                recorded.append(("add", texts, vectors, metadatas))
+                added += len(texts)
         except Exception as e:
-            print(f"Failed to load index for {user_id}: {e}")
-            return None
-    return None
+            # All or nothing: a retried upload must not find half of itself already indexed
+            print(f"RAG Ingest Error ({scope}): {e}")
+            raise
+
+        if added:
+            index_store.compact(vector_store) # Large scopes switch to the configured index type
+            _commit(scope, vector_store, generation + 1, sources)
+            for operation in recorded:
+                _record(scope, operation)
+    return added
 
 def add_documents(documents: list[str], metadatas: list[dict] = None, user_id: int = None):
     """
     Add documents to specific memory index (Global or User).
     """
     if not documents or embeddings is None:
-        return
+        return 0
+    return _ingest(user_id, [(list(documents), metadatas)])
 
-    path = get_index_path(user_id)
-    vector_store = get_vector_store(user_id)
+def add_chunks(chunks, base_metadata: dict = None, user_id: int = None, batch_size: int = INGEST_BATCH_SIZE) -> int:
+    """
+    Add (chunk_text, offset) pairs (e.g. from text_chunker) in embedding batches.
+    Each chunk gets base_metadata plus its offset; the index is published and persisted once at the end.
+    Returns the number of chunks added.
+    """
+    if embeddings is None:
+        return 0
 
-    if vector_store is None:
-        try:
-            vector_store = FAISS.from_texts(documents, embeddings, metadatas=metadatas)
-        except Exception as e:
-            print(f"RAG Init Error: {e}")
-            return
-    else:
+    def batches():
+        texts, metadatas = [], []
+        for index, (text, offset) in enumerate(chunks):
+            texts.append(text)
+            metadatas.append({**(base_metadata or {}), "offset": offset, "chunk": index})
+            if len(texts) >= batch_size:
+                yield texts, metadatas
+                texts, metadatas = [], []
+        if texts:
+            yield texts, metadatas
+
+    return _ingest(user_id, batches())
+
+def estimate_tokens(text: str) -> int:
+    # Rough LLM token estimate (Thai/English mix averages ~3 chars per token on Qwen)
+    return max(1, len(text) // 3)
+
+def _search_scope(user_id, query_vector, k):
+    scope = get_scope_key(user_id)
+    with _reading(user_id) as vector_store:
+        if vector_store is None:
+            return []
         try:
-            vector_store.add_texts(documents, metadatas=metadatas)
+            return [(doc, score, scope) for doc, score in vector_store.similarity_search_with_score_by_vector(query_vector, k=k)]
         except Exception as e:
-            print(f"RAG Add Error: {e}")
-            return
-    
-    # Save
-    os.makedirs(path, exist_ok=True)
-    vector_store.save_local(path)
+            print(f"RAG Search Error ({scope}): {e}")
+            return []
 
-def query_memory(query_text: str, n_results=3, user_id: int = None):
+def retrieve_context(query_text: str, k: int = 5, user_id: int = None, token_budget: int = CONTEXT_TOKEN_BUDGET, max_results: int = None):
     """
-    Query both Global and Private memory.
+    Search Global + Private in parallel, merge by distance, drop duplicates,
+    and keep the best hits that fit in token_budget (None = no budget).
+    Returns new Documents (best first) with 'score' and 'scope' added to metadata.
     """
     if embeddings is None:
         return []
 
-    results = []
-    
-    # 1. Query Global
-    global_store = get_vector_store(None)
-    if global_store:
-        try:
-            results.extend(global_store.similarity_search(query_text, k=n_results))
-        except Exception: 
-            pass
+    # Embed once (cached), then search both indices by vector
+    try:
+        query_vector = embeddings.embed_query(query_text)
+    except Exception as e:
+        print(f"RAG Query Embedding Error: {e}")
+        return []
 
-    # 2. Query Private (if User)
+    futures = [_search_pool.submit(_search_scope, None, query_vector, k)]
     if user_id:
-        user_store = get_vector_store(user_id)
-        if user_store:
-            try:
-                results.extend(user_store.similarity_search(query_text, k=n_results))
-            except Exception:
-                pass
-    
-    # Deduplicate (by content potentially) and maybe re-rank?
-    # For now, simplistic combination: just take them all.
-    # Optionally limit to n_results * 2
-    return results[:n_results*2] # Return broad context
+        futures.append(_search_pool.submit(_search_scope, user_id, query_vector, k))
+    scored = []
+    for future in futures:
+        scored.extend(future.result())
+
+    # L2 distance: lower is closer
+    scored.sort(key=lambda item: item[1])
+
+    results = []
+    seen = set()
+    used_tokens = 0
+    for doc, score, scope in scored:
+        content_key = hashlib.sha1(" ".join(doc.page_content.split()).encode("utf-8")).hexdigest()
+        if content_key in seen:
+            continue
+        seen.add(content_key)
+
+        cost = estimate_tokens(doc.page_content)
+        if token_budget is not None and results and used_tokens + cost > token_budget:
+            break
+        used_tokens += cost
+        # Copy: the docstore hands out its own Document objects
+        results.append(Document(page_content=doc.page_content, metadata={**doc.metadata, "score": float(score), "scope": scope}))
+        if max_results is not None and len(results) >= max_results:
+            break
+    return results
+
+def query_memory(query_text: str, n_results=3, user_id: int = None):
+    """
+    Query both Global and Private memory.
+    """
+    return retrieve_context(query_text, k=n_results, user_id=user_id, token_budget=None, max_results=n_results * 2)
+
+def delete_documents(source: str, user_id: int = None) -> int:
+    """
+    Remove every vector whose metadata 'source' matches (no re-embedding).
+    Published as a new generation, like any other write. Returns the number of vectors removed.
+    """
+    scope = get_scope_key(user_id)
+    with _write_lock(scope), _latest(scope) as (base, generation):
+        if base is None:
+            return 0
+        sources = _sources_for(scope, base)
+        ids = sources.get(source)
+        if not ids:
+            return 0
+        vector_store = _clone_store(base)
+        try:
+            index_store.delete_documents(vector_store, ids) # remove_ids (or a rebuild for HNSW) + docstore cleanup
+        except Exception as e:
+            print(f"RAG Delete Error ({scope}/{source}): {e}")
+            return 0
+        sources.pop(source, None)
+        _commit(scope, vector_store, generation + 1, sources)
+        _record(scope, ("delete", source))
+    print(f"RAG: removed {len(ids)} vectors for '{source}' from {scope}")
+    return len(ids)
 
 def clear_memory(user_id=None):
-    path = get_index_path(user_id)
-    if os.path.exists(path):
-        shutil.rmtree(path, ignore_errors=True)
+    scope = get_scope_key(user_id)
+    with _write_lock(scope):
+        _clear(scope)
+
+def _clear(scope):
+    # Caller holds the scope's write lock
+    with _cache_lock:
+        store = _index_cache.pop(scope, None)
+        if store is not None:
+            _retire(store)
+        _index_sizes.pop(scope, None)
+        _source_ids.pop(scope, None)
+        _dirty_scopes.discard(scope)
+        # Keep _generations: the next write continues the sequence
+        generation = max(_generations.get(scope, 0), _read_pointer(scope)[0])
+        if os.path.exists(_pointer_path(scope)):
+            os.remove(_pointer_path(scope))
+        _prune_generations(scope, generation + KEEP_GENERATIONS)
+
+def migrate_legacy_indices():
+    """
+    Re-save every index still stored with a pickled docstore (or in the pre-generation
+    layout) in index_store's format. One scope at a time; searches carry on meanwhile.
+    """
+    if not os.path.isdir(MEMORY_DIR):
+        return 0
+    scopes = {name.split(".", 1)[0] for name in os.listdir(MEMORY_DIR) if not name.startswith(".")}
+    migrated = 0
+    for scope in sorted(scopes):
+        with _write_lock(scope):
+            try:
+                disk_generation, path = _read_pointer(scope)
+                if path is None or not index_store.is_legacy(path):
+                    continue
+                with _cache_lock:
+                    generation = max(disk_generation, _generations.get(scope, 0)) + 1
+                legacy_store = _load(path)
+                try:
+                    _save_scope(scope, legacy_store, generation)
+                finally:
+                    index_store.release(legacy_store)
+                with _cache_lock:
+                    if scope not in _dirty_scopes:
+                        _generations[scope] = generation
+            except Exception as e:
+                print(f"RAG Migration Error ({scope}): {e}")
+                continue
+        migrated += 1
+        print(f"RAG: migrated '{scope}' to the SQLite docstore format")
+    return migrated
 
 def rebuild_index(data_store_path: str):
-    # This legacy rebuild function was for the single index.
-    # We might need to deprecate or update it to scan the new separated folders.
-    # For now, let's keep it simple: It clears GLOBAL memory.
-    print("⚠️ Rebuild Index called - Clearing GLOBAL memory only.")
-    clear_memory(None)
-    # Re-implmentation logic would need to know which file belongs to whom.
-    # We will defer this logic to the new `train_text_internal` flow.
-    pass
+    """
+    Full re-index of data_store (global + every user). Blocks until done; resumes a previous run.
+    """
+    import index_rebuilder # Local import: index_rebuilder depends on this module
+    return index_rebuilder.run_rebuild(data_store_path)
 
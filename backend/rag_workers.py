@@ -0,0 +1,138 @@
+import asyncio
+import datetime
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import rag_engine
+
+# Configuration
+# rag_engine is synchronous (embedding + FAISS + index saves). Request handlers reach it
+# only through these executors, so a long ingestion never stalls the event loop.
+# Threads are enough: the embedding model and FAISS release the GIL while they work.
+RETRIEVAL_WORKERS = int(os.getenv("RAG_RETRIEVAL_WORKERS", "4"))
+INGEST_WORKERS = int(os.getenv("RAG_INGEST_WORKERS", "1")) # index writes serialize on rag_engine's lock anyway
+MAX_QUEUED_JOBS = int(os.getenv("RAG_MAX_QUEUED_JOBS", "32")) # per process; further uploads get 429
+JOB_HISTORY = 500 # finished jobs kept for the status endpoint
+
+_retrieval_pool = ThreadPoolExecutor(max_workers=max(1, RETRIEVAL_WORKERS), thread_name_prefix="rag-retrieve")
+_ingest_pool = ThreadPoolExecutor(max_workers=max(1, INGEST_WORKERS), thread_name_prefix="rag-ingest")
+
+
+class QueueFull(Exception):
+    """Too many ingestion jobs are waiting already."""
+
+
+# ==========================================
+# ASYNC WRAPPERS
+# ==========================================
+
+async def _run(pool, fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, lambda: fn(*args, **kwargs))
+
+async def retrieve_context(query_text: str, **kwargs):
+    return await _run(_retrieval_pool, rag_engine.retrieve_context, query_text, **kwargs)
+
+async def query_memory(query_text: str, **kwargs):
+    return await _run(_retrieval_pool, rag_engine.query_memory, query_text, **kwargs)
+
+async def add_chunks(chunks, **kwargs):
+    # chunks may be a lazy iterator (e.g. over an open file); it is consumed on the worker
+    return await _run(_ingest_pool, rag_engine.add_chunks, chunks, **kwargs)
+
+async def delete_documents(source: str, user_id: int = None):
+    return await _run(_ingest_pool, rag_engine.delete_documents, source, user_id=user_id)
+
+
+# ==========================================
+# BACKGROUND INGESTION JOBS
+# ==========================================
+
+class IngestJobs:
+    """
+    Training uploads run as background tasks on the event loop; their heavy part
+    (add_chunks) runs on the ingest executor. Status is kept in memory, per process.
+    """
+
+    def __init__(self, max_queued=MAX_QUEUED_JOBS, history=JOB_HISTORY):
+        self.max_queued = max(1, max_queued)
+        self.history = history
+        self._jobs = OrderedDict() # job_id -> status dict
+        self._tasks = {} # job_id -> asyncio.Task, while unfinished
+        self._lock = threading.Lock()
+
+    def submit(self, coro_fn, user_id=None, filename=None, scope=None):
+        """
+        Start coro_fn() in the background. It returns a dict merged into the job status
+        (e.g. {"chunks": n}). Returns the new job's status.
+        """
+        with self._lock:
+            if len(self._tasks) >= self.max_queued:
+                raise QueueFull()
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                "job_id": job_id,
+                "state": "queued", # queued | running | completed | failed
+                "user_id": user_id,
+                "filename": filename,
+                "scope": scope,
+                "created_at": datetime.datetime.now().isoformat(),
+                "finished_at": None,
+                "error": None,
+            }
+            self._tasks[job_id] = asyncio.ensure_future(self._run_job(job_id, coro_fn))
+            self._trim()
+            return dict(self._jobs[job_id])
+
+    def _update(self, job_id, **changes):
+        with self._lock:
+            self._jobs[job_id].update(changes)
+
+    async def _run_job(self, job_id, coro_fn):
+        self._update(job_id, state="running")
+        try:
+            result = await coro_fn()
+            self._update(job_id, state="completed", finished_at=datetime.datetime.now().isoformat(), **(result or {}))
+        except Exception as e:
+            print(f"Ingest Job Error ({job_id}): {e}")
+            self._update(job_id, state="failed", error=str(e), finished_at=datetime.datetime.now().isoformat())
+        finally:
+            with self._lock:
+                self._tasks.pop(job_id, None)
+
+    def _trim(self):
+        # Caller holds _lock. Forget the oldest finished jobs beyond `history`.
+        excess = len(self._jobs) - len(self._tasks) - self.history
+        for job_id in list(self._jobs):
+            if excess <= 0:
+                break
+            if job_id not in self._tasks:
+                del self._jobs[job_id]
+                excess -= 1
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list(self, user_id=None):
+        # Newest first; user_id None = every job (admin)
+        with self._lock:
+            return [dict(job) for job in reversed(self._jobs.values())
+                    if user_id is None or job["user_id"] == user_id]
+
+    def stats(self):
+        with self._lock:
+            return {"active": len(self._tasks), "tracked": len(self._jobs)}
+
+
+jobs = IngestJobs()
+
+
+def shutdown():
+    _retrieval_pool.shutdown(wait=False, cancel_futures=True)
+    # Let a running ingestion finish so its index save is not cut off
+    _ingest_pool.shutdown(wait=True, cancel_futures=True)
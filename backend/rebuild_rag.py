@@ -1,9 +1,10 @@
-import rag_engine
+import index_rebuilder
 import os
 
 print("Rebuilding index...")
 if os.path.exists("data_store"):
-    rag_engine.rebuild_index("data_store")
-    print("Rebuild complete.")
+    # Resumes automatically if a previous rebuild was interrupted
+    status = index_rebuilder.run_rebuild("data_store")
+    print(f"Rebuild complete. ({status['files_done']} files, {status['scopes_total']} scopes)")
 else:
     print("data_store not found.")
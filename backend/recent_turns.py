@@ -0,0 +1,70 @@
+import os
+import threading
+from collections import OrderedDict, deque
+
+# Configuration
+HISTORY_WINDOW = 6 # messages fed back to the LLM each turn
+MAX_USERS = int(os.getenv("RECENT_TURNS_MAX_USERS", "10000")) # least recently active users are dropped first
+
+
+class RecentTurns:
+    """
+    Per-user ring buffer of the last HISTORY_WINDOW chat messages as (role, content).
+    Filled from the database (plus transcript_writer's pending rows) on a user's first turn,
+    then kept in sync by append() after every write, so later turns read no rows at all.
+    Per-process: run a single worker, or each worker keeps its own copy in sync only
+    with its own writes.
+    """
+
+    def __init__(self, window=HISTORY_WINDOW, max_users=MAX_USERS):
+        self.window = window
+        self.max_users = max(1, max_users)
+        self._buffers = OrderedDict() # user_id -> deque[(role, content)]
+        self._generations = {} # user_id -> writes seen, so a slow DB read cannot install stale rows
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """
+        Recent messages, oldest first, or None if this user is not loaded yet.
+        """
+        with self._lock:
+            buffer = self._buffers.get(user_id)
+            if buffer is None:
+                return None
+            self._buffers.move_to_end(user_id)
+            return list(buffer)
+
+    def read_token(self, user_id):
+        # Take before reading the database; pass to load()
+        with self._lock:
+            return self._generations.get(user_id, 0)
+
+    def load(self, user_id, messages, token):
+        """
+        Install messages read from the database, unless a write landed while they were read.
+        """
+        with self._lock:
+            if self._generations.get(user_id, 0) != token:
+                return False
+            self._buffers[user_id] = deque(messages[-self.window:], maxlen=self.window)
+            self._buffers.move_to_end(user_id)
+            while len(self._buffers) > self.max_users:
+                evicted, _ = self._buffers.popitem(last=False)
+                self._generations.pop(evicted, None)
+            return True
+
+    def append(self, user_id, role, content):
+        # Call once the message is journaled (transcript_writer.submit); it may not be in the database yet
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            buffer = self._buffers.get(user_id)
+            if buffer is not None:
+                buffer.append((role, content))
+
+    def forget(self, user_id):
+        with self._lock:
+            self._buffers.pop(user_id, None)
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+
+turns = RecentTurns()
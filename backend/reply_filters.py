@@ -0,0 +1,190 @@
+import re
+
+# ==========================================
+# Reply post-processing that works both on a finished reply and incrementally on a token stream.
+# Each filter holds back only the few characters that could still be part of a pattern.
+# ==========================================
+
+# Mali speaks as "หนู". Applied left-to-right, non-overlapping (same result as sequential str.replace).
+PRONOUN_REPLACEMENTS = [
+    (" ฉัน ", " หนู "), # "Chan" with spaces (avoids words like "อ่านว่าฉัน")
+    ("ดิฉัน", "หนู"),   # Always kill "Di-Chan" (formal I)
+    ("คะ", "ค่า"),      # Common particles (make it cuter)
+    ("ค่ะ", "ค่า"),
+]
+LEADING_PRONOUN = ("ฉัน", "หนู")
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+
+def _is_partial_prefix(tail, patterns):
+    return any(p.startswith(tail) and p != tail for p in patterns)
+
+
+class PronounFilter:
+    """
+    Incremental version of the "ฉัน -> หนู" replacement done on every reply.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._at_start = True
+        self._patterns = [p for p, _ in PRONOUN_REPLACEMENTS]
+
+    def feed(self, text, final=False):
+        self._buffer += text
+        out = []
+
+        if self._at_start:
+            stripped = self._buffer.lstrip()
+            if not final and len(stripped) < len(LEADING_PRONOUN[0]):
+                return ""
+            self._buffer = stripped
+            if self._buffer.startswith(LEADING_PRONOUN[0]):
+                out.append(LEADING_PRONOUN[1])
+                self._buffer = self._buffer[len(LEADING_PRONOUN[0]):]
+            self._at_start = False
+
+        i = 0
+        buf = self._buffer
+        while i < len(buf):
+            for pattern, replacement in PRONOUN_REPLACEMENTS:
+                if buf.startswith(pattern, i):
+                    out.append(replacement)
+                    i += len(pattern)
+                    break
+            else:
+                # Might be the start of a pattern that has not fully arrived yet
+                if not final and _is_partial_prefix(buf[i:], self._patterns):
+                    break
+                out.append(buf[i])
+                i += 1
+        self._buffer = buf[i:]
+        return "".join(out)
+
+    def flush(self):
+        return self.feed("", final=True)
+
+
+class ThinkFilter:
+    """
+    Drops <think>...</think> blocks from a stream (an unclosed block is dropped to the end).
+    hold_chars > 0 also drops everything before a bare </think> (reasoning whose opening tag
+    was in the prompt), like the blocking path's split: the start of the stream is held back
+    until a tag arrives or hold_chars is exceeded. Text already passed on cannot be taken back.
+    """
+
+    def __init__(self, hold_chars=0):
+        self._buffer = ""
+        self._inside = False
+        self._hold_chars = hold_chars
+        self._holding = hold_chars > 0
+        self._tags = [THINK_OPEN, THINK_CLOSE] if hold_chars > 0 else [THINK_OPEN]
+
+    def feed(self, text, final=False):
+        self._buffer += text
+        out = []
+        while self._buffer:
+            lower = self._buffer.lower()
+            if self._inside:
+                end = lower.find(THINK_CLOSE)
+                if end == -1:
+                    # Keep just enough to recognise a split closing tag
+                    self._buffer = self._buffer[-(len(THINK_CLOSE) - 1):] if not final else ""
+                    break
+                self._buffer = self._buffer[end + len(THINK_CLOSE):]
+                self._inside = False
+            else:
+                start = lower.find(THINK_OPEN)
+                end = lower.find(THINK_CLOSE) if THINK_CLOSE in self._tags else -1
+                if end != -1 and (start == -1 or end < start):
+                    # Bare </think>: everything before it was reasoning
+                    out = []
+                    self._buffer = self._buffer[end + len(THINK_CLOSE):]
+                    self._holding = False
+                    continue
+                if start != -1:
+                    out.append(self._buffer[:start])
+                    self._buffer = self._buffer[start + len(THINK_OPEN):]
+                    self._inside = True
+                    self._holding = False
+                    continue
+                if self._holding and not final and len(self._buffer) < self._hold_chars:
+                    break # May still be reasoning waiting for its </think>
+                self._holding = False
+                # Hold back a possible partial tag
+                hold = 0
+                if not final:
+                    for n in range(min(max(map(len, self._tags)) - 1, len(lower)), 0, -1):
+                        if _is_partial_prefix(lower[-n:], self._tags):
+                            hold = n
+                            break
+                out.append(self._buffer[:len(self._buffer) - hold])
+                self._buffer = self._buffer[len(self._buffer) - hold:]
+                break
+        return "".join(out)
+
+    def flush(self):
+        return self.feed("", final=True)
+
+
+class StreamCleaner:
+    """
+    Stream equivalent of the remote-model cleanup: strip <think> blocks, a leading
+    "Answer:" / "- ตอบ:" label, and cut the stream at a leaked-thought marker.
+    """
+
+    LEADING_LABEL = re.compile(r'^(Answer:|- ตอบ:)\s*')
+    LABEL_PREFIXES = ["Answer:", "- ตอบ:"]
+
+    def __init__(self, cut_markers=("Okay, the user",), think_hold_chars=0):
+        self._think = ThinkFilter(hold_chars=think_hold_chars)
+        self._cut_markers = list(cut_markers)
+        self._pending = ""
+        self._at_start = True
+        self._stopped = False
+
+    def feed(self, text, final=False):
+        if self._stopped:
+            return ""
+        self._pending += self._think.feed(text, final=final)
+
+        if self._at_start:
+            stripped = self._pending.lstrip()
+            if not final and (not stripped or _is_partial_prefix(stripped, self.LABEL_PREFIXES)):
+                return ""
+            self._pending = self.LEADING_LABEL.sub("", stripped)
+            if not final and not self._pending:
+                return "" # Label consumed; keep skipping leading whitespace
+            self._at_start = False
+
+        for marker in self._cut_markers:
+            pos = self._pending.find(marker)
+            if pos != -1:
+                out = self._pending[:pos]
+                self._pending = ""
+                self._stopped = True
+                return out
+
+        # Hold back the longest tail that could still grow into a cut marker
+        hold = 0
+        if not final:
+            for marker in self._cut_markers:
+                for n in range(min(len(marker) - 1, len(self._pending)), 0, -1):
+                    if marker.startswith(self._pending[-n:]):
+                        hold = max(hold, n)
+                        break
+        out = self._pending[:len(self._pending) - hold]
+        self._pending = self._pending[len(self._pending) - hold:]
+        return out
+
+    def flush(self):
+        return self.feed("", final=True)
+
+
+def fix_pronouns(text):
+    """
+    Post-process a complete reply (same rules as PronounFilter).
+    """
+    return PronounFilter().feed(text, final=True)
@@ -0,0 +1,170 @@
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+# Configuration (opt-in)
+ENABLED = os.getenv("RESPONSE_CACHE", "0") == "1"
+TTL = float(os.getenv("RESPONSE_CACHE_TTL", "600")) # seconds
+MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX", "2000"))
+SIMILARITY_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.95")) # cosine, near-duplicate questions
+
+TRAILING_NOISE = re.compile(r"[\s.!?~…ๆ]+$")
+
+
+def normalize_message(message):
+    text = unicodedata.normalize("NFC", message).lower()
+    text = " ".join(text.split())
+    return TRAILING_NOISE.sub("", text)
+
+
+def scope_key(persona_key, rag_docs, nickname):
+    """
+    Everything besides the question a cached reply depends on: persona version,
+    the exact memories retrieved for it, and the name Mali calls the user.
+    """
+    digest = hashlib.sha1()
+    digest.update(f"{persona_key}\0{nickname}\0".encode("utf-8"))
+    for doc in rag_docs:
+        content = " ".join(doc.page_content.split())
+        digest.update(hashlib.sha1(content.encode("utf-8")).digest())
+    return digest.hexdigest()
+
+
+def owner_of(rag_docs, user_id):
+    # Replies built on private memories belong to that user (dropped when they train/forget)
+    if any(doc.metadata.get("scope", "global") != "global" for doc in rag_docs): # rag_engine.GLOBAL_INDEX
+        return user_id
+    return None
+
+
+class _Entry:
+    __slots__ = ("key", "scope", "vector", "reply", "owner", "expires_at")
+
+    def __init__(self, key, scope, vector, reply, owner, expires_at):
+        self.key = key
+        self.scope = scope
+        self.vector = vector
+        self.reply = reply
+        self.owner = owner
+        self.expires_at = expires_at
+
+
+class ResponseCache:
+    """
+    Reply cache for repeated questions. Exact hits match on the normalized message;
+    near-duplicates match by MiniLM embedding (cosine >= threshold) within the same scope_key.
+    TTL + LRU bounded. A hit skips generation entirely.
+    """
+
+    def __init__(self, enabled=ENABLED, ttl=TTL, max_entries=MAX_ENTRIES, threshold=SIMILARITY_THRESHOLD):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.threshold = threshold
+        self._entries = OrderedDict() # (normalized message, scope) -> _Entry
+        self._by_scope = {} # scope -> set of keys, for near-duplicate scans
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def _embed(self, message):
+        # Same text the retriever just embedded, so this is normally an embedding-cache hit
+        import rag_engine
+        if rag_engine.embeddings is None:
+            return None
+        vector = np.asarray(rag_engine.embeddings.embed_query(message), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _drop(self, key):
+        # Caller holds _lock
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            keys = self._by_scope.get(entry.scope)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_scope[entry.scope]
+
+    def lookup(self, message, scope):
+        if not self.enabled:
+            return None
+        key = (normalize_message(message), scope)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.reply
+            if entry is not None:
+                self._drop(key)
+            has_candidates = bool(self._by_scope.get(scope))
+
+        if has_candidates:
+            vector = self._embed(message)
+            if vector is not None:
+                with self._lock:
+                    best, best_score = None, self.threshold
+                    for candidate_key in list(self._by_scope.get(scope, ())):
+                        candidate = self._entries[candidate_key]
+                        if candidate.expires_at <= now:
+                            self._drop(candidate_key)
+                            continue
+                        if candidate.vector is None:
+                            continue
+                        score = float(np.dot(vector, candidate.vector))
+                        if score >= best_score:
+                            best, best_score = candidate, score
+                    if best is not None:
+                        self._entries.move_to_end(best.key)
+                        self.near_hits += 1
+                        return best.reply
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def store(self, message, scope, reply, owner=None):
+        if not self.enabled or not reply:
+            return
+        key = (normalize_message(message), scope)
+        vector = self._embed(message)
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = _Entry(key, scope, vector, reply, owner, time.monotonic() + self.ttl)
+            self._by_scope.setdefault(scope, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, user_id=None):
+        """
+        Memory changed. user_id None (Global memory) drops everything; otherwise that user's entries.
+        """
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                self._by_scope.clear()
+                return
+            for key in [k for k, e in self._entries.items() if e.owner == user_id]:
+                self._drop(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+            }
+
+
+cache = ResponseCache()
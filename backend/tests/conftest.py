@@ -0,0 +1,69 @@
+import os
+import sys
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+# Backend modules are imported flat (as main.py does)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import models
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """
+    A fresh SQLite database behind database.SessionLocal / AsyncSessionLocal.
+    Returns the sync session factory.
+    """
+    path = tmp_path / "test.db"
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    models.Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    monkeypatch.setattr(database, "SessionLocal", session_factory)
+    monkeypatch.setattr(database, "AsyncSessionLocal",
+                        async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False))
+    yield session_factory
+    engine.dispose()
+
+
+class FakeEmbeddings:
+    # Deterministic 3-d vectors: enough for FAISS, no model download
+    def __init__(self):
+        self.calls = 0
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        return [[float(len(text)), float(sum(map(ord, text)) % 97), 1.0] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+@pytest.fixture
+def rag(tmp_path, monkeypatch):
+    """
+    rag_engine with fake embeddings and its indices under tmp_path (skipped without faiss/langchain).
+    """
+    pytest.importorskip("faiss")
+    pytest.importorskip("langchain_community")
+    import rag_engine
+    monkeypatch.setattr(rag_engine, "embeddings", FakeEmbeddings())
+    monkeypatch.setattr(rag_engine, "MEMORY_DIR", str(tmp_path / "memory_indices"))
+    monkeypatch.setattr(rag_engine, "PERSIST_MODE", "write-through")
+    with rag_engine._cache_lock:
+        scopes = list(rag_engine._index_cache)
+    for scope in scopes:
+        with rag_engine._cache_lock:
+            rag_engine._index_cache.pop(scope, None)
+            rag_engine._index_sizes.pop(scope, None)
+            rag_engine._source_ids.pop(scope, None)
+    rag_engine._generations.clear()
+    yield rag_engine
+    for scope in list(rag_engine._index_cache):
+        with rag_engine._write_lock(scope):
+            rag_engine._clear(scope)
@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+
+import database
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imports database.py with engine creation stubbed out (no Postgres driver needed)
+PROBE = """
+import sqlalchemy, sqlalchemy.ext.asyncio as sa_async
+urls = []
+sqlalchemy.create_engine = lambda url, **kwargs: urls.append(url)
+sa_async.create_async_engine = lambda url, **kwargs: urls.append(url)
+import sqlalchemy.orm
+sqlalchemy.orm.sessionmaker = lambda **kwargs: None
+sa_async.async_sessionmaker = lambda *args, **kwargs: None
+import database
+print(database.SQLALCHEMY_DATABASE_URL)
+print(urls[0])
+print(urls[1])
+"""
+
+
+def test_postgres_scheme_is_normalised_for_both_engines():
+    env = {**os.environ, "DATABASE_URL": "postgres://u:p@db.example:5432/mali"}
+    out = subprocess.run([sys.executable, "-c", PROBE], cwd=BACKEND_DIR, env=env,
+                         capture_output=True, text=True, check=True).stdout.split()
+    assert out == [
+        "postgresql://u:p@db.example:5432/mali",
+        "postgresql://u:p@db.example:5432/mali",
+        "postgresql+asyncpg://u:p@db.example:5432/mali",
+    ]
+
+
+def test_async_url():
+    assert database._async_url("sqlite:///./x.db") == "sqlite+aiosqlite:///./x.db"
+    assert database._async_url("postgresql://h/db") == "postgresql+asyncpg://h/db"
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+
+import pytest
+
+from generation_scheduler import GenerationScheduler, SchedulerSaturated
+
+
+def blocked_scheduler(**kwargs):
+    # One worker, held inside a first job until the returned event is set
+    scheduler = GenerationScheduler(["engine"], **kwargs)
+    gate, started = threading.Event(), threading.Event()
+
+    def hold(engine):
+        started.set()
+        gate.wait(5)
+
+    scheduler.submit("holder", hold)
+    assert started.wait(5)
+    return scheduler, gate
+
+
+def test_users_are_served_round_robin():
+    scheduler, gate = blocked_scheduler()
+    order = []
+    record = lambda engine, name: order.append(name)
+    futures = [scheduler.submit(user, record, name=name)
+               for user, name in [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1"), ("c", "c1")]]
+    gate.set()
+    for future in futures:
+        future.result(5)
+    assert order == ["a1", "b1", "c1", "a2", "a3"]
+
+
+def test_full_queue_is_rejected_with_retry_after():
+    scheduler, gate = blocked_scheduler(max_queue=2)
+    scheduler.submit("a", lambda engine: None)
+    scheduler.submit("b", lambda engine: None)
+    with pytest.raises(SchedulerSaturated) as error:
+        scheduler.submit("c", lambda engine: None)
+    assert error.value.retry_after >= 1
+    assert scheduler.metrics()["rejected"] == 1
+    gate.set()
+
+
+def test_job_result_and_error_reach_the_caller():
+    scheduler = GenerationScheduler(["engine"])
+
+    def fail(engine):
+        raise ValueError("backend down")
+
+    async def main():
+        assert await scheduler.run(1, lambda engine, x: (engine, x), x=2) == ("engine", 2)
+        with pytest.raises(ValueError):
+            await scheduler.run(1, fail)
+
+    asyncio.run(main())
+    assert scheduler.metrics()["completed"] == 2
+
+
+def test_stream_yields_items_then_reraises_worker_errors():
+    scheduler = GenerationScheduler(["engine"])
+
+    def pieces(engine, fail):
+        yield "a"
+        yield "b"
+        if fail:
+            raise RuntimeError("stream broke")
+
+    async def collect(fail):
+        items = []
+        async for item in scheduler.stream(1, pieces, fail=fail):
+            items.append(item)
+        return items
+
+    assert asyncio.run(collect(False)) == ["a", "b"]
+    with pytest.raises(RuntimeError):
+        asyncio.run(collect(True))
+
+
+def test_abandoned_stream_stops_the_generator():
+    scheduler = GenerationScheduler(["engine"])
+    closed = threading.Event()
+    produced = []
+
+    def endless(engine):
+        try:
+            i = 0
+            while True:
+                produced.append(i)
+                yield i
+                i += 1
+        finally:
+            closed.set()
+
+    async def take_two():
+        stream = scheduler.stream(1, endless)
+        items = [await stream.__anext__(), await stream.__anext__()]
+        await stream.aclose()
+        return items
+
+    assert asyncio.run(take_two()) == [0, 1]
+    assert closed.wait(5)
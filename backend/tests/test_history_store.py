@@ -0,0 +1,65 @@
+import asyncio
+import json
+import types
+
+import database
+import history_store
+
+ADMIN = types.SimpleNamespace(id=1, role="admin")
+ALICE = types.SimpleNamespace(id=2, role="user")
+
+
+def add(entries):
+    async def main():
+        async with database.AsyncSessionLocal() as db:
+            for entry in entries:
+                await history_store.add_entry(db, entry)
+    asyncio.run(main())
+
+
+def pages(user, limit):
+    async def main():
+        collected, cursor = [], None
+        async with database.AsyncSessionLocal() as db:
+            while True:
+                entries, cursor = await history_store.list_visible(db, user, cursor=cursor, limit=limit)
+                collected.append([entry["filename"] for entry in entries])
+                if cursor is None:
+                    return collected
+    return asyncio.run(main())
+
+
+def test_cursor_pages_are_newest_first_and_complete(db):
+    add([{"filename": f"f{i}.txt", "user_id": None, "scope": "global", "status": "ok"} for i in range(5)])
+    assert pages(ADMIN, 2) == [["f4.txt", "f3.txt"], ["f2.txt", "f1.txt"], ["f0.txt"]]
+    # An exact multiple of the page size ends without an empty extra page
+    assert pages(ADMIN, 5) == [["f4.txt", "f3.txt", "f2.txt", "f1.txt", "f0.txt"]]
+
+
+def test_users_see_their_own_and_global_entries(db):
+    add([
+        {"filename": "global.txt", "user_id": None, "scope": "Global"},
+        {"filename": "alice.txt", "user_id": 2, "scope": "Private"},
+        {"filename": "bob.txt", "user_id": 3, "scope": "Private"},
+    ])
+    assert pages(ALICE, 10) == [["alice.txt", "global.txt"]]
+    assert pages(ADMIN, 10) == [["bob.txt", "alice.txt", "global.txt"]]
+
+
+def test_entries_for_files_newest_first(db):
+    add([{"filename": "a.txt", "user_id": 2}, {"filename": "b.txt", "user_id": 3}, {"filename": "a.txt", "user_id": 4}])
+    rows = history_store.entries_for_files(["a.txt"])
+    assert [row.user_id for row in rows] == [4, 2]
+    assert history_store.entries_for_files([]) == []
+
+
+def test_legacy_json_is_imported_once(db, tmp_path):
+    path = tmp_path / "training_history.json"
+    path.write_text(json.dumps([
+        {"filename": "old.txt", "timestamp": "2024-01-02T03:04:05", "scope": "global", "status": "Success (File)"},
+        {"timestamp": "no filename: skipped"},
+    ]), encoding="utf-8")
+    assert history_store.import_legacy_json(str(path)) == 1
+    assert history_store.import_legacy_json(str(path)) == 0
+    assert (tmp_path / "training_history.json.imported").exists()
+    assert pages(ADMIN, 10) == [["old.txt"]]
@@ -0,0 +1,76 @@
+import asyncio
+import os
+
+import pytest
+
+import database
+import history_store
+
+
+@pytest.fixture
+def rebuilder(rag, db, tmp_path, monkeypatch):
+    import index_rebuilder
+    staging = str(tmp_path / "staging")
+    monkeypatch.setattr(index_rebuilder, "STAGING_DIR", staging)
+    monkeypatch.setattr(index_rebuilder, "CHECKPOINT_FILE", os.path.join(staging, "checkpoint.json"))
+    return index_rebuilder
+
+
+def write(path, text="some remembered text"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return path
+
+
+def history(*entries):
+    async def main():
+        async with database.AsyncSessionLocal() as session:
+            for entry in entries:
+                await history_store.add_entry(session, entry)
+    asyncio.run(main())
+
+
+def indexed(rag, user_id):
+    store = rag.get_vector_store(user_id)
+    return sorted(rag._build_source_ids(store)) if store is not None else []
+
+
+def test_root_files_go_to_their_owner_or_are_skipped(rebuilder, tmp_path):
+    data = tmp_path / "data_store"
+    g = write(str(data / "global" / "g.txt"))
+    u = write(str(data / "users" / "7" / "u.txt"))
+    shared = write(str(data / "shared.txt"))
+    private = write(str(data / "private.txt"))
+    write(str(data / "orphan.txt"))
+    history(
+        {"filename": "shared.txt", "user_id": None, "scope": "Global"},
+        {"filename": "private.txt", "user_id": 9, "scope": "Private"},
+    )
+    assert rebuilder.discover_scopes(str(data)) == [(None, [g, shared]), (7, [u]), (9, [private])]
+
+
+def test_rebuild_resumes_after_a_failed_scope(rebuilder, rag, tmp_path, monkeypatch):
+    data = tmp_path / "data_store"
+    write(str(data / "global" / "g.txt"))
+    write(str(data / "users" / "7" / "u.txt"))
+    embed_batch = rebuilder._embed_batch
+
+    def fail_for_user(files, embedder):
+        if any(os.sep + "users" + os.sep in path for path in files):
+            raise RuntimeError("embedding service down")
+        return embed_batch(files, embedder)
+
+    monkeypatch.setattr(rebuilder, "_embed_batch", fail_for_user)
+    with pytest.raises(RuntimeError):
+        rebuilder.run_rebuild(str(data))
+    assert rebuilder.get_status()["state"] == "failed"
+    assert indexed(rag, None) == ["g.txt"]
+
+    monkeypatch.setattr(rebuilder, "_embed_batch", embed_batch)
+    calls = rag.embeddings.calls
+    status = rebuilder.run_rebuild(str(data))
+    assert status["state"] == "completed" and status["resumed"]
+    assert rag.embeddings.calls == calls + 1 # only the user scope was embedded again
+    assert indexed(rag, 7) == ["u.txt"]
+    assert not os.path.exists(rebuilder.STAGING_DIR)
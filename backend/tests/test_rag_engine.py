@@ -0,0 +1,47 @@
+import pytest
+
+
+def sources(rag, user_id):
+    store = rag.get_vector_store(user_id)
+    return sorted(rag._build_source_ids(store)) if store is not None else []
+
+
+def test_failed_ingest_publishes_nothing(rag):
+    rag.add_chunks(iter([("first", 0)]), base_metadata={"source": "a.txt"}, user_id=901)
+
+    def broken():
+        yield "partial", 0
+        raise OSError("upload went away")
+
+    with pytest.raises(OSError):
+        rag.add_chunks(broken(), base_metadata={"source": "b.txt"}, user_id=901, batch_size=1)
+    assert sources(rag, 901) == ["a.txt"]
+
+
+def test_delete_documents_by_source(rag):
+    rag.add_documents(["one", "two"], [{"source": "a.txt"}, {"source": "b.txt"}], user_id=902)
+    assert rag.delete_documents("a.txt", user_id=902) == 1
+    assert sources(rag, 902) == ["b.txt"]
+    assert [doc.page_content for doc in rag.query_memory("two", user_id=902)] == ["two"]
+
+
+def test_published_index_survives_a_reload(rag):
+    rag.add_documents(["kept"], [{"source": "a.txt"}], user_id=903)
+    with rag._cache_lock:
+        rag._index_cache.pop("user_903")
+        rag._source_ids.pop("user_903", None)
+    assert sources(rag, 903) == ["a.txt"]
+
+
+def test_install_index_replays_writes_made_during_a_rebuild(rag):
+    rag.add_documents(["old"], [{"source": "old.txt"}], user_id=904)
+    rebuilt = rag._clone_store(rag.get_vector_store(904))
+    rag.start_capture()
+    try:
+        rag.add_documents(["new"], [{"source": "new.txt"}], user_id=904)
+        rag.add_documents(["old again"], [{"source": "old.txt"}], user_id=904) # re-read by the rebuild itself
+        rag.install_index(rebuilt, user_id=904, rebuilt_sources={"old.txt"})
+    finally:
+        rag.stop_capture()
+    store = rag.get_vector_store(904)
+    assert sorted(doc.page_content for doc in (store.docstore.search(i) for i in store.index_to_docstore_id.values())) == ["new", "old"]
@@ -0,0 +1,32 @@
+from recent_turns import RecentTurns
+
+
+def test_unloaded_user_reads_none_then_window_after_load():
+    turns = RecentTurns(window=3)
+    assert turns.get(1) is None
+    assert turns.load(1, [("user", str(i)) for i in range(5)], turns.read_token(1))
+    assert turns.get(1) == [("user", "2"), ("user", "3"), ("user", "4")]
+    turns.append(1, "ai", "5")
+    assert turns.get(1) == [("user", "3"), ("user", "4"), ("ai", "5")]
+
+
+def test_stale_database_read_is_not_installed():
+    turns = RecentTurns()
+    token = turns.read_token(1)
+    turns.append(1, "user", "written while the query ran")
+    assert not turns.load(1, [], token)
+    assert turns.get(1) is None
+    assert turns.load(1, [("user", "written while the query ran")], turns.read_token(1))
+
+
+def test_least_recent_user_is_evicted_and_forget_invalidates():
+    turns = RecentTurns(max_users=2)
+    for user_id in (1, 2):
+        turns.load(user_id, [], turns.read_token(user_id))
+    turns.get(1) # 2 is now the least recently used
+    turns.load(3, [], turns.read_token(3))
+    assert turns.get(2) is None and turns.get(1) == [] and turns.get(3) == []
+    token = turns.read_token(1)
+    turns.forget(1)
+    assert turns.get(1) is None
+    assert not turns.load(1, [], token)
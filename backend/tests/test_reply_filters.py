@@ -0,0 +1,54 @@
+from reply_filters import PronounFilter, StreamCleaner, ThinkFilter, fix_pronouns
+
+
+def run(stream_filter, pieces):
+    out = [stream_filter.feed(piece) for piece in pieces]
+    return out, stream_filter.flush()
+
+
+def test_think_block_split_across_pieces():
+    out, tail = run(ThinkFilter(), ["Hi <thi", "nk>secret</th", "ink> there"])
+    assert "".join(out) + tail == "Hi  there"
+
+
+def test_unclosed_think_block_is_dropped():
+    out, tail = run(ThinkFilter(), ["answer<think>still thinking"])
+    assert "".join(out) + tail == "answer"
+
+
+def test_bare_close_ignored_by_default():
+    out, tail = run(ThinkFilter(), ["plain </think> text"])
+    assert "".join(out) + tail == "plain </think> text"
+
+
+def test_short_untagged_reply_streams_before_flush():
+    # Regression: the remote path held every reply shorter than the hold until flush()
+    cleaner = StreamCleaner(cut_markers=["Okay, the user"])
+    reply = "สวัสดีค่ะพี่ " * 20
+    out = [cleaner.feed(piece) for piece in reply.split(" ")]
+    assert "".join(out).strip()
+
+
+def test_bare_close_drops_reasoning_when_held():
+    out, tail = run(ThinkFilter(hold_chars=100), ["Okay, the user wants", " x.</thi", "nk>สวัสดีค่ะ"])
+    assert "".join(out) + tail == "สวัสดีค่ะ"
+
+
+def test_hold_is_released_after_hold_chars():
+    out, _ = run(ThinkFilter(hold_chars=10), ["abcdef", "ghijkl", "mno"])
+    assert out == ["", "abcdefghijkl", "mno"]
+
+
+def test_cleaner_strips_label_and_cuts_at_marker():
+    out, tail = run(StreamCleaner(), ["  Answer: ", "hello", " Okay, the", " user asked"])
+    assert "".join(out) + tail == "hello "
+
+
+def test_pronoun_filter_matches_one_shot_replacement():
+    text = "ฉันคิดว่า ฉัน ชอบค่ะ ดิฉันเองคะ"
+    expected = fix_pronouns(text)
+    for size in (1, 2, 3):
+        pronouns = PronounFilter()
+        out = [pronouns.feed(text[i:i + size]) for i in range(0, len(text), size)]
+        assert "".join(out) + pronouns.flush() == expected
+    assert expected.startswith("หนู")
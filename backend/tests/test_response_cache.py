@@ -0,0 +1,72 @@
+import numpy as np
+
+from response_cache import ResponseCache, normalize_message
+
+VECTORS = {
+    "what is my cat called": [1.0, 0.0],
+    "whats my cat called": [0.99, 0.14],
+    "how old am i": [0.0, 1.0],
+    "a": [0.0, 0.0, 1.0],
+    "b": [0.0, 0.0, 0.0, 1.0],
+    "c": [0.0, 0.0, 0.0, 0.0, 1.0],
+    "d": [0.0, 0.0, 0.0, 0.0, 0.0, 1.0],
+}
+
+
+def make_cache(**kwargs):
+    cache = ResponseCache(enabled=True, **kwargs)
+
+    def embed(message):
+        vector = np.zeros(6, dtype=np.float32)
+        values = VECTORS[normalize_message(message)]
+        vector[:len(values)] = values
+        return vector / np.linalg.norm(vector)
+
+    cache._embed = embed
+    return cache
+
+
+def test_disabled_cache_stores_nothing():
+    cache = ResponseCache(enabled=False)
+    cache.store("hi", "s", "hello")
+    assert cache.lookup("hi", "s") is None
+
+
+def test_exact_hit_ignores_case_spacing_and_trailing_punctuation():
+    cache = make_cache()
+    cache.store("What is my cat called?", "scope", "Mochi")
+    assert cache.lookup("  what is   my cat called!! ", "scope") == "Mochi"
+    assert cache.lookup("What is my cat called?", "other scope") is None
+    assert cache.stats()["hits"] == 1
+
+
+def test_near_duplicate_hit_within_scope_only():
+    cache = make_cache(threshold=0.95)
+    cache.store("what is my cat called", "scope", "Mochi")
+    assert cache.lookup("whats my cat called", "scope") == "Mochi"
+    assert cache.lookup("how old am i", "scope") is None
+    assert cache.stats()["near_hits"] == 1
+
+
+def test_expired_entries_miss(monkeypatch):
+    cache = make_cache(ttl=10)
+    clock = [100.0]
+    monkeypatch.setattr("response_cache.time.monotonic", lambda: clock[0])
+    cache.store("how old am i", "scope", "20")
+    clock[0] += 11
+    assert cache.lookup("how old am i", "scope") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_invalidate_by_owner_and_lru_bound():
+    cache = make_cache(max_entries=2)
+    cache.store("a", "s", "1", owner=7)
+    cache.store("b", "s", "2")
+    cache.invalidate(7)
+    assert cache.lookup("a", "s") is None and cache.lookup("b", "s") == "2"
+    cache.store("c", "s", "3")
+    cache.store("d", "s", "4")
+    assert cache.stats()["entries"] == 2
+    assert cache.lookup("b", "s") is None
+    cache.invalidate()
+    assert cache.stats()["entries"] == 0
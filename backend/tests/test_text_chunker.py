@@ -0,0 +1,45 @@
+import io
+
+import text_chunker
+from text_chunker import iter_chunks, iter_text_chunks
+
+THAI = "วันนี้อากาศดีมาก พี่นนท์ไปทำงานแต่เช้า แล้วกลับมากินข้าวที่บ้าน "
+TEXT = "\n\n".join(f"Paragraph {i}. " + THAI * (i % 4 + 1) for i in range(30))
+
+
+def test_short_text_is_one_chunk():
+    assert list(iter_text_chunks("  hello world  ")) == [("hello world", 0)]
+    assert list(iter_text_chunks("   \n ")) == []
+
+
+def test_chunks_fit_and_point_back_into_the_text():
+    chunks = list(iter_text_chunks(TEXT, chunk_size=200, overlap=40))
+    assert len(chunks) > 1
+    offsets = [offset for _, offset in chunks]
+    assert offsets == sorted(set(offsets))
+    for chunk, offset in chunks:
+        assert len(chunk) <= 200
+        assert TEXT[offset:].lstrip().startswith(chunk)
+
+
+def test_chunks_cover_the_whole_text_with_overlap():
+    chunks = list(iter_text_chunks(TEXT, chunk_size=200, overlap=40))
+    covered = set()
+    for chunk, offset in chunks:
+        start = offset + len(TEXT[offset:]) - len(TEXT[offset:].lstrip())
+        covered.update(range(start, start + len(chunk)))
+    assert all(i in covered for i, c in enumerate(TEXT) if not c.isspace())
+    # Consecutive chunks share some text (overlap), apart from a cut on a paragraph break
+    assert any(a[1] + len(a[0]) > b[1] for a, b in zip(chunks, chunks[1:]))
+
+
+def test_prefers_paragraph_breaks():
+    text = "a" * 120 + "\n\n" + "b " * 100
+    first, _ = next(iter_text_chunks(text, chunk_size=200, overlap=0))
+    assert first == "a" * 120
+
+
+def test_streaming_matches_whole_text(monkeypatch):
+    expected = list(iter_text_chunks(TEXT, chunk_size=150, overlap=30))
+    monkeypatch.setattr(text_chunker, "READ_BLOCK_CHARS", 7)
+    assert list(iter_chunks(io.StringIO(TEXT), chunk_size=150, overlap=30)) == expected
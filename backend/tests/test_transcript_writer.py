@@ -0,0 +1,112 @@
+import os
+import time
+
+from sqlalchemy import select
+
+import models
+import transcript_writer
+from transcript_writer import TranscriptWriter
+
+
+def stored(db):
+    with db() as session:
+        return session.execute(
+            select(models.ChatMessage.role, models.ChatMessage.content).order_by(models.ChatMessage.timestamp, models.ChatMessage.id)
+        ).all()
+
+
+def journals(writer):
+    return sorted(name for name in os.listdir(writer.journal_dir) if name.endswith(".jsonl"))
+
+
+def make_writer(tmp_path, **kwargs):
+    writer = TranscriptWriter(journal_dir=str(tmp_path / "journal"), **kwargs)
+    writer.start()
+    return writer
+
+
+def test_flush_inserts_in_submit_order(db, tmp_path):
+    writer = make_writer(tmp_path, flush_interval=60)
+    try:
+        batch = writer.submit(1, [("user", "q1"), ("ai", "a1")])
+        writer.submit(1, [("user", "q2"), ("ai", "a2")])
+        assert batch[0].timestamp < batch[1].timestamp
+        assert [m.content for m in writer.pending_for(1)] == ["q1", "a1", "q2", "a2"]
+        assert writer.flush() == 4
+        assert stored(db) == [("user", "q1"), ("ai", "a1"), ("user", "q2"), ("ai", "a2")]
+        assert writer.pending_for(1) == []
+        assert journals(writer) == [transcript_writer.CURRENT_JOURNAL]
+    finally:
+        writer.close()
+
+
+def test_replay_is_idempotent(db, tmp_path):
+    writer = make_writer(tmp_path, flush_interval=60)
+    writer.submit(1, [("user", "hello")])
+    # Simulate a crash: the journal stays behind, unflushed
+    writer._journal.close()
+    writer._journal = None
+
+    again = TranscriptWriter(journal_dir=writer.journal_dir)
+    again.replay()
+    again.replay()
+    assert stored(db) == [("user", "hello")]
+
+
+def test_failing_insert_backs_off_and_keeps_one_journal(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(transcript_writer, "MAX_ATTEMPTS", 1000)
+    writer = make_writer(tmp_path, flush_interval=0.05, flush_batch=1)
+    attempts = []
+
+    def failing_insert(batch, skip_existing=False):
+        attempts.append(len(batch))
+        raise RuntimeError("database is down")
+
+    monkeypatch.setattr(writer, "_insert", failing_insert)
+    try:
+        for i in range(5):
+            writer.submit(1, [("user", f"m{i}")])
+        time.sleep(0.5)
+        # 0.05, 0.1, 0.2, 0.4 s backoff: a handful of attempts, not a busy loop
+        assert 1 <= len(attempts) <= 6
+        flushing = [name for name in journals(writer) if name.startswith("flushing-")]
+        assert len(flushing) == 1
+        assert len(writer.pending_for(1)) == 5
+    finally:
+        del writer._insert # The database is back: close() flushes the same journal
+        writer.close()
+    assert len(stored(db)) == 5
+    assert journals(writer) == [transcript_writer.CURRENT_JOURNAL]
+
+
+def test_bad_row_is_dead_lettered_after_max_attempts(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(transcript_writer, "MAX_ATTEMPTS", 3)
+    writer = make_writer(tmp_path, flush_interval=60)
+    insert = writer._insert
+
+    def reject_bad(batch, skip_existing=False):
+        if any(message.content == "BAD" for message in batch):
+            raise RuntimeError("integrity error")
+        return insert(batch, skip_existing=skip_existing)
+
+    monkeypatch.setattr(writer, "_insert", reject_bad)
+    try:
+        writer.submit(1, [("user", "ok1"), ("ai", "BAD"), ("user", "ok2")])
+        for _ in range(2):
+            try:
+                writer.flush()
+            except RuntimeError:
+                pass
+        assert writer.failures == 2
+        writer.submit(1, [("user", "later")])
+        # Third attempt: good rows go in, the bad one is set aside, then the row queued behind it
+        assert writer.flush() == 3
+        assert writer.dead_lettered == 1
+        assert writer.failures == 0
+        assert [content for _, content in stored(db)] == ["ok1", "ok2", "later"]
+        dead = [name for name in journals(writer) if name.startswith("dead-")]
+        assert len(dead) == 1
+        with open(os.path.join(writer.journal_dir, dead[0]), encoding="utf-8") as f:
+            assert '"BAD"' in f.read()
+    finally:
+        writer.close()
@@ -0,0 +1,92 @@
+import io
+import os
+
+# Configuration
+# Sizes are in characters. all-MiniLM-L6-v2 truncates at 256 word-pieces, and Thai text
+# tokenizes close to one piece per character, so chunks stay well under that.
+CHUNK_SIZE = int(os.getenv("RAG_CHUNK_SIZE", "400"))
+CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "80"))
+READ_BLOCK_CHARS = 64 * 1024
+
+# Preferred cut points, strongest first. Thai has no spaces between words,
+# but uses a space (or newline) between phrases/sentences.
+SEPARATORS = ["\n\n", "\n", ". ", "! ", "? ", "ฯ ", " ", "\u200b"]
+
+# Optional: dictionary word segmentation for hard cuts inside long Thai runs
+try:
+    from pythainlp.tokenize import word_tokenize
+except ImportError:
+    word_tokenize = None
+
+
+def _find_cut(buffer, chunk_size):
+    """
+    Index at which to end the next chunk (exclusive).
+    Prefers the strongest separator found in the second half of the window.
+    """
+    window = buffer[:chunk_size]
+    min_cut = chunk_size // 2
+    for sep in SEPARATORS:
+        pos = window.rfind(sep)
+        if pos >= min_cut:
+            return pos + len(sep)
+
+    # No separator: avoid splitting a Thai word if we can segment it
+    if word_tokenize is not None:
+        try:
+            cut = 0
+            for word in word_tokenize(window, keep_whitespace=True):
+                if cut + len(word) > chunk_size:
+                    break
+                cut += len(word)
+            if cut >= min_cut:
+                return cut
+        except Exception:
+            pass
+    return chunk_size
+
+
+def _overlap_start(buffer, cut, overlap):
+    # Start the next chunk `overlap` chars back, snapped forward to a word/phrase boundary
+    start = max(1, cut - overlap)
+    boundary = buffer.find(" ", start, cut)
+    if boundary != -1:
+        return boundary + 1
+    return start
+
+
+def iter_chunks(stream, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """
+    Yields (chunk_text, char_offset) from a text stream without reading it all at once.
+    """
+    chunk_size = max(50, chunk_size)
+    overlap = max(0, min(overlap, chunk_size // 2 - 1))
+
+    buffer = ""
+    offset = 0 # char offset of buffer[0] in the stream
+    eof = False
+    while True:
+        while not eof and len(buffer) < chunk_size * 2:
+            block = stream.read(READ_BLOCK_CHARS)
+            if not block:
+                eof = True
+                break
+            buffer += block
+
+        if len(buffer) <= chunk_size:
+            if buffer.strip():
+                yield buffer.strip(), offset
+            return
+
+        cut = _find_cut(buffer, chunk_size)
+        chunk = buffer[:cut].strip()
+        if chunk:
+            yield chunk, offset
+
+        next_start = _overlap_start(buffer, cut, overlap)
+        buffer = buffer[next_start:]
+        offset += next_start
+
+
+def iter_text_chunks(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    return iter_chunks(io.StringIO(text), chunk_size=chunk_size, overlap=overlap)
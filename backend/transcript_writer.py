@@ -0,0 +1,283 @@
+import datetime
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+
+from sqlalchemy import insert, select
+
+import database
+import models
+
+# Configuration
+# Chat messages are acknowledged as soon as they are journaled; a background thread
+# inserts them in batched transactions.
+JOURNAL_DIR = os.getenv("TRANSCRIPT_JOURNAL_DIR", "transcript_journal")
+FLUSH_INTERVAL = float(os.getenv("TRANSCRIPT_FLUSH_MS", "250")) / 1000
+FLUSH_BATCH = int(os.getenv("TRANSCRIPT_FLUSH_BATCH", "200")) # flush early once this many rows wait
+# "interval": journal fsync'd once per flush cycle (a process crash loses nothing, a power cut up to one interval)
+# "always": fsync on every submit; "off": leave it to the OS
+JOURNAL_FSYNC = os.getenv("TRANSCRIPT_JOURNAL_FSYNC", "interval")
+# A failed flush is retried with exponential backoff (flush interval doubling up to RETRY_MAX_S).
+# After MAX_ATTEMPTS, its rows are inserted one by one and those that still fail are moved
+# to a dead-letter journal, so one bad row cannot hold up everything queued behind it.
+MAX_ATTEMPTS = int(os.getenv("TRANSCRIPT_FLUSH_ATTEMPTS", "8"))
+RETRY_MAX_S = float(os.getenv("TRANSCRIPT_RETRY_MAX_S", "60"))
+
+CURRENT_JOURNAL = "current.jsonl"
+REPLAY_CHUNK = 500
+
+
+class PendingMessage:
+    __slots__ = ("uid", "user_id", "role", "content", "timestamp")
+
+    def __init__(self, uid, user_id, role, content, timestamp):
+        self.uid = uid
+        self.user_id = user_id
+        self.role = role
+        self.content = content
+        self.timestamp = timestamp
+
+    def to_json(self):
+        return json.dumps({
+            "uid": self.uid,
+            "user_id": self.user_id,
+            "role": self.role,
+            "content": self.content,
+            "timestamp": self.timestamp.isoformat()
+        }, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, line):
+        data = json.loads(line)
+        return cls(data["uid"], data["user_id"], data["role"], data["content"],
+                   datetime.datetime.fromisoformat(data["timestamp"]))
+
+    def to_row(self):
+        return {"uid": self.uid, "user_id": self.user_id, "role": self.role,
+                "content": self.content, "timestamp": self.timestamp}
+
+
+class TranscriptWriter:
+    """
+    Write-behind queue for ChatMessage rows.
+    submit() appends to a local journal and returns; the flusher swaps the journal out,
+    inserts everything it held in one transaction, then deletes it.
+    Journals left by a crash are replayed at startup (rows are keyed by uid, so replay is idempotent).
+    """
+
+    def __init__(self, journal_dir=JOURNAL_DIR, flush_interval=FLUSH_INTERVAL, flush_batch=FLUSH_BATCH):
+        self.journal_dir = journal_dir
+        self.flush_interval = flush_interval
+        self.flush_batch = max(1, flush_batch)
+        self._cond = threading.Condition()
+        self._pending = []
+        self._journal = None
+        self._rotation = 0
+        self._last_timestamp = datetime.datetime.min
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+        self._retry = None # (journal_path, batch) rotated out but not inserted yet
+        self.failures = 0 # consecutive failed flushes
+        self.flushed = 0
+        self.flushes = 0
+        self.dead_lettered = 0
+
+    # --- Lifecycle ---
+
+    def start(self):
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self.replay()
+        self._journal = open(os.path.join(self.journal_dir, CURRENT_JOURNAL), "a", encoding="utf-8")
+        self._thread = threading.Thread(target=self._loop, name="transcript-writer", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        self.flush()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    # --- Writes ---
+
+    def submit(self, user_id, messages):
+        """
+        Queue [(role, content)] for user_id. Durable once this returns (see JOURNAL_FSYNC).
+        """
+        with self._cond:
+            if self._journal is None:
+                raise RuntimeError("Transcript writer is not running")
+            # Strictly increasing, so ordering by timestamp keeps the order messages were submitted in
+            batch = []
+            for role, content in messages:
+                self._last_timestamp = max(datetime.datetime.utcnow(), self._last_timestamp + datetime.timedelta(microseconds=1))
+                batch.append(PendingMessage(uuid.uuid4().hex, user_id, role, content, self._last_timestamp))
+            self._journal.write("".join(message.to_json() + "\n" for message in batch))
+            self._journal.flush()
+            if JOURNAL_FSYNC == "always":
+                os.fsync(self._journal.fileno())
+            self._pending.extend(batch)
+            if len(self._pending) >= self.flush_batch:
+                self._cond.notify()
+        return batch
+
+    def pending_for(self, user_id):
+        """
+        Messages for this user not yet in the database, oldest first.
+        """
+        with self._cond:
+            return [message for message in self._pending if message.user_id == user_id]
+
+    # --- Flushing ---
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                if self.failures:
+                    # Back off; a full queue must not turn retries into a busy loop
+                    deadline = time.monotonic() + self.retry_delay()
+                    while not self._stopping and time.monotonic() < deadline:
+                        self._cond.wait(deadline - time.monotonic())
+                elif not self._stopping and len(self._pending) < self.flush_batch:
+                    self._cond.wait(self.flush_interval)
+                if self._stopping:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                # Rows stay journaled; the next cycle (or the next startup) retries them
+                print(f"Transcript Flush Error ({self.failures}/{MAX_ATTEMPTS}): {e}")
+
+    def retry_delay(self):
+        return min(self.flush_interval * 2 ** (self.failures - 1), RETRY_MAX_S)
+
+    def _rotate(self):
+        # Caller holds _cond. Swap in a fresh journal; the old one covers exactly `batch`.
+        if not self._pending:
+            return None, []
+        if JOURNAL_FSYNC != "off":
+            os.fsync(self._journal.fileno())
+        self._journal.close()
+        self._rotation += 1
+        current = os.path.join(self.journal_dir, CURRENT_JOURNAL)
+        flushing = os.path.join(self.journal_dir, f"flushing-{os.getpid()}-{self._rotation}.jsonl")
+        os.replace(current, flushing)
+        self._journal = open(current, "a", encoding="utf-8")
+        return flushing, list(self._pending)
+
+    def flush(self):
+        with self._flush_lock:
+            # A retried batch is followed by whatever was queued behind it
+            retried = self._retry is not None
+            flushed = self._flush_batch()
+            if retried and self._retry is None:
+                flushed += self._flush_batch()
+            return flushed
+
+    def _flush_batch(self):
+        # Caller holds _flush_lock
+        with self._cond:
+            if self._retry is not None:
+                # Retry the journal that already holds these rows instead of rotating another
+                journal_path, batch = self._retry
+            elif self._journal is None:
+                return 0
+            else:
+                journal_path, batch = self._rotate()
+        if not batch:
+            return 0
+
+        dead = 0
+        try:
+            # A retry may follow a commit whose acknowledgement was lost
+            self._insert(batch, skip_existing=self._retry is not None)
+        except Exception:
+            self._retry = (journal_path, batch)
+            self.failures += 1
+            if self.failures < MAX_ATTEMPTS:
+                raise
+            dead = self._dead_letter(journal_path, batch)
+        with self._cond:
+            # Only the rows we took; newer ones were journaled into the fresh file
+            del self._pending[:len(batch)]
+            self.flushed += len(batch) - dead
+            self.flushes += 1
+        self._retry = None
+        self.failures = 0
+        os.remove(journal_path)
+        return len(batch) - dead
+
+    def _dead_letter(self, journal_path, batch):
+        # Caller holds _flush_lock. Insert what still can be; set the rest aside.
+        failed = []
+        for message in batch:
+            try:
+                self._insert([message], skip_existing=True)
+            except Exception as e:
+                failed.append((message, e))
+        if not failed:
+            return 0
+        dead_path = journal_path.replace("flushing-", "dead-", 1)
+        with open(dead_path, "a", encoding="utf-8") as f:
+            f.write("".join(message.to_json() + "\n" for message, _ in failed))
+        self.dead_lettered += len(failed)
+        print(f"Transcript writer: set {len(failed)} message(s) aside in {os.path.basename(dead_path)} "
+              f"after {self.failures} failed flushes (last error: {failed[-1][1]})")
+        return len(failed)
+
+    def _insert(self, batch, skip_existing=False):
+        db = database.SessionLocal()
+        try:
+            if skip_existing:
+                uids = [message.uid for message in batch]
+                existing = set()
+                for i in range(0, len(uids), REPLAY_CHUNK):
+                    existing.update(db.execute(
+                        select(models.ChatMessage.uid).where(models.ChatMessage.uid.in_(uids[i:i + REPLAY_CHUNK]))
+                    ).scalars())
+                batch = [message for message in batch if message.uid not in existing]
+            if batch:
+                db.execute(insert(models.ChatMessage), [message.to_row() for message in batch])
+            db.commit()
+            return len(batch)
+        finally:
+            db.close()
+
+    # --- Recovery ---
+
+    def replay(self):
+        """
+        Insert rows from journals left over by a crash, then remove them.
+        """
+        paths = sorted(glob.glob(os.path.join(self.journal_dir, "flushing-*.jsonl")), key=os.path.getmtime)
+        current = os.path.join(self.journal_dir, CURRENT_JOURNAL)
+        if os.path.exists(current):
+            paths.append(current)
+
+        for path in paths:
+            batch = []
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        batch.append(PendingMessage.from_json(line))
+                    except (ValueError, KeyError):
+                        pass # Torn last line from a crash mid-write
+            inserted = self._insert(batch, skip_existing=True) if batch else 0
+            os.remove(path)
+            print(f"Transcript journal: replayed {inserted} message(s) from {os.path.basename(path)}")
+
+    def stats(self):
+        with self._cond:
+            return {"pending": len(self._pending), "flushed": self.flushed, "flushes": self.flushes,
+                    "failures": self.failures, "dead_lettered": self.dead_lettered}
+
+
+writer = TranscriptWriter()
@@ -0,0 +1,183 @@
+import asyncio
+import importlib
+import io
+import json
+import os
+import threading
+import wave
+
+import speech_recognition as sr
+from pydub import AudioSegment
+
+import worker_pools
+
+# Configuration
+# STT_BACKENDS is tried in order; the next backend runs only if one is unreachable/unavailable
+# (e.g. "google,whisper" falls back to the local model when offline).
+# Built-ins: google (online), whisper and vosk (offline); or "module:function" for your own.
+STT_BACKENDS = [b.strip() for b in os.getenv("STT_BACKENDS", "google").split(",") if b.strip()]
+STT_LANGUAGE = os.getenv("STT_LANGUAGE", "th-TH")
+STT_WORKERS = int(os.getenv("STT_WORKERS", "2"))
+STT_MAX_UPLOAD_MB = float(os.getenv("STT_MAX_UPLOAD_MB", "10"))
+WHISPER_MODEL = os.getenv("STT_WHISPER_MODEL", "small")
+VOSK_MODEL_PATH = os.getenv("STT_VOSK_MODEL", "models/vosk")
+
+TARGET_RATE = 16000 # Hz, mono 16-bit: what every backend handles well
+
+
+class BackendUnavailable(Exception):
+    """The backend cannot run here (no network, missing package/model); try the next one."""
+
+
+# ==========================================
+# DECODING (in memory, no temp files)
+# ==========================================
+
+def _decode_wav(data):
+    with wave.open(io.BytesIO(data), "rb") as wav:
+        frames = wav.readframes(wav.getnframes())
+        return sr.AudioData(frames, wav.getframerate(), wav.getsampwidth())
+
+
+def decode_audio(data: bytes) -> sr.AudioData:
+    """
+    Upload bytes (wav/webm/ogg/mp3/...) -> AudioData. Plain PCM WAV is parsed directly;
+    anything else goes through ffmpeg over pipes.
+    """
+    if data[:4] == b"RIFF":
+        try:
+            return _decode_wav(data)
+        except (wave.Error, EOFError):
+            pass # Compressed WAV variants: let ffmpeg handle them
+    sound = AudioSegment.from_file(io.BytesIO(data))
+    sound = sound.set_channels(1).set_frame_rate(TARGET_RATE).set_sample_width(2)
+    return sr.AudioData(sound.raw_data, sound.frame_rate, sound.sample_width)
+
+
+# ==========================================
+# RECOGNITION BACKENDS
+# ==========================================
+
+_recognizer = None # one per worker process; keeps loaded local models between calls
+_recognizer_lock = threading.Lock()
+
+
+def _get_recognizer():
+    global _recognizer
+    with _recognizer_lock:
+        if _recognizer is None:
+            _recognizer = sr.Recognizer()
+        return _recognizer
+
+
+def _recognize_google(audio, language):
+    try:
+        return _get_recognizer().recognize_google(audio, language=language)
+    except sr.RequestError as e:
+        raise BackendUnavailable(f"Google STT unreachable: {e}")
+
+
+def _recognize_whisper(audio, language):
+    # Offline: openai-whisper on this machine (weights are downloaded once, then cached)
+    if not hasattr(sr.Recognizer, "recognize_whisper"):
+        raise BackendUnavailable("SpeechRecognition is too old for recognize_whisper")
+    try:
+        return _get_recognizer().recognize_whisper(audio, model=WHISPER_MODEL, language=language.split("-")[0])
+    except (ImportError, sr.RequestError) as e:
+        raise BackendUnavailable(f"Whisper unavailable: {e}")
+
+
+_vosk_model = None
+
+def _recognize_vosk(audio, language):
+    # Offline: Vosk with a model unpacked at STT_VOSK_MODEL
+    global _vosk_model
+    try:
+        from vosk import KaldiRecognizer, Model
+    except ImportError as e:
+        raise BackendUnavailable(f"Vosk unavailable: {e}")
+    if _vosk_model is None:
+        if not os.path.isdir(VOSK_MODEL_PATH):
+            raise BackendUnavailable(f"Vosk model not found at {VOSK_MODEL_PATH}")
+        _vosk_model = Model(VOSK_MODEL_PATH)
+    recognizer = KaldiRecognizer(_vosk_model, TARGET_RATE)
+    recognizer.AcceptWaveform(audio.get_raw_data(convert_rate=TARGET_RATE, convert_width=2))
+    return json.loads(recognizer.FinalResult()).get("text", "")
+
+
+BACKENDS = {
+    "google": _recognize_google,
+    "whisper": _recognize_whisper,
+    "vosk": _recognize_vosk,
+}
+
+
+def _resolve_backend(name):
+    # Built-in name, or "module:function" for a custom recognizer fn(audio_data, language) -> text
+    # (raise BackendUnavailable from it to fall through to the next backend)
+    if name in BACKENDS:
+        return BACKENDS[name]
+    if ":" in name:
+        module_name, attr = name.split(":", 1)
+        try:
+            return getattr(importlib.import_module(module_name), attr)
+        except (ImportError, AttributeError) as e:
+            print(f"STT: cannot load backend '{name}': {e}")
+            return None
+    print(f"STT: unknown backend '{name}'")
+    return None
+
+
+def recognize(audio, language=STT_LANGUAGE, backends=None):
+    for name in backends or STT_BACKENDS:
+        fn = _resolve_backend(name)
+        if fn is None:
+            continue
+        try:
+            return fn(audio, language) or ""
+        except sr.UnknownValueError:
+            return "" # Heard nothing intelligible: another backend will not do better
+        except BackendUnavailable as e:
+            print(f"STT: {e}")
+    return ""
+
+
+def transcribe_bytes(data: bytes, language=STT_LANGUAGE, backends=None) -> str:
+    """
+    Decode + recognize. Runs inside a worker (see transcribe).
+    """
+    if not data:
+        return ""
+    return recognize(decode_audio(data), language=language, backends=backends)
+
+
+# ==========================================
+# ASYNC ENTRY POINT
+# ==========================================
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = worker_pools.make_cpu_pool(STT_WORKERS, "stt")
+        return _pool
+
+
+async def transcribe(data: bytes, language=STT_LANGUAGE, backends=None) -> str:
+    """
+    Transcribe upload bytes on the STT worker pool; the event loop keeps serving meanwhile.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_pool(), transcribe_bytes, data, language, backends)
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
@@ -1,12 +1,15 @@
 import urllib.request
-import json
+import os
+import sys
 
-url = "http://localhost:8000/forget"
-data = json.dumps({"filename": "force_rebuild_dummy"}).encode("utf-8")
-req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+# Usage: python trigger_rebuild.py <admin access token>   (or set MALI_ADMIN_TOKEN)
+token = sys.argv[1] if len(sys.argv) > 1 else os.getenv("MALI_ADMIN_TOKEN", "")
+
+url = "http://localhost:8000/admin/rebuild"
+req = urllib.request.Request(url, data=b"", method="POST", headers={'Authorization': f'Bearer {token}'})
 try:
     with urllib.request.urlopen(req) as f:
         print(f"Response: {f.read().decode('utf-8')}")
-    print("Rebuild triggered successfully.")
+    print("Rebuild triggered successfully. Poll GET /admin/rebuild for progress.")
 except Exception as e:
     print(f"Failed to trigger rebuild: {e}")
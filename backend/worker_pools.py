@@ -0,0 +1,27 @@
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def main_is_app_script():
+    """
+    True when started as `python main.py` (or another script in this folder).
+    Spawned workers re-run __main__ on start-up, which would load the LLM in every one of them.
+    """
+    main_file = getattr(sys.modules.get("__main__"), "__file__", None)
+    if not main_file:
+        return False
+    return os.path.dirname(os.path.abspath(main_file)) == os.path.dirname(os.path.abspath(__file__))
+
+
+def make_cpu_pool(max_workers, name):
+    """
+    Process pool for CPU-bound work (spawned workers import only the module of the submitted
+    function). Falls back to threads under `python main.py`; the jobs we run there (hashlib,
+    ffmpeg subprocesses, torch) release the GIL for their heavy parts.
+    """
+    max_workers = max(1, max_workers)
+    if main_is_app_script():
+        return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
@@ -72,7 +72,7 @@ import { AuthService } from '../../services/auth.service';
               <ul class="history-list">
                   <li *ngFor="let item of history" class="history-item">
                       <div class="item-left">
-                           <span class="history-icon" [title]="item.scope">{{ item.scope === 'global' ? '🌎' : '🔒' }}</span>
+                           <span class="history-icon" [title]="item.scope">{{ item.scope?.toLowerCase() === 'global' ? '🌎' : '🔒' }}</span>
                           <div class="history-info">
                               <strong>{{ item.filename }}</strong>
                               <small>{{ item.timestamp }}</small>
@@ -85,6 +85,7 @@ import { AuthService } from '../../services/auth.service';
                   </li>
                   <li *ngIf="history.length === 0" class="empty-state">No memories yet.</li>
               </ul>
+              <button *ngIf="historyCursor !== null" (click)="loadMoreHistory()" class="btn-save width-full">Load more</button>
           </div>
       </div>
       
@@ -179,6 +180,7 @@ export class TrainingComponent implements OnInit {
   isUploading = false;
   uploadStatus = '';
   history: any[] = [];
+  historyCursor: number | null = null;
   mode: 'file' | 'text' | 'persona' | 'history' = 'file';
 
   constructor(private chatService: ChatService, private authService: AuthService) { }
@@ -264,7 +266,15 @@ export class TrainingComponent implements OnInit {
 
   loadHistory() {
     this.chatService.getHistory().subscribe(data => {
-      this.history = data.reverse();
+      this.history = data.items;
+      this.historyCursor = data.next_cursor;
+    });
+  }
+
+  loadMoreHistory() {
+    this.chatService.getHistory(this.historyCursor).subscribe(data => {
+      this.history = this.history.concat(data.items);
+      this.historyCursor = data.next_cursor;
     });
   }
 
@@ -1,6 +1,7 @@
 import { Injectable } from '@angular/core';
 import { HttpClient } from '@angular/common/http';
-import { Observable } from 'rxjs';
+import { Observable, timer } from 'rxjs';
+import { first, map, switchMap } from 'rxjs/operators';
 
 export interface ChatResponse {
     reply: string;
@@ -89,16 +90,29 @@ export class ChatService {
         const formData = new FormData();
         formData.append('file', file);
         formData.append('scope', scope);
-        return this.http.post(`${this.baseUrl}/train`, formData);
+        return this.http.post<any>(`${this.baseUrl}/train`, formData).pipe(switchMap(job => this.waitForTrainingJob(job)));
     }
 
-    getHistory(): Observable<any[]> {
-        // History stored Locally
-        return this.http.get<any[]>(`${this.baseUrl}/history`);
+    getHistory(cursor: number | null = null): Observable<{ items: any[], next_cursor: number | null }> {
+        // History stored Locally (newest first, paginated)
+        const query = cursor !== null ? `?cursor=${cursor}` : '';
+        return this.http.get<{ items: any[], next_cursor: number | null }>(`${this.baseUrl}/history${query}`);
     }
 
     trainText(title: string, text: string, scope: 'private' | 'global' = 'private'): Observable<any> {
-        return this.http.post(`${this.baseUrl}/train-text`, { title, text, scope });
+        return this.http.post<any>(`${this.baseUrl}/train-text`, { title, text, scope }).pipe(switchMap(job => this.waitForTrainingJob(job)));
+    }
+
+    private waitForTrainingJob(job: any): Observable<any> {
+        // Training runs in the background on the server: poll until the job finishes
+        return timer(0, 1000).pipe(
+            switchMap(() => this.http.get<any>(`${this.baseUrl}/train/jobs/${job.job_id}`)),
+            first(status => status.state === 'completed' || status.state === 'failed'),
+            map(status => {
+                if (status.state === 'failed') throw new Error(status.error || 'Training failed');
+                return status;
+            })
+        );
     }
 
     getPersona(): Observable<{ persona: string }> {